@@ -0,0 +1,421 @@
+"""
+Benchmark of the build pipeline on synthetic Pushshift-shaped data.
+
+The generator is deterministic (seeded) and gives realistic thread shapes: heavy-tailed thread sizes, some deep reply
+chains, deleted (missing) parents, deleted authors without author_fullname and a few very active redditors. Every stage
+(zst decode, json load, convert_to_object, update_parent, update_attr) is timed, with the memory it takes, at several
+dataset sizes. Every dataset is generated in its own process and built in a fresh one, so the peak memory is the one of
+the build, and the time per record of the largest size is compared with the smallest one to catch scaling regressions.
+With --compact, the objects are built with dict and with CompactData _data instead (see compare_compact), to compare
+the bytes of a record, the memory kept by the objects and the time of the build.
+
+python -m reddit_object.benchmark --sizes 1000 10000 100000 --output_dir /tmp/reddit_benchmark --check
+python -m reddit_object.benchmark --sizes 4000 --compact
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import zstandard
+
+from .data_processor import DataProcessorReddit
+from .load import LoadSubmissions, LoadComments
+from . import objects
+from .instrumentation import peak_rss_mb, rss_mb
+from .zst2json import read_lines_zst
+
+stages = ["zst_decode", "json_load", "convert_to_object", "update_parent", "update_attr"]
+
+submission_template = {
+    "all_awardings": [], "allow_live_comments": False, "archived": False, "author": None,
+    "author_flair_css_class": None, "author_flair_richtext": [], "author_flair_text": None,
+    "author_flair_type": "text", "author_fullname": None, "author_patreon_flair": False, "author_premium": False,
+    "awarders": [], "can_gild": True, "category": None, "content_categories": None, "contest_mode": False,
+    "created_utc": 0, "discussion_type": None, "distinguished": None, "domain": "self.AskReddit", "edited": False,
+    "gilded": 0, "gildings": {}, "hidden": False, "id": None, "is_created_from_ads_ui": False, "is_self": True,
+    "is_video": False, "link_flair_css_class": None, "link_flair_richtext": [], "link_flair_text": None,
+    "link_flair_type": "text", "locked": False, "media": None, "no_follow": True, "num_comments": 0,
+    "num_crossposts": 0, "over_18": False, "permalink": None, "pinned": False, "retrieved_on": 0, "score": 1,
+    "selftext": "", "send_replies": True, "spoiler": False, "stickied": False, "subreddit": None,
+    "subreddit_id": None, "subreddit_name_prefixed": None, "subreddit_subscribers": 1000000,
+    "subreddit_type": "public", "thumbnail": "self", "title": None, "total_awards_received": 0,
+    "treatment_tags": [], "upvote_ratio": 1.0, "url": None,
+}
+
+comment_template = {
+    "all_awardings": [], "archived": False, "associated_award": None, "author": None,
+    "author_created_utc": 1389999999, "author_flair_background_color": None, "author_flair_css_class": None,
+    "author_flair_richtext": [], "author_flair_template_id": None, "author_flair_text": None,
+    "author_flair_text_color": None, "author_flair_type": "text", "author_fullname": None,
+    "author_patreon_flair": False, "author_premium": False, "awarders": [], "body": None, "can_gild": True,
+    "can_mod_post": False, "collapsed": False, "collapsed_because_crowd_control": None, "collapsed_reason": None,
+    "comment_type": None, "controversiality": 0, "created_utc": 0, "distinguished": None, "edited": False,
+    "gilded": 0, "gildings": {}, "id": None, "is_submitter": False, "link_id": None, "locked": False,
+    "no_follow": True, "parent_id": None, "permalink": None, "retrieved_on": 0, "score": 1, "send_replies": True,
+    "stickied": False, "subreddit": None, "subreddit_id": None, "subreddit_name_prefixed": None,
+    "subreddit_type": "public", "top_awarded_type": None, "total_awards_received": 0, "treatment_tags": [],
+}
+
+words = ["the", "game", "season", "think", "better", "really", "never", "people", "first", "because", "would",
+         "thread", "comment", "thanks", "agree", "source", "actually", "probably", "reddit", "post"]
+
+
+def base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+    return result or "0"
+
+
+def generate_dataset(num_submissions, seed=0, mean_comments=20, max_comments=100000, chain_fraction=0.02,
+                     deleted_parent_fraction=0.02, deleted_author_fraction=0.05, num_subreddits=50,
+                     num_redditors=None, start_utc=1609459200):
+    """
+    generate Pushshift-shaped submissions and comments, the same ones for the same arguments
+    :param num_submissions: number of submissions
+    :param seed: random seed
+    :param mean_comments: mean number of comments per submission, the sizes follow a Pareto distribution (most threads
+    are small, a few are huge)
+    :param max_comments: maximum number of comments of a submission
+    :param chain_fraction: fraction of the threads which are one deep chain of replies
+    :param deleted_parent_fraction: fraction of the comments whose parent comment is not in the data
+    :param deleted_author_fraction: fraction of the objects whose author is [deleted] (no author_fullname)
+    :param num_subreddits: number of subreddits
+    :param num_redditors: number of redditors (default: 2 per submission), a few of them post most of the objects
+    :param start_utc: created_utc of the first submission
+    :return: list of submissions and list of comments (in created_utc order, as in the dumps)
+    """
+    rnd = random.Random(seed)
+    num_redditors = num_redditors or max(10, 2 * num_submissions)
+    subreddits = [(f"subreddit{idx}", f"t5_{base36(36 ** 4 + idx)}") for idx in range(num_subreddits)]
+    next_id = 36 ** 5
+    pareto_alpha = 1.5
+    submissions = []
+    comments = []
+
+    def pick_author(record):
+        if rnd.random() < deleted_author_fraction:
+            record["author"] = "[deleted]"
+            del record["author_fullname"]
+        else:
+            # heavy-tailed activity: the first redditors (bots, power users) post most of the objects
+            idx = int(num_redditors * rnd.random() ** 3)
+            record["author"] = f"redditor{idx}"
+            record["author_fullname"] = f"t2_{base36(36 ** 5 + idx)}"
+
+    def text(length):
+        return " ".join(rnd.choice(words) for _ in range(length))
+
+    for submission_idx in range(num_submissions):
+        created_utc = start_utc + submission_idx * 30 + rnd.randint(0, 29)
+        subreddit, subreddit_id = subreddits[int(num_subreddits * rnd.random() ** 2)]
+        submission_id = base36(next_id)
+        next_id += 1
+        submission = dict(submission_template, id=submission_id, created_utc=created_utc, subreddit=subreddit,
+                          subreddit_id=subreddit_id, subreddit_name_prefixed=f"r/{subreddit}",
+                          title=text(rnd.randint(3, 15)), selftext=text(rnd.randint(0, 60)),
+                          score=rnd.randint(0, 5000), retrieved_on=created_utc + 3600,
+                          permalink=f"/r/{subreddit}/comments/{submission_id}/",
+                          url=f"https://www.reddit.com/r/{subreddit}/comments/{submission_id}/")
+        pick_author(submission)
+
+        pareto = rnd.paretovariate(pareto_alpha) - 1
+        num_comments = min(max_comments, int(mean_comments * (pareto_alpha - 1) * pareto))
+        submission["num_comments"] = num_comments
+        submissions.append(submission)
+        chain = rnd.random() < chain_fraction
+        thread_ids = []
+        comment_utc = created_utc
+        for _ in range(num_comments):
+            comment_id = base36(next_id)
+            next_id += 1
+            comment_utc += rnd.randint(0, 60)
+            if rnd.random() < deleted_parent_fraction:
+                # the parent comment was deleted before the dump, it is not in the data
+                parent_id = f"t1_{base36(36 ** 6 + next_id)}"
+            elif chain:
+                parent_id = f"t1_{thread_ids[-1]}" if thread_ids else f"t3_{submission_id}"
+            elif not thread_ids or rnd.random() < 0.3:
+                parent_id = f"t3_{submission_id}"
+            else:
+                # replies mostly go to the recent comments
+                parent_id = f"t1_{thread_ids[int(len(thread_ids) * rnd.random() ** 0.5)]}"
+            comment = dict(comment_template, id=comment_id, created_utc=comment_utc, link_id=f"t3_{submission_id}",
+                           parent_id=parent_id, subreddit=subreddit, subreddit_id=subreddit_id,
+                           subreddit_name_prefixed=f"r/{subreddit}", body=text(rnd.randint(1, 80)),
+                           score=rnd.randint(-20, 500), retrieved_on=comment_utc + 3600,
+                           permalink=f"/r/{subreddit}/comments/{submission_id}/_/{comment_id}/")
+            pick_author(comment)
+            thread_ids.append(comment_id)
+            comments.append(comment)
+    comments.sort(key=lambda x: x["created_utc"])
+    return submissions, comments
+
+
+def write_dataset(submissions, comments, output_dir, name):
+    """
+    write the submissions and comments as jsonl files, and the comments as a zst file as in the Pushshift dumps
+    :return: submission file, comment file, comment zst file
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    submission_file = os.path.join(output_dir, f"{name}_submissions.jsonl")
+    comment_file = os.path.join(output_dir, f"{name}_comments.jsonl")
+    comment_zst_file = os.path.join(output_dir, f"{name}_comments.zst")
+    with open(submission_file, "w") as f:
+        for submission in submissions:
+            f.write(json.dumps(submission) + "\n")
+    with open(comment_file, "w") as f:
+        for comment in comments:
+            f.write(json.dumps(comment) + "\n")
+    with open(comment_file, "rb") as f_in, open(comment_zst_file, "wb") as f_out:
+        zstandard.ZstdCompressor(level=3).copy_stream(f_in, f_out)
+    return submission_file, comment_file, comment_zst_file
+
+
+def run_stages(submission_file, comment_file, comment_zst_file=None, json_backend=None):
+    """
+    build the objects of the files stage by stage in a new registry, timing every stage and measuring the resident
+    memory at its end and the memory it takes (None where instrumentation.rss_mb is not available)
+    :return: dict with the seconds and memory of every stage, the number of records and objects, the memory of the
+    process before the stages and its peak memory
+    """
+    timings = {}
+    memory = {}
+    baseline_rss = rss_mb()
+
+    def end_stage(stage, begin_time, begin_rss):
+        timings[stage] = time.perf_counter() - begin_time
+        end_rss = rss_mb()
+        memory[stage] = {"rss_mb": end_rss,
+                         "rss_delta_mb": None if begin_rss is None or end_rss is None else end_rss - begin_rss}
+
+    if comment_zst_file:
+        begin_time, begin_rss = time.perf_counter(), rss_mb()
+        for _ in read_lines_zst(comment_zst_file):
+            pass
+        end_stage("zst_decode", begin_time, begin_rss)
+
+    begin_time, begin_rss = time.perf_counter(), rss_mb()
+    submissions = LoadSubmissions(submission_file, json_backend)
+    comments = LoadComments(comment_file, json_backend)
+    end_stage("json_load", begin_time, begin_rss)
+
+    registry = objects.Registry()
+    begin_time, begin_rss = time.perf_counter(), rss_mb()
+    submissions.convert_to_object(partial(objects.create_submission, registry=registry))
+    comments.convert_to_object(partial(objects.create_comment, registry=registry))
+    end_stage("convert_to_object", begin_time, begin_rss)
+
+    begin_time, begin_rss = time.perf_counter(), rss_mb()
+    for comment in registry["comment"].values():
+        comment.update_parent()
+    end_stage("update_parent", begin_time, begin_rss)
+
+    begin_time, begin_rss = time.perf_counter(), rss_mb()
+    objects.update_comment_trees(registry=registry)
+    end_stage("update_attr", begin_time, begin_rss)
+
+    return {"timings": timings, "memory": memory, "records": len(submissions) + len(comments),
+            "objects": {object_type: len(objects_of_type) for object_type, objects_of_type in registry.items()},
+            "baseline_rss_mb": baseline_rss, "peak_rss_mb": peak_rss_mb()}
+
+
+def generate_files(size, output_dir, seed=0, mean_comments=20):
+    """
+    generate the dataset of a size and write it (see write_dataset), run in its own process so the memory of the
+    generator is released with it
+    :return: submission file, comment file, comment zst file
+    """
+    submissions, comments = generate_dataset(size, seed=seed, mean_comments=mean_comments)
+    return write_dataset(submissions, comments, output_dir, f"synthetic_{size}")
+
+
+def fresh_process() -> ProcessPoolExecutor:
+    """
+    executor of one new process whose peak memory (ru_maxrss) is its own: a forked process, and on Linux a spawned one
+    too (it is forked before it runs python again), starts with the peak memory of its parent, the processes of the
+    forkserver start from a small server process. spawn where forkserver is not available
+    """
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context(start_method))
+
+
+def run_benchmark(sizes, output_dir, seed=0, json_backend=None, mean_comments=20):
+    """
+    run the stages on a generated dataset of every size (number of submissions), the dataset is generated in a process
+    and built in another fresh one (see fresh_process)
+    :return: list of results of run_stages, with the size
+    """
+    results = []
+    for size in sizes:
+        with fresh_process() as executor:
+            files = executor.submit(generate_files, size, output_dir, seed, mean_comments).result()
+        with fresh_process() as executor:
+            result = executor.submit(run_stages, *files, json_backend=json_backend).result()
+        result["size"] = size
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def deep_size(value, seen) -> int:
+    """
+    bytes of a value and of the values it holds, the ones in seen (e.g. interned str, or the layout and constants dicts
+    shared by CompactData objects, when they were measured with an object before) are not counted again
+    :param seen: set of the ids of the values already measured, updated
+    """
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif isinstance(value, objects.CompactData):
+        for field in value.fields:
+            size += deep_size(object.__getattribute__(value, field), seen)
+        for attribute in ("_layout", "_values", "_constants", "_extra"):
+            size += deep_size(getattr(value, attribute), seen)
+    return size
+
+
+def measure_compact(submission_file, comment_file, compact, json_backend=None):
+    """
+    build the objects of the files (stream mode) in a new registry, with dict or CompactData _data
+    :param compact: CompactData _data
+    :return: dict with the seconds of the build, the memory kept by the objects (None where instrumentation.rss_mb is
+    not available), and the mean bytes of the _data of the submissions and comments built from a record (deep_size,
+    what the records share is counted once)
+    """
+    gc.collect()
+    begin_rss = rss_mb()
+    begin_time = time.perf_counter()
+    data = DataProcessorReddit(submission_file, comment_file, json_backend=json_backend, stream=True, compact=compact,
+                               registry=objects.Registry())
+    seconds = time.perf_counter() - begin_time
+    registry = data.registry
+    del data
+    gc.collect()
+    end_rss = rss_mb()
+    record_bytes = {}
+    for object_type in ["submission", "comment"]:
+        # placeholders (e.g. deleted parents) are not records
+        records = [obj._data for obj in registry[object_type].values() if "created_utc" in obj._data]
+        seen = set()
+        record_bytes[object_type] = sum(deep_size(record, seen) for record in records) / max(len(records), 1)
+    return {"seconds": seconds, "retained_mb": None if begin_rss is None or end_rss is None else end_rss - begin_rss,
+            "record_bytes": record_bytes}
+
+
+def compare_compact(sizes, output_dir, seed=0, json_backend=None, mean_comments=20):
+    """
+    build a generated dataset of every size (number of submissions) with dict and with CompactData _data, each in a
+    fresh process (see fresh_process)
+    :return: list of {"size", "dict": measure_compact result, "compact": measure_compact result}
+    """
+    results = []
+    for size in sizes:
+        with fresh_process() as executor:
+            files = executor.submit(generate_files, size, output_dir, seed, mean_comments).result()
+        result = {"size": size}
+        for name, compact in [("dict", False), ("compact", True)]:
+            with fresh_process() as executor:
+                result[name] = executor.submit(measure_compact, *files[:2], compact, json_backend).result()
+        results.append(result)
+        print_compact_result(result)
+    return results
+
+
+def print_compact_result(result):
+    print(f"{result['size']:>9,} submissions")
+    for name in ["dict", "compact"]:
+        measure = result[name]
+        retained = f"{measure['retained_mb']:9,.0f} MB" if measure["retained_mb"] is not None else ""
+        record_bytes = "   ".join(f"{object_type} {size:7,.0f} B"
+                                   for object_type, size in measure["record_bytes"].items())
+        print(f"    {name:8} {measure['seconds']:9.3f} s {retained}   {record_bytes}")
+    ratios = "   ".join(f"{object_type} {size / result['compact']['record_bytes'][object_type]:.1f}x"
+                       for object_type, size in result["dict"]["record_bytes"].items())
+    retained = ""
+    if result["dict"]["retained_mb"] and result["compact"]["retained_mb"]:
+        retained = f"   objects {result['dict']['retained_mb'] / result['compact']['retained_mb']:.1f}x"
+    print(f"    smaller  {ratios}{retained}   build "
+          f"{result['compact']['seconds'] / result['dict']['seconds']:.2f}x the time")
+
+
+def print_result(result):
+    print(f"{result['size']:>9,} submissions {result['records']:>11,} records   peak memory "
+          f"{result['peak_rss_mb'] or 0:,.0f} MB (from {result['baseline_rss_mb'] or 0:,.0f} MB)")
+    for stage in stages:
+        if stage in result["timings"]:
+            seconds = result["timings"][stage]
+            delta = result["memory"][stage]["rss_delta_mb"]
+            memory = f" {delta:+9,.0f} MB" if delta is not None else ""
+            print(f"    {stage:18} {seconds:9.3f} s {result['records'] / max(seconds, 1e-9):14,.0f} records/s{memory}")
+
+
+def check_scaling(results, max_ratio=3.0):
+    """
+    compare the time per record of every stage at the largest size with the smallest size
+    :param max_ratio: largest accepted ratio, a quadratic stage grows with the size
+    :return: list of (stage, ratio) above max_ratio
+    """
+    if len(results) < 2:
+        return []
+    smallest, largest = min(results, key=lambda x: x["records"]), max(results, key=lambda x: x["records"])
+    regressions = []
+    for stage in stages:
+        if stage not in smallest["timings"] or stage not in largest["timings"]:
+            continue
+        small = smallest["timings"][stage] / smallest["records"]
+        large = largest["timings"][stage] / largest["records"]
+        # too short to be measured
+        if smallest["timings"][stage] < 0.01:
+            continue
+        ratio = large / small
+        if ratio > max_ratio:
+            regressions.append((stage, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the build stages on synthetic Pushshift-shaped data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='numbers of submissions')
+    parser.add_argument('--mean_comments', type=int, default=20, help='mean number of comments per submission')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the generator')
+    parser.add_argument('--output_dir', type=str, default='benchmark_data', help='directory of the generated files')
+    parser.add_argument('--json_backend', type=str, default=None, help='json, orjson, msgspec or auto')
+    parser.add_argument('--json_file', type=str, default=None, help='write the results to this json file')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with an error if a stage does not scale linearly (see --max_ratio)')
+    parser.add_argument('--max_ratio', type=float, default=3.0,
+                        help='largest accepted ratio of the time per record between the largest and smallest size')
+    parser.add_argument('--compact', action='store_true',
+                        help='compare the objects built with dict and CompactData _data instead of timing the stages')
+    args = parser.parse_args()
+
+    if args.compact:
+        benchmark_results = compare_compact(args.sizes, args.output_dir, args.seed, args.json_backend,
+                                            args.mean_comments)
+    else:
+        benchmark_results = run_benchmark(args.sizes, args.output_dir, args.seed, args.json_backend,
+                                          args.mean_comments)
+    if args.json_file:
+        with open(args.json_file, "w") as f:
+            json.dump(benchmark_results, f, indent=2)
+    if not args.compact:
+        scaling_regressions = check_scaling(benchmark_results, args.max_ratio)
+        for regression_stage, regression_ratio in scaling_regressions:
+            print(f"{regression_stage} is {regression_ratio:.1f} times slower per record at the largest size")
+        if args.check and scaling_regressions:
+            raise SystemExit(1)
@@ -0,0 +1,261 @@
+"""
+columnar representation of submissions and comments with numpy arrays, for vectorized aggregate queries
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .load import parse_object_id
+
+comment_columns = ["id", "parent", "submission", "author", "subreddit", "created_utc", "score", "depth"]
+submission_columns = ["id", "author", "subreddit", "created_utc", "score"]
+
+
+def to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class ColumnarRecord:
+    """
+    Submissions and comments as numpy arrays (one array per column, one row per object).
+
+    submission: id, author, subreddit, created_utc, score
+    comment: id, parent, submission, author, subreddit, created_utc, score, depth
+
+    parent, submission, author and subreddit are row indexes (in comment, submission, redditor_ids and subreddit_ids),
+    -1 when there is none: parent is -1 for a top level comment. depth is 0 for a top level comment.
+    The replies of every comment, and the top level comments of every submission, are kept as CSR arrays:
+    the replies of comment i are children_indices[children_indptr[i]:children_indptr[i + 1]].
+    """
+
+    def __init__(self, submission, comment, redditor_ids, subreddit_ids):
+        """
+        use from_record or from_loaders
+        :param submission: dict of column -> array for the submissions (ids, the other columns are lists of ids)
+        :param comment: dict of column -> array for the comments
+        """
+        if np is None:
+            raise ImportError("numpy is required for the columnar representation")
+        self.redditor_ids = np.asarray(redditor_ids, dtype=np.int64)
+        self.subreddit_ids = np.asarray(subreddit_ids, dtype=np.int64)
+        self.submission = {column: np.asarray(submission[column], dtype=np.int64) for column in submission_columns}
+        self.comment = {column: np.asarray(comment[column], dtype=np.int64) for column in comment_columns
+                        if column != "depth"}
+        self.comment["depth"] = self.compute_depth(self.comment["parent"])
+        self.children_indptr, self.children_indices = self.build_csr(self.comment["parent"], len(self.comment["id"]))
+        top_level = np.where(self.comment["parent"] < 0, self.comment["submission"], -1)
+        self.submission_children_indptr, self.submission_children_indices = self.build_csr(
+            top_level, len(self.submission["id"]))
+        self._sorted = {}
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        build from the objects of a registry (objects.record or DataProcessorReddit.registry), after the repair of
+        generate_data_objects
+        """
+        submission_index = {submission_id: idx for idx, submission_id in enumerate(record["submission"])}
+        comment_index = {comment_id: idx for idx, comment_id in enumerate(record["comment"])}
+        redditor_index = {}
+        subreddit_index = {}
+
+        def index_of(obj, index):
+            if obj is None:
+                return -1
+            if obj._data["id"] not in index:
+                index[obj._data["id"]] = len(index)
+            return index[obj._data["id"]]
+
+        submission = {column: [] for column in submission_columns}
+        for submission_id, obj in record["submission"].items():
+            submission["id"].append(submission_id)
+            submission["author"].append(index_of(getattr(obj, "_author", None), redditor_index))
+            submission["subreddit"].append(index_of(getattr(obj, "_subreddit", None), subreddit_index))
+            submission["created_utc"].append(to_int(obj._data.get("created_utc")))
+            submission["score"].append(to_int(obj._data.get("score")))
+
+        comment = {column: [] for column in comment_columns}
+        for comment_id, obj in record["comment"].items():
+            parent = getattr(obj, "_parent", None)
+            linked_submission = getattr(obj, "_submission", None)
+            comment["id"].append(comment_id)
+            comment["parent"].append(comment_index.get(parent._data["id"], -1)
+                                     if parent is not None and parent.object_type == "comment" else -1)
+            comment["submission"].append(submission_index.get(linked_submission._data["id"], -1)
+                                         if linked_submission is not None else -1)
+            comment["author"].append(index_of(getattr(obj, "_author", None), redditor_index))
+            comment["subreddit"].append(index_of(getattr(obj, "_subreddit", None), subreddit_index))
+            comment["created_utc"].append(to_int(obj._data.get("created_utc")))
+            comment["score"].append(to_int(obj._data.get("score")))
+        return cls(submission, comment, list(redditor_index), list(subreddit_index))
+
+    @classmethod
+    def from_loaders(cls, submissions, comments):
+        """
+        build directly from the raw records of LoadSubmissions and LoadComments (any mode which can be iterated),
+        without building the objects. The comments whose parent is not in the file are top level comments.
+        """
+        redditor_index = {}
+        subreddit_index = {}
+
+        def index_of(object_id, index):
+            try:
+                object_id = parse_object_id(object_id)
+            except ValueError:
+                return -1
+            if object_id not in index:
+                index[object_id] = len(index)
+            return index[object_id]
+
+        submission = {column: [] for column in submission_columns}
+        submission_index = {}
+        for item in submissions:
+            submission_id = parse_object_id(item["id"])
+            submission_index[submission_id] = len(submission["id"])
+            submission["id"].append(submission_id)
+            submission["author"].append(index_of(item.get("author_fullname"), redditor_index))
+            submission["subreddit"].append(index_of(item.get("subreddit_id"), subreddit_index))
+            submission["created_utc"].append(to_int(item.get("created_utc")))
+            submission["score"].append(to_int(item.get("score")))
+
+        comment = {column: [] for column in comment_columns}
+        parent_ids = []
+        for item in comments:
+            comment["id"].append(parse_object_id(item["id"]))
+            try:
+                link_id = parse_object_id(item.get("link_id"))
+            except ValueError:
+                link_id = None
+            parent_id = item.get("parent_id")
+            try:
+                parent_ids.append(parse_object_id(parent_id) if parent_id and not str(parent_id).startswith("t3_")
+                                  else None)
+            except ValueError:
+                parent_ids.append(None)
+            comment["submission"].append(submission_index.get(link_id, -1))
+            comment["author"].append(index_of(item.get("author_fullname"), redditor_index))
+            comment["subreddit"].append(index_of(item.get("subreddit_id"), subreddit_index))
+            comment["created_utc"].append(to_int(item.get("created_utc")))
+            comment["score"].append(to_int(item.get("score")))
+        comment_index = {comment_id: idx for idx, comment_id in enumerate(comment["id"])}
+        comment["parent"] = [comment_index.get(parent_id, -1) for parent_id in parent_ids]
+        return cls(submission, comment, list(redditor_index), list(subreddit_index))
+
+    @staticmethod
+    def compute_depth(parent):
+        """
+        depth of every comment by pointer jumping, in about log2(max depth) vectorized steps
+        """
+        ancestor = parent.copy()
+        depth = (parent >= 0).astype(np.int64)
+        for _ in range(64):
+            active = np.nonzero(ancestor >= 0)[0]
+            if len(active) == 0:
+                break
+            next_ancestor = ancestor[active]
+            depth[active] += depth[next_ancestor]
+            ancestor[active] = ancestor[next_ancestor]
+        return depth
+
+    @staticmethod
+    def build_csr(parent, size):
+        """
+        CSR arrays (indptr, indices) of the rows grouped by parent, the rows with parent -1 are left out
+        """
+        rows = np.nonzero(parent >= 0)[0]
+        order = np.argsort(parent[rows], kind="stable")
+        indices = rows[order]
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parent[rows], minlength=size), out=indptr[1:])
+        return indptr, indices
+
+    def __len__(self):
+        return len(self.submission["id"]) + len(self.comment["id"])
+
+    def columns(self, object_type):
+        if object_type not in ("submission", "comment"):
+            raise ValueError(f"Unknown object type {object_type}")
+        return self.submission if object_type == "submission" else self.comment
+
+    def index(self, object_type, object_ids):
+        """
+        row indexes of int ids (an array or a list), -1 for the ids which are not there
+        """
+        if object_type in ("submission", "comment"):
+            ids = self.columns(object_type)["id"]
+        else:
+            ids = self.redditor_ids if object_type == "redditor" else self.subreddit_ids
+        object_ids = np.asarray(object_ids, dtype=np.int64)
+        if len(ids) == 0:
+            return np.full(len(object_ids), -1, dtype=np.int64)
+        if object_type not in self._sorted:
+            self._sorted[object_type] = np.argsort(ids, kind="stable")
+        order = self._sorted[object_type]
+        rows = order[np.minimum(np.searchsorted(ids[order], object_ids), len(ids) - 1)]
+        return np.where(ids[rows] == object_ids, rows, -1)
+
+    def children(self, row):
+        """
+        row indexes of the replies of the comment at row
+        """
+        return self.children_indices[self.children_indptr[row]:self.children_indptr[row + 1]]
+
+    def top_level_comments(self, row):
+        """
+        row indexes of the top level comments of the submission at row
+        """
+        return self.submission_children_indices[
+               self.submission_children_indptr[row]:self.submission_children_indptr[row + 1]]
+
+    def time_mask(self, object_type="comment", start=None, end=None):
+        """
+        boolean mask of the rows with start <= created_utc <= end
+        """
+        created_utc = self.columns(object_type)["created_utc"]
+        mask = np.ones(len(created_utc), dtype=bool)
+        if start is not None:
+            mask &= created_utc >= start
+        if end is not None:
+            mask &= created_utc <= end
+        return mask
+
+    def aggregate(self, object_type="comment", by="subreddit", values=None, mask=None):
+        """
+        sum of values grouped by a row index column (author, subreddit, submission or parent)
+        :param values: name of a column or an array, None to count the rows
+        :param mask: optional boolean mask of the rows to use
+        :return: array with one entry per group (per redditor, per subreddit...)
+        """
+        columns = self.columns(object_type)
+        groups = columns[by]
+        size = {"author": len(self.redditor_ids), "subreddit": len(self.subreddit_ids),
+                "submission": len(self.submission["id"]), "parent": len(self.comment["id"])}[by]
+        if isinstance(values, str):
+            values = columns[values]
+        keep = groups >= 0
+        if mask is not None:
+            keep &= mask
+        weights = None if values is None else np.asarray(values)[keep]
+        return np.bincount(groups[keep], weights=weights, minlength=size)
+
+    def subtree_sizes(self):
+        """
+        number of descendants of every comment, one vectorized step per depth level
+        """
+        parent = self.comment["parent"]
+        depth = self.comment["depth"]
+        sizes = np.ones(len(parent), dtype=np.int64)
+        for level in range(int(depth.max(initial=0)), 0, -1):
+            rows = np.nonzero(depth == level)[0]
+            np.add.at(sizes, parent[rows], sizes[rows])
+        return sizes - 1
+
+    def thread_sizes(self):
+        """
+        number of comments of every submission
+        """
+        return self.aggregate("comment", by="submission")
@@ -2,10 +2,21 @@
 data processing for reddit
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
 from tqdm import tqdm
 
-from .load import LoadSubmissions, LoadComments
+from .load import LoadSubmissions, LoadComments, RecordFilter, parse_object_id
 from . import objects
+from .columnar import ColumnarRecord
+from .graph_export import EdgeList, export_graph
+from .indexes import SecondaryIndexes
+from .store import SQLiteStore
+from .sqlite_export import export_sqlite
+from .instrumentation import BuildReport
 from typing import List, Dict, Any, Optional
 
 
@@ -25,29 +36,189 @@ def access_attribute(obj: object, attributes: List[str]) -> Optional[Any]:
     return obj
 
 
-def load_data_from_file(submission_file: str, comment_file: str) -> (LoadSubmissions, LoadComments):
+def load_data_from_file(submission_file: str, comment_file: str, json_backend=None, stream: bool = False,
+                        lazy: bool = False, record_filter: RecordFilter = None) -> (LoadSubmissions, LoadComments):
     """
     load data from file
+    :param record_filter: load.RecordFilter of the records to keep (default: all of them), the comments of the
+    submissions left out are left out too
     """
-    submissions = LoadSubmissions(submission_file)
-    comments = LoadComments(comment_file)
+    submissions = LoadSubmissions(submission_file, json_backend, stream, lazy, record_filter)
+    if record_filter is not None:
+        record_filter = record_filter.for_threads(submission_ids(submissions))
+    comments = LoadComments(comment_file, json_backend, stream, lazy, record_filter)
     return submissions, comments
 
 
-def generate_data_objects(submissions: LoadSubmissions, comments: LoadComments) -> Dict[str, objects.RedditObjectBase]:
+def submission_ids(submissions: LoadSubmissions) -> set:
+    """
+    int ids of the submissions of a loader (read from the file again in stream mode)
+    """
+    if submissions.lazy:
+        return set(submissions.offsets)
+    return {parse_object_id(item["id"]) for item in submissions}
+
+
+def generate_data_objects(submissions: LoadSubmissions, comments: LoadComments,
+                          registry: objects.Registry = None, report: BuildReport = None) -> objects.Registry:
     """
     generate data objects
+    :param registry: registry to build the objects in (default: objects.record)
+    :param report: BuildReport to fill with the time of every stage and the objects created (default: none)
+    """
+    registry = objects.record if registry is None else registry
+    report = BuildReport() if report is None else report
+    report.begin(registry)
+    with report.stage("convert_submissions"):
+        submissions.convert_to_object(partial(objects.create_submission, registry=registry), use_tqdm=True)
+    with report.stage("convert_comments"):
+        comments.convert_to_object(partial(objects.create_comment, registry=registry), use_tqdm=True)
+    repair_data_objects(registry, report=report)
+    report.finish(registry)
+    return registry
+
+
+def repair_data_objects(registry: objects.Registry, use_tqdm: bool = True,
+                        report: BuildReport = None) -> objects.Registry:
+    """
+    repair the objects after all the submissions and comments are built: the parents of the comments, then the
+    comment trees
+    :param report: BuildReport to add the update_parent and update_comment_trees stages to (default: none)
+    """
+    report = BuildReport() if report is None else report
+    comments = registry["comment"].values()
+    comment_trees = registry["comment_tree"].values()
+    if use_tqdm:
+        comments = tqdm(comments, desc="repairing comment", total=len(registry["comment"]))
+        comment_trees = tqdm(comment_trees, desc="repairing comment tree", total=len(registry["comment_tree"]))
+    with report.stage("update_parent"):
+        for comment in comments:
+            comment.update_parent()
+    with report.stage("update_comment_trees"):
+        objects.update_comment_trees(comment_trees, registry)
+    return registry
+
+
+def last_objects(objects_of_type: dict, count: int) -> list:
+    """
+    the last count objects added to a dict of objects of a registry, in order, without going through the others
+    """
+    return list(islice(reversed(objects_of_type.values()), count))[::-1]
+
+
+def append_data_objects(submissions: LoadSubmissions, comments: LoadComments,
+                        registry: objects.Registry = None, report: BuildReport = None) -> Dict[str, int]:
+    """
+    add the submissions and comments of new files to the objects already built in registry, and repair only what they
+    change: the parents of the new comments, the comments_total_id of their parent comments up to the submission, and
+    the comment trees of the new objects. The redditors and subreddits are updated when the new objects are built.
+    The cost depends on the new data (and the depth of the threads it replies to), not on the objects already there.
+    The new ids are appended to the comments_total_id of the old comments, in a different order than a full build.
+    :param registry: registry of the objects built (default: objects.record)
+    :param report: BuildReport to fill with the time of every stage and the objects created (default: none)
+    :return: number of new objects of every type
+    """
+    registry = objects.record if registry is None else registry
+    report = BuildReport() if report is None else report
+    report.begin(registry)
+    counts = {object_type: len(objects_of_type) for object_type, objects_of_type in registry.items()}
+    with report.stage("convert_submissions"):
+        submissions.convert_to_object(partial(objects.create_submission, registry=registry), use_tqdm=True)
+    with report.stage("convert_comments"):
+        comments.convert_to_object(partial(objects.create_comment, registry=registry), use_tqdm=True)
+    new_counts = {object_type: len(objects_of_type) - counts.get(object_type, 0)
+                  for object_type, objects_of_type in registry.items()}
+
+    new_comments = last_objects(registry["comment"], new_counts["comment"])
+    with report.stage("update_parent"):
+        for comment in new_comments:
+            comment.update_parent()
+    with report.stage("update_ancestors"):
+        append_to_ancestors(new_comments)
+    with report.stage("update_comment_trees"):
+        objects.update_comment_trees(last_objects(registry["comment_tree"], new_counts["comment_tree"]), registry)
+    report.finish(registry)
+    return new_counts
+
+
+def append_to_ancestors(new_comments: list):
+    """
+    add the ids of new comments to the comments_total_id of their parent comments up to the submission
+    """
+    for comment in new_comments:
+        # the parent already has the comment (when it is built), its parent comments get it here
+        parent = getattr(comment, "_parent", None)
+        ancestor = getattr(parent, "_parent", None) if parent is not None and parent.object_type == "comment" else None
+        visited = set()
+        while ancestor is not None and ancestor.object_type == "comment" and id(ancestor) not in visited:
+            visited.add(id(ancestor))
+            # as in a full build, only the comments with a tree (not the placeholders) get all their descendants
+            if getattr(ancestor, "_comment_tree", None) is not None:
+                ancestor._data["comments_total_id"].append(comment._data["id"])
+            ancestor = getattr(ancestor, "_parent", None)
+
+
+def shard_of(object_id, num_shards: int) -> int:
+    """
+    shard of a submission id (the link_id of a comment), 0 if the id cannot be parsed
+    """
+    try:
+        return parse_object_id(object_id) % num_shards
+    except (TypeError, ValueError):
+        return 0
+
+
+def build_shard(submission_items: List[dict], comment_items: List[dict], compact: bool = False) -> objects.Registry:
+    """
+    build and repair the objects of a shard (whole threads) in a new registry, run in a worker process
+    """
+    registry = objects.Registry(compact=compact)
+    for item in submission_items:
+        objects.create_submission(item, registry)
+    for item in comment_items:
+        objects.create_comment(item, registry)
+    return repair_data_objects(registry, use_tqdm=False)
+
+
+def generate_data_objects_parallel(submissions: LoadSubmissions, comments: LoadComments,
+                                   registry: objects.Registry = None, workers: int = None,
+                                   num_shards: int = None, report: BuildReport = None) -> objects.Registry:
     """
-    submissions.convert_to_object(objects.create_submission, use_tqdm=True)
-    comments.convert_to_object(objects.create_comment, use_tqdm=True)
+    generate data objects in a process pool: the submissions and the comments are split in shards by submission id
+    (link_id for the comments) so every thread is built and repaired in one worker, then the registries of the shards
+    are merged in order into registry. The redditors and subreddits which are in several shards are joined by the merge
+    (comments_id, submissions_id and no_follow in shard order, activity sorted by time).
+    The objects are not kept in submissions.objects and comments.objects as by generate_data_objects.
+    :param registry: registry to build the objects in (default: objects.record)
+    :param workers: number of processes (default: number of cpus)
+    :param num_shards: number of shards (default: 4 per worker, for balance between small and large threads)
+    :param report: BuildReport to fill with the time of the sharding and of the build of the shards (with their merge)
+    and the objects created (default: none)
+    """
+    registry = objects.record if registry is None else registry
+    report = BuildReport() if report is None else report
+    report.begin(registry)
+    workers = workers or os.cpu_count()
+    num_shards = num_shards or workers * 4
+    shard_submissions = [[] for _ in range(num_shards)]
+    shard_comments = [[] for _ in range(num_shards)]
+    with report.stage("shard"):
+        for item in tqdm(submissions, desc="sharding submissions"):
+            shard_submissions[shard_of(item.get("id"), num_shards)].append(item)
+        for item in tqdm(comments, desc="sharding comments"):
+            shard_comments[shard_of(item.get("link_id"), num_shards)].append(item)
 
-    for comment in tqdm(objects.record["comment"].values(), desc="repairing comment",
-                        total=len(objects.record["comment"])):
-        comment.update_parent()
-    for comment_tree in tqdm(objects.record["comment_tree"].values(), desc="repairing comment tree",
-                             total=len(objects.record["comment_tree"])):
-        comment_tree.update_attr()
-    return objects.record
+    with report.stage("build_shards"), ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_shard, shard_submissions[shard], shard_comments[shard],
+                                   registry.compact or objects.compact_data)
+                   for shard in range(num_shards) if shard_submissions[shard] or shard_comments[shard]]
+        del shard_submissions, shard_comments
+        # merged in shard order, so the result does not depend on which worker finishes first
+        for future in tqdm(futures, desc="merging shards"):
+            # the shards are whole threads, their id lists are disjoint
+            registry.merge(future.result(), disjoint=True)
+    report.finish(registry)
+    return registry
 
 
 class DataProcessor:
@@ -93,12 +264,45 @@ class DataProcessorReddit(DataProcessor):
     data processor for reddit
     """
 
-    def __init__(self, submission_file: str = None, comment_file: str = None, return_type: str = "submission"):
+    def __init__(self, submission_file: str = None, comment_file: str = None, return_type: str = "submission",
+                 json_backend=None, stream: bool = False, lazy: bool = False, compact: bool = False,
+                 registry: objects.Registry = None, workers: int = None, snapshot: str = None,
+                 report: BuildReport = None, record_filter: RecordFilter = None, store=None):
         """
         :param submission_file: submission file path
         :param comment_file: comment file path
         :param return_type: return type (submission, comment, comment_tree, redditor, subreddit) (default: submission)
         for __getitem__
+        :param json_backend: json backend or its name (json, orjson, msgspec, auto) (default: REDDIT_JSON_BACKEND or
+        auto)
+        :param stream: read the files record by record while building the objects instead of loading them first, so the
+        raw records are not kept in memory (self.submissions and self.comments can only be iterated again)
+        :param lazy: only index the offsets of the records (jsonl files only), and build the objects of a thread (the
+        submission and all its comments, with their comment trees, authors and subreddits) when one of them is first
+        accessed by __getitem__ or materialize_thread. The objects are kept in the registry after they are built. A
+        redditor or subreddit got by __getitem__ or materialize has all its threads built, the ones only reached
+        through a thread know about the threads built so far.
+        :param compact: keep the data of the objects in objects.CompactData (core fields in __slots__, shared constant
+        values, interned short strings) instead of dicts: the data of a Pushshift comment is about 3 times smaller,
+        all the objects about 1.7 times (see benchmark.py --compact), but the build takes about 1.6 times as long.
+        get_dict() then returns a mapping, use dict(obj.get_dict()) or get_dict().to_dict() for a real dict. It only
+        applies to the registry of the processor (Registry(compact=True)), a new one when none is given
+        :param registry: objects.Registry to build the objects in (default: objects.record, shared by the processors
+        which are not given one). Give each processor its own registry to build several datasets side by side, and
+        registry.clear() to release one
+        :param workers: build the objects in this many processes, sharded by submission (see
+        generate_data_objects_parallel), instead of in this process (not in lazy mode)
+        :param snapshot: load the objects from a snapshot of save_snapshot instead of building them from the files (the
+        files are not needed then)
+        :param report: BuildReport filled by the build (time and peak memory of every stage, objects created, stubs),
+        with its hooks called (default: a new one), in self.report. report.to_json(path) writes it
+        :param record_filter: load.RecordFilter of the records to build (time window, subreddits, authors, score,
+        predicate), applied while the files are read so the other records never become objects or placeholders. Also
+        used by append
+        :param store: keep the data of the objects on disk, in a store.SQLiteStore or an SQLite file path (a store with
+        the default cache size), for the datasets larger than memory. The objects keep their links and id lists in
+        memory, the other fields are read from the store when they are used. The files are read in stream mode (the raw
+        records are not kept) unless lazy. The store is attached to the registry given, or to a new one
         """
         self.submissions = None
         self.comments = None
@@ -108,21 +312,62 @@ class DataProcessorReddit(DataProcessor):
         self.redditor_objects = None
         self.subreddit_objects = None
         self.return_type = return_type
+        self.json_backend = json_backend
+        self.stream = stream or (store is not None and not lazy)
+        self.lazy = lazy
+        self.compact = compact
+        if registry is None:
+            # a compact or store build gets its own registry, objects.record keeps dicts in memory
+            registry = objects.Registry(compact=compact) if compact or store is not None else objects.record
+        elif compact:
+            registry.compact = True
+        self.registry = registry
+        if store is not None:
+            self.registry.use_store(SQLiteStore(store) if isinstance(store, str) else store)
+        self.workers = workers
+        self.snapshot = snapshot
+        self.report = BuildReport() if report is None else report
+        self.record_filter = record_filter
+        # secondary indexes of the objects, built by the first query
+        self.indexes = None
+        # submission ids of the threads built in lazy mode
+        self.materialized_threads = set()
         super().__init__(submission_file=submission_file, comment_file=comment_file)
 
     def load_data_from_file(self, **kwargs) -> (LoadSubmissions, LoadComments):
         """
         load data from file
         """
+        # the build begins with the load, the builders (generate_data_objects...) keep this start
+        self.report.begin(self.registry)
+        if self.snapshot:
+            return {"submissions": None, "comments": None}
 
-        self.submissions, self.comments = load_data_from_file(kwargs["submission_file"], kwargs["comment_file"])
+        with self.report.stage("load_files"):
+            self.submissions, self.comments = load_data_from_file(kwargs["submission_file"], kwargs["comment_file"],
+                                                                  self.json_backend, self.stream, self.lazy,
+                                                                  self.record_filter)
         return {"submissions": self.submissions, "comments": self.comments}
 
-    def generate_data_objects(self) -> Dict[str, objects.RedditObjectBase]:
+    def generate_data_objects(self) -> objects.Registry:
         """
         generate data objects
         """
-        record = generate_data_objects(self.submissions, self.comments)
+        if self.snapshot:
+            self.report.begin(self.registry)
+            with self.report.stage("load_snapshot"):
+                record = self.registry.merge(objects.Registry.load_snapshot(self.snapshot))
+            self.report.finish(record)
+        elif self.lazy:
+            self.registry.loaders["submission"] = self.submissions.get_record
+            self.registry.loaders["comment"] = self.comments.get_record
+            record = self.registry
+            self.report.finish(record)
+        elif self.workers and self.workers > 1:
+            record = generate_data_objects_parallel(self.submissions, self.comments, self.registry, self.workers,
+                                                    report=self.report)
+        else:
+            record = generate_data_objects(self.submissions, self.comments, self.registry, self.report)
         self.submission_objects = record["submission"]
         self.comment_objects = record["comment"]
         self.comment_tree_objects = record["comment_tree"]
@@ -136,11 +381,162 @@ class DataProcessorReddit(DataProcessor):
         """
         return self.objects
 
+    def append(self, submission_file: str, comment_file: str, report: BuildReport = None) -> Dict[str, int]:
+        """
+        add the submissions and comments of new files (e.g. the next month) to the objects already built or loaded from
+        a snapshot, see append_data_objects. Not in lazy mode
+        :param report: BuildReport to fill with the stages of the append (default: none)
+        :return: number of new objects of every type
+        """
+        if self.lazy:
+            raise ValueError("append is not supported in lazy mode")
+        submissions, comments = load_data_from_file(submission_file, comment_file, self.json_backend, self.stream,
+                                                    record_filter=self.record_filter)
+        self.indexes = None
+        return append_data_objects(submissions, comments, self.registry, report)
+
+    def save_snapshot(self, path: str):
+        """
+        save the objects built to a binary snapshot (.zst for a compressed one), to start from it with
+        DataProcessorReddit(snapshot=path) instead of parsing and building again
+        """
+        self.registry.save_snapshot(path)
+
+    def to_columnar(self) -> ColumnarRecord:
+        """
+        columnar (numpy) representation of the submissions and comments built, for vectorized aggregate queries
+        """
+        return ColumnarRecord.from_record(self.objects)
+
+    def export_graph(self, kind: str = "reply", **kwargs) -> EdgeList:
+        """
+        edges (numpy arrays, to COO/CSR, scipy or networkx) of the reply graph of the comments, the user to user reply
+        graph or the user to subreddit graph of the objects built, see graph_export.export_graph
+        :param kind: reply, user_reply or user_subreddit
+        """
+        return export_graph(self.to_columnar(), kind, **kwargs)
+
+    def export_sqlite(self, path: str, batch_size: int = 10000) -> Dict[str, int]:
+        """
+        write the objects built to an SQLite database (submissions, comments, redditors, subreddits and the edges of the
+        comment trees, indexed on the ids, link_id, parent_id, author_id and created_utc) for SQL queries, see
+        sqlite_export.export_sqlite. sqlite_export.read_threads builds the objects of some threads from it again
+        :return: number of rows of every table
+        """
+        return export_sqlite(path, self.registry, batch_size, self.json_backend)
+
+    def build_indexes(self) -> SecondaryIndexes:
+        """
+        build the secondary indexes (sorted by time per subreddit, per author and for all the objects) of the
+        submissions and comments built, see indexes.SecondaryIndexes. Built again by the next query after append
+        """
+        self.indexes = SecondaryIndexes(self.registry)
+        return self.indexes
+
+    def query(self, object_type: str = "comment", subreddit=None, author=None, start=None,
+              end=None) -> List[objects.RedditObjectBase]:
+        """
+        the submissions or comments (of a subreddit, of an author) with start <= created_utc <= end, in time order,
+        found by bisection in the secondary indexes
+        :param subreddit: subreddit name, fullname (t5_xxx) or int id
+        :param author: redditor name, fullname (t2_xxx) or int id
+        """
+        if self.indexes is None:
+            self.build_indexes()
+        objects_of_type = self.registry[object_type]
+        return [objects_of_type[object_id]
+                for object_id in self.indexes.query(object_type, subreddit, author, start, end)]
+
+    def top(self, object_type: str = "comment", k: int = 10, subreddit=None, author=None, start=None,
+            end=None) -> List[objects.RedditObjectBase]:
+        """
+        the k submissions or comments (of a subreddit, of an author, with start <= created_utc <= end) with the best
+        scores, best first, see query
+        """
+        if self.indexes is None:
+            self.build_indexes()
+        objects_of_type = self.registry[object_type]
+        return [objects_of_type[object_id]
+                for object_id in self.indexes.top(object_type, k, subreddit, author, start, end)]
+
+    def materialize_thread(self, submission_id) -> Optional[objects.Submission]:
+        """
+        build the objects of a thread in lazy mode: the submission, all its comments and their comment trees, then
+        repair them as generate_data_objects does
+        :param submission_id: int id, base 36 id or fullname of the submission
+        :return: the submission object (None if neither the submission nor its comments are in the files)
+        """
+        submission_id = objects.CreateObject.process_id(submission_id, "submission")
+        if submission_id in self.materialized_threads:
+            return self.registry["submission"].get(submission_id)
+        comment_ids = self.comments.submission_comments.get(submission_id, [])
+        if submission_id not in self.submissions.offsets and not comment_ids:
+            return None
+        self.materialized_threads.add(submission_id)
+        self.indexes = None
+        if submission_id in self.submissions.offsets:
+            objects.create_submission({"id": submission_id}, self.registry)
+        for comment_id in comment_ids:
+            # the comments are in file (time) order, so the parents are usually built before their replies
+            objects.create_comment({"id": comment_id}, self.registry)
+
+        comment_record = self.registry["comment"]
+        tree_ids = [submission_id]
+        for comment_id in comment_ids:
+            comment = comment_record[comment_id]
+            comment.update_parent()
+            tree_ids.append(comment_id)
+            # the placeholders of the parents which are not in the file have their trees as well
+            if self.comments.comments_parent_ids[comment_id] is not None:
+                tree_ids.append(self.comments.comments_parent_ids[comment_id])
+        comment_tree_record = self.registry["comment_tree"]
+        objects.update_comment_trees([comment_tree_record[tree_id] for tree_id in dict.fromkeys(tree_ids)
+                                      if tree_id in comment_tree_record], self.registry)
+        return self.registry["submission"].get(submission_id)
+
+    def materialize(self, object_type: str, object_id) -> objects.RedditObjectBase:
+        """
+        get an object in lazy mode, build its thread first if needed. A redditor or a subreddit gets all the threads it
+        posts in built (found in the offset index), so its id lists are complete
+        :param object_type: submission, comment, comment_tree, redditor or subreddit
+        :param object_id: int id, base 36 id or fullname
+        :raise KeyError: for an object which is neither in the files nor built, e.g. a comment which is not in the
+        comment file (unless a thread built has it as a placeholder parent)
+        """
+        if object_type == "comment_tree":
+            object_id = objects.CreateObject.process_id(object_id, "comment")
+        else:
+            object_id = objects.CreateObject.process_id(object_id, object_type)
+        if object_type == "submission":
+            self.materialize_thread(object_id)
+        elif object_type in ("comment", "comment_tree"):
+            if object_id in self.comments.comments_link_ids:
+                self.materialize_thread(self.comments.comments_link_ids[object_id])
+            elif object_type == "comment_tree":
+                # the comment tree of a submission has the id of the submission
+                self.materialize_thread(object_id)
+        elif object_type in ("redditor", "subreddit"):
+            threads_of_type = "author_threads" if object_type == "redditor" else "subreddit_threads"
+            thread_ids = getattr(self.submissions, threads_of_type).get(object_id, []) + \
+                getattr(self.comments, threads_of_type).get(object_id, [])
+            for thread_id in dict.fromkeys(thread_ids):
+                self.materialize_thread(thread_id)
+        objects_of_type = self.registry[object_type]
+        if object_id not in objects_of_type:
+            raise KeyError(f"{object_type} {object_id} is not in the files")
+        return objects_of_type[object_id]
+
     def __getitem__(self, item):
+        if self.lazy:
+            return self.materialize(self.return_type, item)
         return self.generator[self.return_type][item]
 
     def __len__(self):
+        if self.lazy and self.return_type in ("submission", "comment"):
+            return len(self.submissions if self.return_type == "submission" else self.comments)
         return len(self.generator[self.return_type])
 
     def __iter__(self):
+        if self.lazy and self.return_type in ("submission", "comment"):
+            return iter((self.submissions if self.return_type == "submission" else self.comments).offsets)
         return iter(self.generator[self.return_type])
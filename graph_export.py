@@ -0,0 +1,170 @@
+"""
+graphs of a columnar record (columnar.ColumnarRecord) as edge arrays and sparse adjacency matrices: the reply graph of
+the comments, the user to user reply graph and the user to subreddit graph, built with vectorized numpy operations
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+graph_kinds = ["reply", "user_reply", "user_subreddit"]
+
+
+class EdgeList:
+    """
+    Edges of a graph as numpy arrays: source, target (node indexes), timestamp (created_utc of the comment or
+    submission which makes the edge) and weight.
+
+    The source nodes are source_ids[i] (int ids of source_type objects) and the target nodes target_ids[j]. After
+    aggregate, there is one edge per (source, target) pair, weight is the number of edges joined and timestamp the
+    first one.
+    """
+
+    def __init__(self, source, target, timestamp, weight, source_ids, target_ids, source_type, target_type):
+        self.source = np.asarray(source, dtype=np.int64)
+        self.target = np.asarray(target, dtype=np.int64)
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.weight = np.asarray(weight, dtype=np.float64)
+        self.source_ids = np.asarray(source_ids, dtype=np.int64)
+        self.target_ids = np.asarray(target_ids, dtype=np.int64)
+        self.source_type = source_type
+        self.target_type = target_type
+
+    def __len__(self):
+        return len(self.source)
+
+    @property
+    def shape(self) -> (int, int):
+        return len(self.source_ids), len(self.target_ids)
+
+    def aggregate(self) -> "EdgeList":
+        """
+        one edge per (source, target) pair, with the sum of the weights and the first timestamp
+        """
+        keys = self.source * max(len(self.target_ids), 1) + self.target
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        weight = np.bincount(inverse, weights=self.weight, minlength=len(unique_keys))
+        timestamp = np.full(len(unique_keys), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(timestamp, inverse, self.timestamp)
+        source, target = np.divmod(unique_keys, max(len(self.target_ids), 1))
+        return EdgeList(source, target, timestamp, weight, self.source_ids, self.target_ids, self.source_type,
+                        self.target_type)
+
+    def to_coo(self, values: str = "weight") -> tuple:
+        """
+        COO arrays (row, col, data, shape) of the adjacency matrix, the edges of a pair are added (see aggregate)
+        :param values: weight or timestamp for data
+        """
+        return self.source, self.target, getattr(self, values), self.shape
+
+    def to_csr(self, values: str = "weight") -> tuple:
+        """
+        CSR arrays (indptr, indices, data, shape) of the adjacency matrix, the edges of a source sorted by target
+        """
+        order = np.lexsort((self.target, self.source))
+        indptr = np.zeros(len(self.source_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.source, minlength=len(self.source_ids)), out=indptr[1:])
+        return indptr, self.target[order], getattr(self, values)[order], self.shape
+
+    def to_scipy(self, values: str = "weight", sparse_format: str = "csr"):
+        """
+        scipy.sparse matrix of the adjacency matrix (scipy is needed), the edges of a pair are added
+        """
+        try:
+            from scipy import sparse
+        except ImportError:
+            raise ImportError("scipy is required for to_scipy, use to_coo or to_csr for the arrays")
+        matrix = sparse.coo_matrix((getattr(self, values), (self.source, self.target)), shape=self.shape)
+        return matrix.asformat(sparse_format)
+
+    def to_networkx(self, directed: bool = True):
+        """
+        networkx graph (networkx is needed), the nodes are (object type, int id), the edges have timestamp and weight
+        (use aggregate first, a graph keeps one edge per pair)
+        """
+        try:
+            import networkx as nx
+        except ImportError:
+            raise ImportError("networkx is required for to_networkx, use to_coo or to_csr for the arrays")
+        graph = nx.DiGraph() if directed else nx.Graph()
+        sources = zip([self.source_type] * len(self), self.source_ids[self.source].tolist())
+        targets = zip([self.target_type] * len(self), self.target_ids[self.target].tolist())
+        graph.add_edges_from((source, target, {"timestamp": timestamp, "weight": weight})
+                             for source, target, timestamp, weight in
+                             zip(sources, targets, self.timestamp.tolist(), self.weight.tolist()))
+        return graph
+
+
+def reply_edges(columns, include_submissions: bool = True) -> EdgeList:
+    """
+    comment -> parent edges. The nodes are the comments, then the submissions (node len(comment ids) + submission row)
+    when include_submissions, for the edges of the top level comments
+    :param columns: columnar.ColumnarRecord
+    """
+    comment = columns.comment
+    num_comments = len(comment["id"])
+    target = comment["parent"].copy()
+    if include_submissions:
+        top_level = (target < 0) & (comment["submission"] >= 0)
+        target[top_level] = num_comments + comment["submission"][top_level]
+        node_ids = np.concatenate([comment["id"], columns.submission["id"]])
+    else:
+        node_ids = comment["id"]
+    keep = target >= 0
+    source = np.nonzero(keep)[0]
+    return EdgeList(source, target[keep], comment["created_utc"][keep], np.ones(len(source)), node_ids, node_ids,
+                    "comment", "comment")
+
+
+def user_reply_edges(columns, include_submissions: bool = True, aggregate: bool = False) -> EdgeList:
+    """
+    author -> author edges of the replies: the author of a comment to the author of its parent comment (or of the
+    submission for a top level comment, when include_submissions). The edges with an unknown author are left out
+    :param aggregate: one edge per pair of authors, weight being the number of replies
+    """
+    comment = columns.comment
+    parent = comment["parent"]
+    target = np.where(parent >= 0, comment["author"][np.maximum(parent, 0)], -1)
+    if include_submissions:
+        submission = comment["submission"]
+        top_level = (parent < 0) & (submission >= 0)
+        target[top_level] = columns.submission["author"][submission[top_level]]
+    source = comment["author"]
+    keep = (source >= 0) & (target >= 0)
+    edges = EdgeList(source[keep], target[keep], comment["created_utc"][keep], np.ones(int(keep.sum())),
+                     columns.redditor_ids, columns.redditor_ids, "redditor", "redditor")
+    return edges.aggregate() if aggregate else edges
+
+
+def user_subreddit_edges(columns, include_submissions: bool = True, aggregate: bool = True) -> EdgeList:
+    """
+    author -> subreddit edges of the comments (and submissions), one per object or, aggregated, one per pair with the
+    number of objects as weight
+    """
+    parts = [columns.comment]
+    if include_submissions:
+        parts.append(columns.submission)
+    source = np.concatenate([part["author"] for part in parts])
+    target = np.concatenate([part["subreddit"] for part in parts])
+    timestamp = np.concatenate([part["created_utc"] for part in parts])
+    keep = (source >= 0) & (target >= 0)
+    edges = EdgeList(source[keep], target[keep], timestamp[keep], np.ones(int(keep.sum())), columns.redditor_ids,
+                     columns.subreddit_ids, "redditor", "subreddit")
+    return edges.aggregate() if aggregate else edges
+
+
+def export_graph(columns, kind: str = "reply", **kwargs) -> EdgeList:
+    """
+    edges of a graph of a columnar record
+    :param kind: reply (reply_edges), user_reply (user_reply_edges) or user_subreddit (user_subreddit_edges)
+    :param kwargs: arguments of the function of the kind
+    """
+    if np is None:
+        raise ImportError("numpy is required for the graph export")
+    if kind == "reply":
+        return reply_edges(columns, **kwargs)
+    if kind == "user_reply":
+        return user_reply_edges(columns, **kwargs)
+    if kind == "user_subreddit":
+        return user_subreddit_edges(columns, **kwargs)
+    raise ValueError(f"Unknown graph kind {kind}, one of {graph_kinds}")
@@ -0,0 +1,101 @@
+"""
+base 36 ids of reddit: the int id, the base 36 id and the fullname (t1_xxx), with exact integer conversion, a cache for
+the ids which repeat (authors, subreddits, submissions of the comments) and batch conversion of many ids
+"""
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+digits36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+# every 2 digit base 36 number, to convert 2 digits per divmod
+_pairs36 = [high + low for high in digits36 for low in digits36]
+# number of ids kept by the cache of split_hot_id
+hot_cache_size = 2 ** 16
+
+
+def encode36(number: int) -> str:
+    """
+    base 36 id of an int id (exact for any size, no float division)
+    """
+    if number < 0:
+        return "-" + encode36(-number)
+    chunks = []
+    while number >= 1296:
+        number, remainder = divmod(number, 1296)
+        chunks.append(_pairs36[remainder])
+    head = _pairs36[number] if number >= 36 else digits36[number]
+    if not chunks:
+        return head
+    chunks.append(head)
+    return "".join(reversed(chunks))
+
+
+def decode36(object_id) -> int:
+    """
+    int id of an int id, a base 36 id or a fullname (t1_xxx)
+    """
+    if isinstance(object_id, int):
+        return object_id
+    if isinstance(object_id, str):
+        return int(object_id.rpartition("_")[2], 36)
+    raise ValueError(f"Unknown object id type {type(object_id)}")
+
+
+def split_id(object_id, prefix: str, prefixes: tuple = None) -> (int, str, str):
+    """
+    int id, base 36 id and fullname of an id
+    :param object_id: int id, base 36 id or fullname
+    :param prefix: prefix of the fullname (t1_, t3_...) when object_id is not a fullname
+    :param prefixes: prefixes of the fullnames accepted as object_id (default: prefix only), the fullname is then kept
+    """
+    if isinstance(object_id, str):
+        if object_id.startswith(prefixes or prefix):
+            id_36 = object_id[3:]
+            return int(id_36, 36), id_36, object_id
+        return int(object_id, 36), object_id, prefix + object_id
+    if isinstance(object_id, int):
+        id_36 = encode36(object_id)
+        return object_id, id_36, prefix + id_36
+    raise ValueError("id must be str or int")
+
+
+# for the ids which repeat: authors, subreddits, the submissions and parents of the comments
+split_hot_id = lru_cache(maxsize=hot_cache_size)(split_id)
+
+
+def decode_many(object_ids, as_array: bool = False):
+    """
+    int ids of many ids (int ids, base 36 ids or fullnames)
+    :param as_array: return a numpy int64 array instead of a list
+    """
+    numbers = [object_id if isinstance(object_id, int) else int(object_id.rpartition("_")[2], 36)
+               for object_id in object_ids]
+    if as_array:
+        return np.array(numbers, dtype=np.int64)
+    return numbers
+
+
+def encode_many(numbers, prefix: str = "") -> list:
+    """
+    base 36 ids (fullnames with a prefix) of many non-negative int ids, vectorized when numbers is a numpy array
+    """
+    if np is not None and isinstance(numbers, np.ndarray) and numbers.dtype.kind in "iu":
+        numbers = numbers.astype(np.int64)
+        if len(numbers) == 0:
+            return []
+        if numbers.min() < 0:
+            raise ValueError("ids must be non-negative")
+        # 13 base 36 digits hold any int64
+        width = 13
+        table = np.frombuffer(digits36.encode(), dtype=np.uint8)
+        chars = np.empty((len(numbers), width), dtype=np.uint8)
+        for column in range(width - 1, -1, -1):
+            numbers, remainder = np.divmod(numbers, 36)
+            chars[:, column] = table[remainder]
+        encoded = np.char.lstrip(chars.view(f"S{width}").ravel(), b"0")
+        encoded[encoded == b""] = b"0"
+        return [prefix + id_36 for id_36 in encoded.astype(str).tolist()]
+    return [prefix + encode36(int(number)) for number in numbers]
@@ -0,0 +1,190 @@
+"""
+secondary indexes of the submissions and comments of a registry: sorted (created_utc, id) arrays per subreddit, per
+author and for all the objects, for time range and top-k by score queries without going through the id lists of the
+subreddits and redditors
+"""
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .id_codec import decode36
+from .instrumentation import is_stub
+
+indexed_types = ["submission", "comment"]
+
+
+def to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class TimeIndex:
+    """
+    The objects of one key (a subreddit, an author, or all of them) sorted by (created_utc, id), as array columns.
+
+    range(start, end) finds the rows with start <= created_utc <= end by bisection, in O(log n). top(k) gives the k
+    best scores in O(k) from a second order by score, top(k, start, end) keeps the k best rows of the range with a heap.
+    """
+
+    __slots__ = ("times", "ids", "scores", "_by_score")
+
+    def __init__(self, rows):
+        """
+        :param rows: iterable of (created_utc, id, score)
+        """
+        rows = sorted(rows)
+        self.times = array("q", [row[0] for row in rows])
+        self.ids = array("q", [row[1] for row in rows])
+        self.scores = array("q", [row[2] for row in rows])
+        self._by_score = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def range(self, start=None, end=None) -> (int, int):
+        """
+        first and last + 1 rows with start <= created_utc <= end (None for no bound)
+        """
+        first = 0 if start is None else bisect_left(self.times, start)
+        last = len(self.times) if end is None else bisect_right(self.times, end)
+        return first, max(first, last)
+
+    def between(self, start=None, end=None) -> list:
+        """
+        ids of the objects with start <= created_utc <= end, in time order
+        """
+        first, last = self.range(start, end)
+        return self.ids[first:last].tolist()
+
+    def count(self, start=None, end=None) -> int:
+        first, last = self.range(start, end)
+        return last - first
+
+    def top(self, k: int, start=None, end=None) -> list:
+        """
+        ids of the k objects with the best scores (with start <= created_utc <= end), best first, ties by time
+        """
+        if start is None and end is None:
+            if self._by_score is None:
+                self._by_score = array("q", sorted(range(len(self.ids)), key=lambda row: -self.scores[row]))
+            return [self.ids[row] for row in self._by_score[:k]]
+        first, last = self.range(start, end)
+        rows = heapq.nlargest(k, range(first, last), key=lambda row: (self.scores[row], -row))
+        return [self.ids[row] for row in rows]
+
+
+class SecondaryIndexes:
+    """
+    Time indexes of the submissions and comments of a registry (stubs left out): per subreddit, per author id and
+    for all of them, for every object type. Built once from the objects, build again after objects are added.
+
+    by_subreddit[object_type][subreddit name], by_author[object_type][author_id] and by_time[object_type] are
+    TimeIndex. The subreddits are indexed by their lower case name: the comments give the subreddit name as the id of
+    their subreddit, so a subreddit may have two objects.
+    """
+
+    def __init__(self, registry):
+        """
+        :param registry: objects.Registry of the objects to index
+        """
+        self.registry = registry
+        self.by_subreddit = {}
+        self.by_author = {}
+        self.by_time = {}
+        self.author_names = {}
+        self.build()
+
+    def build(self):
+        for object_type in indexed_types:
+            subreddit_rows = {}
+            author_rows = {}
+            all_rows = []
+            for object_id, obj in self.registry[object_type].items():
+                if is_stub(obj):
+                    continue
+                data = obj._data
+                row = (to_int(data.get("created_utc")), object_id, to_int(data.get("score")))
+                all_rows.append(row)
+                if data.get("subreddit"):
+                    subreddit_rows.setdefault(data["subreddit"].lower(), []).append(row)
+                if data.get("author_id") is not None:
+                    author_rows.setdefault(data["author_id"], []).append(row)
+            self.by_subreddit[object_type] = {key: TimeIndex(rows) for key, rows in subreddit_rows.items()}
+            self.by_author[object_type] = {key: TimeIndex(rows) for key, rows in author_rows.items()}
+            self.by_time[object_type] = TimeIndex(all_rows)
+        self.author_names = {obj._data.get("name"): author_id
+                             for author_id, obj in self.registry["redditor"].items() if obj._data.get("name")}
+        return self
+
+    def subreddit_name(self, subreddit):
+        """
+        lower case name of a subreddit given by its name, fullname (t5_xxx) or int id
+        """
+        if isinstance(subreddit, str) and not subreddit.startswith("t5_"):
+            return subreddit.lower()
+        obj = self.registry["subreddit"].get(decode36(subreddit))
+        return obj._data["name"].lower() if obj is not None and obj._data.get("name") else None
+
+    def author_id(self, author):
+        """
+        int id of a redditor given by its int id, fullname (t2_xxx) or name
+        """
+        if isinstance(author, str) and not author.startswith("t2_"):
+            return self.author_names.get(author)
+        return decode36(author)
+
+    def index(self, object_type="comment", subreddit=None, author=None) -> TimeIndex:
+        """
+        the time index of the objects of a subreddit or of an author (the smaller one when both are given, see
+        query), or of all of them
+        :return: the index, None when the subreddit or the author has no object
+        """
+        if object_type not in indexed_types:
+            raise ValueError(f"Unknown object type {object_type}")
+        candidates = []
+        if subreddit is not None:
+            candidates.append(self.by_subreddit[object_type].get(self.subreddit_name(subreddit)))
+        if author is not None:
+            candidates.append(self.by_author[object_type].get(self.author_id(author)))
+        if not candidates:
+            return self.by_time[object_type]
+        if any(candidate is None for candidate in candidates):
+            return None
+        return min(candidates, key=len)
+
+    def query(self, object_type="comment", subreddit=None, author=None, start=None, end=None) -> list:
+        """
+        ids of the objects (of a subreddit, of an author) with start <= created_utc <= end, in time order
+        """
+        index = self.index(object_type, subreddit, author)
+        if index is None:
+            return []
+        object_ids = index.between(start, end)
+        if subreddit is not None and author is not None:
+            object_ids = self.matching(object_type, object_ids, subreddit, author)
+        return object_ids
+
+    def top(self, object_type="comment", k=10, subreddit=None, author=None, start=None, end=None) -> list:
+        """
+        ids of the k objects (of a subreddit, of an author, with start <= created_utc <= end) with the best scores
+        """
+        index = self.index(object_type, subreddit, author)
+        if index is None:
+            return []
+        if subreddit is not None and author is not None:
+            object_ids = set(self.query(object_type, subreddit, author, start, end))
+            first, last = index.range(start, end)
+            rows = heapq.nlargest(k, (row for row in range(first, last) if index.ids[row] in object_ids),
+                                  key=lambda row: (index.scores[row], -row))
+            return [index.ids[row] for row in rows]
+        return index.top(k, start, end)
+
+    def matching(self, object_type, object_ids, subreddit, author) -> list:
+        subreddit_name = self.subreddit_name(subreddit)
+        author_id = self.author_id(author)
+        objects_of_type = self.registry[object_type]
+        return [object_id for object_id in object_ids
+                if (objects_of_type[object_id]._data.get("subreddit") or "").lower() == subreddit_name and
+                objects_of_type[object_id]._data.get("author_id") == author_id]
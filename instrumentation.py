@@ -0,0 +1,154 @@
+"""
+instrumentation of the build pipeline: wall time and memory of every stage, objects created per type, stub and
+real objects, with hooks to forward them (e.g. to a metrics system)
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+stub_types = ["submission", "comment"]
+
+
+def peak_rss_mb():
+    """
+    peak resident memory of this process in MB (None where the resource module is not available)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if os.uname().sysname == "Darwin" else peak / 2 ** 10
+
+
+def rss_mb():
+    """
+    current resident memory of this process in MB (None where /proc/self/statm is not available, e.g. macOS)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def count_objects(registry) -> dict:
+    return {object_type: len(objects_of_type) for object_type, objects_of_type in registry.items()}
+
+
+def is_stub(obj) -> bool:
+    """
+    whether a submission or comment is a stub: built from a placeholder ({"id": ...}) for a parent or submission which
+    is not in the data, it has no created_utc. A stub becomes a real object when its record is built later
+    """
+    return obj.object_type in stub_types and "created_utc" not in obj._data
+
+
+class BuildReport:
+    """
+    Report of a build (generate_data_objects, generate_data_objects_parallel, append_data_objects or
+    DataProcessorReddit(report=...)).
+
+    stages: stage name -> {"seconds": wall time, "rss_mb": resident memory of the process at the end of the stage,
+    "rss_delta_mb": memory taken (or released when negative) by the stage}, the memory is None where rss_mb is not
+    available
+    peak_rss_mb: peak memory of the process at the end of the build (since the process started, not only the build)
+    created: object type -> number of objects created by the build
+    total: object type -> number of objects in the registry after the build
+    stubs: object type -> number of stubs in the registry after the build (see is_stub), real = total - stubs
+
+    on_stage hooks are called as hook(name, stage) after every stage, on_finish hooks as hook(report) at the end.
+    """
+
+    def __init__(self, on_stage=None, on_finish=None):
+        """
+        :param on_stage: list of callables hook(name, stage), stage being the dict of stages[name]
+        :param on_finish: list of callables hook(report)
+        """
+        self.stages = {}
+        self.created = {}
+        self.total = {}
+        self.stubs = {}
+        self.seconds = None
+        self.peak_rss_mb = None
+        self.on_stage = list(on_stage or [])
+        self.on_finish = list(on_finish or [])
+        self._begin_counts = {}
+        self._begin_time = None
+
+    def begin(self, registry):
+        """
+        start the report of a build into registry, nothing is done when it is already started (e.g. by
+        DataProcessorReddit before the files are loaded) and not finished yet
+        """
+        if self._begin_time is not None:
+            return
+        self._begin_counts = count_objects(registry)
+        self._begin_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        time the stage in the with block and measure the memory it takes, the times and memory of a stage run several
+        times are added
+        """
+        begin_rss = rss_mb()
+        begin_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "rss_mb": None, "rss_delta_mb": None})
+            stage["seconds"] += time.perf_counter() - begin_time
+            end_rss = rss_mb()
+            if begin_rss is not None and end_rss is not None:
+                stage["rss_mb"] = end_rss
+                stage["rss_delta_mb"] = (stage["rss_delta_mb"] or 0.0) + end_rss - begin_rss
+            for hook in self.on_stage:
+                hook(name, stage)
+
+    def finish(self, registry):
+        """
+        count the objects of registry and call the on_finish hooks
+        """
+        if self._begin_time is not None:
+            self.seconds = time.perf_counter() - self._begin_time
+        self.total = count_objects(registry)
+        self.created = {object_type: count - self._begin_counts.get(object_type, 0)
+                        for object_type, count in self.total.items()}
+        self.stubs = {object_type: sum(1 for obj in registry[object_type].values() if is_stub(obj))
+                      for object_type in stub_types}
+        self.peak_rss_mb = peak_rss_mb()
+        self._begin_time = None
+        for hook in self.on_finish:
+            hook(self)
+
+    def to_dict(self) -> dict:
+        real = {object_type: self.total.get(object_type, 0) - stubs for object_type, stubs in self.stubs.items()}
+        return {"seconds": self.seconds, "peak_rss_mb": self.peak_rss_mb, "stages": self.stages,
+                "created": self.created, "total": self.total, "stubs": self.stubs, "real": real}
+
+    def to_json(self, path: str = None) -> str:
+        """
+        the report as json, also written to path if it is given
+        """
+        text = json.dumps(self.to_dict(), indent=2)
+        if path:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    def __str__(self):
+        lines = [f"build {self.seconds or 0:.3f} s, peak memory {self.peak_rss_mb or 0:,.0f} MB"]
+        for name, stage in self.stages.items():
+            memory = f" {stage['rss_delta_mb']:+9,.0f} MB" if stage["rss_delta_mb"] is not None else ""
+            lines.append(f"    {name:24} {stage['seconds']:9.3f} s{memory}")
+        for object_type, count in self.created.items():
+            stubs = f" ({self.stubs[object_type]:,} stubs in total)" if object_type in self.stubs else ""
+            lines.append(f"    {object_type:24} {count:9,} created{stubs}")
+        return "\n".join(lines)
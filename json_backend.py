@@ -0,0 +1,165 @@
+"""
+json parsers and serializers for loading and conversion.
+
+orjson or msgspec is used when it is installed, stdlib json otherwise. The backend can be chosen per call (the
+json_backend argument of zst2json and the loaders, a name or a backend) or for the whole process with the
+REDDIT_JSON_BACKEND environment variable (json, orjson, msgspec or auto).
+"""
+import json
+import os
+
+backend_env = "REDDIT_JSON_BACKEND"
+
+
+class JsonBackend:
+    """
+    stdlib json
+    """
+    name = "json"
+    decode_error = json.decoder.JSONDecodeError
+
+    @staticmethod
+    def available():
+        return True
+
+    def loads(self, s):
+        return json.loads(s)
+
+    def dumps(self, obj):
+        """
+        serialize obj to a str
+        """
+        return json.dumps(obj)
+
+    def load(self, f):
+        return self.loads(f.read())
+
+    def __repr__(self):
+        return f"<json backend {self.name}>"
+
+
+class OrjsonBackend(JsonBackend):
+    """
+    orjson, dict keys which are not str (e.g. int ids) are kept as in stdlib json
+    """
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.decode_error = orjson.JSONDecodeError
+
+    @staticmethod
+    def available():
+        try:
+            import orjson
+        except ImportError:
+            return False
+        return True
+
+    def loads(self, s):
+        import orjson
+        return orjson.loads(s)
+
+    def dumps(self, obj):
+        import orjson
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+class MsgspecBackend(JsonBackend):
+    """
+    msgspec
+    """
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+        self.decode_error = msgspec.DecodeError
+
+    @staticmethod
+    def available():
+        try:
+            import msgspec
+        except ImportError:
+            return False
+        return True
+
+    def loads(self, s):
+        import msgspec
+        return msgspec.json.decode(s)
+
+    def dumps(self, obj):
+        import msgspec
+        return msgspec.json.encode(obj).decode()
+
+
+backends = {"orjson": OrjsonBackend, "msgspec": MsgspecBackend, "json": JsonBackend}
+
+_backend_cache = {}
+
+
+def get_backend(json_backend=None):
+    """
+    get a json backend
+    :param json_backend: a backend, a name (json, orjson, msgspec, auto) or None for the REDDIT_JSON_BACKEND environment
+    variable (default: auto, the fastest installed one)
+    :return: the backend
+    """
+    if isinstance(json_backend, JsonBackend):
+        return json_backend
+    name = json_backend or os.environ.get(backend_env) or "auto"
+    if name not in _backend_cache:
+        if name == "auto":
+            _backend_cache[name] = next(backend() for backend in backends.values() if backend.available())
+        elif name in backends:
+            if not backends[name].available():
+                raise ImportError(f"json backend {name} is not installed")
+            _backend_cache[name] = backends[name]()
+        else:
+            raise ValueError(f"Unknown json backend {name}, choose from auto, {', '.join(backends)}")
+    return _backend_cache[name]
+
+
+def available_backends():
+    """
+    names of the installed backends
+    """
+    return [name for name, backend in backends.items() if backend.available()]
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Benchmark the json backends on Pushshift-shaped records.')
+    parser.add_argument('--lines', type=int, default=200000, help='number of records')
+    args = parser.parse_args()
+
+    # a comment as in the Pushshift dumps
+    sample = {
+        "all_awardings": [], "archived": False, "associated_award": None, "author": "some_redditor",
+        "author_created_utc": 1389999999, "author_flair_background_color": None, "author_flair_css_class": None,
+        "author_flair_richtext": [], "author_flair_template_id": None, "author_flair_text": None,
+        "author_flair_text_color": None, "author_flair_type": "text", "author_fullname": "t2_ferd3",
+        "author_patreon_flair": False, "author_premium": False, "awarders": [],
+        "body": "I think the second season was better, but the ending of the first one is hard to beat. " * 3,
+        "can_gild": True, "can_mod_post": False, "collapsed": False, "collapsed_because_crowd_control": None,
+        "collapsed_reason": None, "comment_type": None, "controversiality": 0, "created_utc": 1609459201,
+        "distinguished": None, "edited": False, "gilded": 0, "gildings": {}, "id": "ghb4u1k", "is_submitter": False,
+        "link_id": "t3_kntmzq", "locked": False, "no_follow": True, "parent_id": "t1_ghb2x0a",
+        "permalink": "/r/television/comments/kntmzq/some_title/ghb4u1k/", "retrieved_on": 1610000000,
+        "score": 12, "send_replies": True, "stickied": False, "subreddit": "television",
+        "subreddit_id": "t5_2qh6e", "subreddit_name_prefixed": "r/television", "subreddit_type": "public",
+        "top_awarded_type": None, "total_awards_received": 0, "treatment_tags": [],
+    }
+    lines = [json.dumps(dict(sample, id=f"ghb{idx:x}", score=idx % 100)) for idx in range(args.lines)]
+    for name in available_backends():
+        backend = get_backend(name)
+        begin_time = time.perf_counter()
+        parsed = [backend.loads(line) for line in lines]
+        loads_time = time.perf_counter() - begin_time
+        begin_time = time.perf_counter()
+        for obj in parsed:
+            backend.dumps(obj)
+        dumps_time = time.perf_counter() - begin_time
+        print(f"{name:8} loads {len(lines) / loads_time:12,.0f} lines/s    "
+              f"dumps {len(lines) / dumps_time:12,.0f} lines/s")
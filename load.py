@@ -1,49 +1,418 @@
 """
 load submissions and comments from file
 """
+import copy
 import json
+
 from tqdm import tqdm
 
+from .json_backend import get_backend
+from .id_codec import decode36, split_hot_id
+
 
+# deprecated, use RecordFilter(time_max=...): the loaders created while it is set (and not given a filter) skip the
+# records created after it
 global_time_max = None
 
 
+class RecordFilter:
+    """
+    Filter of the raw records, applied by the loaders while they read the files (before the records are kept in memory,
+    indexed or turned into objects), so a rejected record never becomes an object or creates placeholders of its
+    parent, submission, author or subreddit.
+
+    A record is kept when it passes every condition given: time_min <= created_utc <= time_max, subreddit (name, case
+    insensitive) in subreddits and not in exclude_subreddits, author in authors and not in exclude_authors,
+    score >= score_min, predicate(record) is true, and for a comment, its submission is in link_ids.
+    The comments of a submission left out cannot be built, data_processor.load_data_from_file sets link_ids to the
+    submissions kept (see for_threads). A comment whose parent comment is left out gets a placeholder parent, as a
+    comment whose parent was deleted.
+    """
+
+    def __init__(self, time_min=None, time_max=None, subreddits=None, exclude_subreddits=None, authors=None,
+                 exclude_authors=None, score_min=None, predicate=None, link_ids=None):
+        """
+        :param time_min: earliest created_utc (included)
+        :param time_max: latest created_utc (included)
+        :param subreddits: names of the subreddits to keep
+        :param exclude_subreddits: names of the subreddits to leave out
+        :param authors: names of the authors to keep
+        :param exclude_authors: names of the authors to leave out (e.g. ["[deleted]", "AutoModerator"])
+        :param score_min: lowest score
+        :param predicate: callable predicate(record) -> bool, called last on the raw record
+        :param link_ids: int ids of the submissions whose comments are kept
+        """
+        self.time_min = time_min
+        self.time_max = time_max
+        self.subreddits = None if subreddits is None else {name.lower() for name in subreddits}
+        self.exclude_subreddits = None if exclude_subreddits is None else {name.lower() for name in
+                                                                            exclude_subreddits}
+        self.authors = None if authors is None else set(authors)
+        self.exclude_authors = None if exclude_authors is None else set(exclude_authors)
+        self.score_min = score_min
+        self.predicate = predicate
+        self.link_ids = None if link_ids is None else set(link_ids)
+
+    def __call__(self, item) -> bool:
+        if self.time_min is not None or self.time_max is not None:
+            created_utc = item.get("created_utc")
+            if created_utc is None:
+                return False
+            if isinstance(created_utc, str):
+                created_utc = float(created_utc)
+            if self.time_min is not None and created_utc < self.time_min:
+                return False
+            if self.time_max is not None and created_utc > self.time_max:
+                return False
+        if self.subreddits is not None or self.exclude_subreddits is not None:
+            subreddit = (item.get("subreddit") or "").lower()
+            if self.subreddits is not None and subreddit not in self.subreddits:
+                return False
+            if self.exclude_subreddits is not None and subreddit in self.exclude_subreddits:
+                return False
+        if self.authors is not None and item.get("author") not in self.authors:
+            return False
+        if self.exclude_authors is not None and item.get("author") in self.exclude_authors:
+            return False
+        if self.score_min is not None and (item.get("score") or 0) < self.score_min:
+            return False
+        if self.link_ids is not None and "link_id" in item:
+            try:
+                if parse_object_id(item["link_id"]) not in self.link_ids:
+                    return False
+            except ValueError:
+                return False
+        if self.predicate is not None and not self.predicate(item):
+            return False
+        return True
+
+    def for_threads(self, link_ids):
+        """
+        a copy of the filter which also leaves out the comments of the submissions which are not in link_ids
+        """
+        record_filter = copy.copy(self)
+        record_filter.link_ids = set(link_ids)
+        return record_filter
+
+    def filter(self, items):
+        """
+        the items which pass the filter, as a list
+        """
+        return [item for item in items if self(item)]
+
+
+def default_record_filter(record_filter=None):
+    """
+    record_filter, or a filter of global_time_max when it is set (for the code which still uses it), or None
+    """
+    if record_filter is None and global_time_max:
+        return RecordFilter(time_max=global_time_max)
+    return record_filter
+
+
+def load_json_file(path, json_backend=None, record_filter=None):
+    """
+    load a json file, or a jsonl file with one json record per line (e.g. from zst2json.py --output_format jsonl)
+    :param path: file path
+    :param json_backend: json backend or its name, see json_backend.get_backend
+    :param record_filter: RecordFilter (or any predicate on a record) of the records to keep, applied as every line of
+    a jsonl file is parsed, and to the list of records (or the lists of comments of every submission) of a json file
+    :return: the json value of a json file, or the list of records of a jsonl file
+    """
+    json_backend = get_backend(json_backend)
+    with open(path, "r") as f:
+        if not is_jsonl(f, json_backend):
+            return filter_json_value(json_backend.load(f), record_filter)
+        data = []
+        for line in f:
+            if line.strip():
+                item = json_backend.loads(line)
+                if record_filter is None or record_filter(item):
+                    data.append(item)
+        return data
+
+
+def is_jsonl(f, json_backend=None, peek_size=2 ** 20) -> bool:
+    """
+    whether an open text file is a jsonl file (one json value per line) rather than one json value, reading at most
+    peek_size characters per line: a jsonl file has a first line which is a whole json value and a second non-empty
+    line, or is a single line with one record (a dict with an id). A first line longer than peek_size is a json file
+    (e.g. the one line json of zst2json or of the grouped comments). The file is at its start again after
+    """
+    json_backend = get_backend(json_backend)
+    try:
+        first_line = f.readline(peek_size)
+        if len(first_line) >= peek_size and not first_line.endswith("\n"):
+            return False
+        second_line = ""
+        while not second_line.strip():
+            second_line = f.readline(peek_size)
+            if not second_line:
+                break
+        try:
+            first_value = json_backend.loads(first_line)
+        except json_backend.decode_error:
+            # a json value written over several lines
+            return False
+        if second_line.strip():
+            return True
+        return isinstance(first_value, dict) and "id" in first_value
+    finally:
+        f.seek(0)
+
+
+def filter_json_value(value, record_filter=None):
+    """
+    filter the records of a json file: a list of records, or a dict of submission id -> list of comments (the
+    submissions left without comments are removed)
+    """
+    if record_filter is None:
+        return value
+    if isinstance(value, list):
+        return [item for item in value if record_filter(item)]
+    if isinstance(value, dict):
+        filtered = {}
+        for key, items in value.items():
+            items = [item for item in items if record_filter(item)]
+            if items:
+                filtered[key] = items
+        return filtered
+    return value
+
+
+def iter_json_values(f, chunk_size=2 ** 20):
+    """
+    iterate the values of the top-level json list, or the (key, value) pairs of the top-level json object, of a file
+    without loading the whole file
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill(size):
+        nonlocal buffer, pos, eof
+        chunk = f.read(size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip(characters=" \t\r\n"):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in characters:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill(chunk_size)
+
+    def decode():
+        nonlocal pos
+        size = chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # a number may be cut at the end of the buffer
+                if end < len(buffer) or eof:
+                    pos = end
+                    return value
+            except json.decoder.JSONDecodeError:
+                if eof:
+                    raise
+            # the value goes on in the file, read more (bigger and bigger not to decode a long value too many times)
+            fill(size)
+            size *= 2
+
+    fill(chunk_size)
+    skip()
+    if pos >= len(buffer) or buffer[pos] not in "[{":
+        raise ValueError("the top-level json value is not a list or an object")
+    is_object = buffer[pos] == "{"
+    closing = "}" if is_object else "]"
+    pos += 1
+    while True:
+        skip(" \t\r\n,")
+        if pos >= len(buffer):
+            raise ValueError("unexpected end of the json file")
+        if buffer[pos] == closing:
+            return
+        if is_object:
+            key = decode()
+            skip(" \t\r\n:")
+            yield key, decode()
+        else:
+            yield decode()
+
+
+def iter_json_records(path, json_backend=None, record_filter=None):
+    """
+    iterate the records of a json file (a list of records, or the json object of submission id -> list of comments)
+    or of a jsonl file one by one, without keeping them in memory
+    :param path: file path
+    :param json_backend: json backend or its name for the jsonl files, see json_backend.get_backend
+    :param record_filter: RecordFilter (or any predicate on a record) of the records to yield
+    """
+    if record_filter is not None:
+        yield from filter(record_filter, iter_json_records(path, json_backend))
+        return
+    json_backend = get_backend(json_backend)
+    with open(path, "r") as f:
+        if is_jsonl(f, json_backend):
+            for line in f:
+                if line.strip():
+                    yield json_backend.loads(line)
+            return
+        for value in iter_json_values(f):
+            if isinstance(value, tuple):
+                # grouped comments
+                yield from value[1]
+            else:
+                yield value
+
+
+def parse_object_id(object_id):
+    """
+    int id of a record, accepts int, base 36 id and fullname (t1_xxx)
+    """
+    return decode36(object_id)
+
+
+def group_comments_by_submission(comments):
+    """
+    group a flat list of comments to the dict of submission id -> list of comments which LoadComments uses
+    """
+    grouped = {}
+    for comment in comments:
+        if comment["link_id"] not in grouped:
+            grouped[comment["link_id"]] = []
+        grouped[comment["link_id"]].append(comment)
+    return grouped
+
+
 class LoadRedditObject:
     element_type = "reddit_object"
+    # key of the subreddit id of a record, as the objects take it (the comments derive it from the subreddit name)
+    subreddit_id_key = "subreddit_id"
 
-    def __init__(self, path):
+    def __init__(self, path, json_backend=None, stream=False, lazy=False, record_filter=None):
+        """
+        :param path: json or jsonl file path
+        :param json_backend: json backend or its name, see json_backend.get_backend
+        :param stream: do not load the file, read the records one by one while iterating (e.g. in convert_to_object),
+        so the raw records are never all in memory. Only iteration is supported in this mode.
+        :param lazy: do not load the file, only index the offset of every record (jsonl file only), the records are
+        read one by one with get_record. Iteration works as in the stream mode.
+        :param record_filter: RecordFilter (or any predicate on a raw record) of the records to keep, the others are
+        left out as the file is read (not loaded, indexed or iterated)
+        """
         self.path = path
+        self.json_backend = json_backend
+        self.record_filter = default_record_filter(record_filter)
+        self.stream = stream or lazy
+        self.lazy = lazy
         self.data = None
-        self.load() if self.path else None
+        self.offsets = None
+        # for the lazy mode, int ids of the submissions of the threads of every author and subreddit (int ids as the
+        # redditor and subreddit objects have them), in file order with repeats
+        self.author_threads = None
+        self.subreddit_threads = None
+        self._file = None
+        if self.path:
+            if self.lazy:
+                self.build_offset_index()
+            elif not self.stream:
+                self.load()
         self.objects = {}
 
     def load(self):
         """
-        load the object from json file
+        load the object from json file (or jsonl file)
         """
-        with open(self.path, "r") as f:
-            self.data = json.load(f)
+        self.data = load_json_file(self.path, self.json_backend, self.record_filter)
         return self.data
 
+    def build_offset_index(self):
+        """
+        index the byte offset of every record of the jsonl file
+        """
+        json_backend = get_backend(self.json_backend)
+        with open(self.path, "r") as f:
+            if not is_jsonl(f, json_backend):
+                raise ValueError(f"{self.path} is not a jsonl file, the lazy mode needs one record per line "
+                                 f"(convert it with zst2json.py --output_format jsonl)")
+        self.offsets = {}
+        self.author_threads = {}
+        self.subreddit_threads = {}
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    try:
+                        item = json_backend.loads(line)
+                    except json_backend.decode_error:
+                        item = None
+                    if not (isinstance(item, dict) and "id" in item):
+                        raise ValueError(f"{self.path} is not a jsonl file, the lazy mode needs one record per line "
+                                         f"(convert it with zst2json.py --output_format jsonl)")
+                    if self.record_filter is None or self.record_filter(item):
+                        self.index_record(item, offset)
+                offset += len(line)
+        return self.offsets
+
+    def index_record(self, item, offset):
+        """
+        index one record at its offset
+        """
+        object_id = parse_object_id(item["id"])
+        self.offsets[object_id] = offset
+        self.index_thread(item, object_id)
+
+    def index_thread(self, item, thread_id):
+        """
+        index the thread (submission id) of a record under its author and its subreddit
+        """
+        if thread_id is None:
+            return
+        for threads, object_id, prefix in ((self.author_threads, item.get("author_fullname"), "t2_"),
+                                           (self.subreddit_threads, item.get(self.subreddit_id_key), "t5_")):
+            try:
+                object_id = split_hot_id(object_id, prefix)[0]
+            except (TypeError, ValueError):
+                continue
+            if object_id not in threads:
+                threads[object_id] = []
+            threads[object_id].append(thread_id)
+
+    def get_record(self, object_id):
+        """
+        read the record of an int id from the file in lazy mode
+        :return: the record or None if the id is not in the file
+        """
+        offset = self.offsets.get(object_id)
+        if offset is None:
+            return None
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        self._file.seek(offset)
+        return get_backend(self.json_backend).loads(self._file.readline())
+
     def convert_to_object(self, converter, use_tqdm=False, tqdm_desc=f"convert to object"):
         """
         convert the data to object
         """
         if use_tqdm:
-            for idx, item in tqdm(enumerate(self), desc=tqdm_desc, total=len(self)):
-                if global_time_max:
-                    if item['created_utc'] > global_time_max:
-                        continue
+            for idx, item in tqdm(enumerate(self), desc=tqdm_desc,
+                                  total=len(self) if self.lazy or not self.stream else None):
                 self.objects[idx] = converter(item)
         else:
             for idx, item in enumerate(self):
-                if global_time_max:
-                    if item['created_utc'] > global_time_max:
-                        continue
                 self.objects[idx] = converter(item)
         return self.objects
 
     def __len__(self):
+        if self.lazy:
+            return len(self.offsets)
         return len(self.data)
 
     def __getitem__(self, idx):
@@ -53,6 +422,8 @@ class LoadRedditObject:
         self.data[idx] = value
 
     def __iter__(self):
+        if self.stream:
+            return iter_json_records(self.path, self.json_backend, self.record_filter)
         return iter(self.data)
 
     def __repr__(self):
@@ -102,10 +473,10 @@ class LoadRedditObject:
 class LoadSubmissions(LoadRedditObject):
     element_type = "submissions"
 
-    def __init__(self, path):
+    def __init__(self, path, json_backend=None, stream=False, lazy=False, record_filter=None):
         self.submissions = None
         self.submissions_ids = None
-        super().__init__(path)
+        super().__init__(path, json_backend, stream, lazy, record_filter)
 
     def load(self):
         self.submissions = super().load()
@@ -113,6 +484,8 @@ class LoadSubmissions(LoadRedditObject):
         return self.submissions
 
     def __len__(self):
+        if self.lazy:
+            return super().__len__()
         return len(self.submissions)
 
     def __getitem__(self, idx=None, submission_id=None):
@@ -123,6 +496,8 @@ class LoadSubmissions(LoadRedditObject):
         return self.submissions[idx]
 
     def __iter__(self):
+        if self.stream:
+            return super().__iter__()
         return iter(self.submissions)
 
     def convert_to_object(self, converter, use_tqdm=False, tqdm_desc=f"convert to submission object"):
@@ -134,18 +509,28 @@ class LoadSubmissions(LoadRedditObject):
 
 class LoadComments(LoadRedditObject):
     element_type = "comments"
+    subreddit_id_key = "subreddit"
 
-    def __init__(self, path):
+    def __init__(self, path, json_backend=None, stream=False, lazy=False, record_filter=None):
         self.comments = None
         self.comments_list = None
         self.comments_ids = None
         self.comments_ids2submission_ids = None
         self.comments_tree = None
         self.objects_dict = {}
-        super().__init__(path)
+        # for the lazy mode, int ids of the submission and the parent comment (None for a top level comment) of every
+        # comment, and the int ids of the comments of every submission in file order
+        self.comments_link_ids = None
+        self.comments_parent_ids = None
+        self.submission_comments = None
+        super().__init__(path, json_backend, stream, lazy, record_filter)
 
     def load(self):
         self.comments = super().load()
+        if isinstance(self.comments, list):
+            # flat comments from a jsonl file
+            self.comments = group_comments_by_submission(self.comments)
+            self.data = self.comments
         self.comments_list = [comment for submission_comments in self.comments.values() for comment in
                               submission_comments]
         self.comments_ids = {comment["id"]: idx for idx, comment in enumerate(self.comments_list)}
@@ -153,7 +538,34 @@ class LoadComments(LoadRedditObject):
         self.comments_tree = {comment["id"]: comment["parent_id"] for comment in self.comments_list}
         return self.comments
 
+    def build_offset_index(self):
+        self.comments_link_ids = {}
+        self.comments_parent_ids = {}
+        self.submission_comments = {}
+        return super().build_offset_index()
+
+    def index_record(self, item, offset):
+        comment_id = parse_object_id(item["id"])
+        self.offsets[comment_id] = offset
+        try:
+            link_id = parse_object_id(item["link_id"])
+        except (KeyError, ValueError):
+            link_id = None
+        parent_id = item.get("parent_id")
+        try:
+            parent_id = parse_object_id(parent_id) if parent_id and not str(parent_id).startswith("t3_") else None
+        except ValueError:
+            parent_id = None
+        self.comments_link_ids[comment_id] = link_id
+        self.comments_parent_ids[comment_id] = parent_id if parent_id != link_id else None
+        self.index_thread(item, link_id)
+        if link_id not in self.submission_comments:
+            self.submission_comments[link_id] = []
+        self.submission_comments[link_id].append(comment_id)
+
     def __len__(self):
+        if self.lazy:
+            return super().__len__()
         return len(self.comments_list)
 
     def __getitem__(self, idx=None, comment_id=None):
@@ -164,32 +576,27 @@ class LoadComments(LoadRedditObject):
         return self.comments_list[idx]
 
     def __iter__(self):
+        if self.stream:
+            return super().__iter__()
         return iter(self.comments_list)
 
     def convert_to_object(self, converter, use_tqdm=False, tqdm_desc=f"convert to comment object"):
         """
         convert the data to object
         """
+        items = enumerate(self)
         if use_tqdm:
-            for idx, item in tqdm(enumerate(self.comments_list), desc=tqdm_desc, total=len(self.comments_list)):
-                if global_time_max:
-                    if item['created_utc'] > global_time_max:
-                        continue
-                self.objects[idx] = converter(item)
-                item = self.objects[idx]
-                if self.comments_ids2submission_ids[item["id_36"]] not in self.objects_dict:
-                    self.objects_dict[self.comments_ids2submission_ids[item["id_36"]]] = []
-                self.objects_dict[self.comments_ids2submission_ids[item["id_36"]]].append(self.objects[idx])
-        else:
-            for idx, item in enumerate(self.comments_list):
-                if global_time_max:
-                    if item['created_utc'] > global_time_max:
-                        continue
-                self.objects[idx] = converter(item)
-                item = self.objects[idx]
-                if self.comments_ids2submission_ids[item["id_36"]] not in self.objects_dict:
-                    self.objects_dict[self.comments_ids2submission_ids[item["id_36"]]] = []
-                self.objects_dict[self.comments_ids2submission_ids[item["id_36"]]].append(self.objects[idx])
+            items = tqdm(items, desc=tqdm_desc, total=len(self) if self.lazy or not self.stream else None)
+        for idx, item in items:
+            # keep the raw link_id in stream mode, the converter replaces it with the int id
+            link_id = item.get("link_id") if self.stream else None
+            self.objects[idx] = converter(item)
+            item = self.objects[idx]
+            if not self.stream:
+                link_id = self.comments_ids2submission_ids[item["id_36"]]
+            if link_id not in self.objects_dict:
+                self.objects_dict[link_id] = []
+            self.objects_dict[link_id].append(self.objects[idx])
 
 
 if __name__ == "__main__":
@@ -2,9 +2,323 @@
 Reddit Objects
 """
 from typing import Iterable
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from array import array
 import copy
+import gc
+import io
+import operator
+import pickle
+import sys
+
+from . import id_codec
+
+object_types = ["reddit_object", "submission", "comment", "redditor", "subreddit", "comment_tree"]
+
+# the attributes of the objects which link to other objects
+link_attributes = ["_submission", "_author", "_subreddit", "_comment_tree", "_parent", "_head"]
+
+# the object types a link attribute can point to
+link_targets = {"_submission": {"submission"}, "_author": {"redditor"}, "_subreddit": {"subreddit"},
+                "_comment_tree": {"comment_tree"}, "_parent": {"submission", "comment"},
+                "_head": {"submission", "comment"}}
+
+# the id lists merged (without duplicates) when the same object is in two registries
+merged_list_keys = ["comments_id", "comments_total_id", "submissions_id"]
+
+
+class Registry(dict):
+    """
+    The objects of a dataset: object type -> {int id: object}.
+    The objects are created in a registry by the create_* functions (registry argument) and keep it in _registry, so
+    several datasets can be built side by side. record is the default registry, used when none is given.
+    loaders: object type -> function of an int id returning the raw dict of the object or None, for the lazy mode of
+    DataProcessorReddit: a placeholder ({"id": ...}) of an object which is not built yet is built from the raw dict
+    instead.
+    A registry is pickled as a flat list of objects whose links are (object type, id) references, so it can be sent
+    from a worker process or saved whatever the size of the graph.
+    store: optional store.SQLiteStore keeping the data of the objects on disk (see use_store), None to keep it in
+    memory.
+    compact: keep the data of the objects created in the registry in CompactData instead of dicts (see CompactData),
+    use_compact_data does it for all the registries.
+    """
+
+    def __init__(self, store=None, compact=False):
+        super().__init__((object_type, {}) for object_type in object_types)
+        self.loaders = {}
+        self.compact = compact
+        self.store = None
+        if store is not None:
+            self.use_store(store)
 
-record = {}
+    def __repr__(self):
+        return f"<Registry {', '.join(f'{len(objects)} {object_type}' for object_type, objects in self.items())}>"
+
+    def count(self):
+        return sum(len(objects) for objects in self.values())
+
+    def use_store(self, store):
+        """
+        keep the data of the objects in store (store.SQLiteStore): the objects already there and the ones created
+        after get a store.DiskData as _data
+        """
+        self.store = store
+        for objects in self.values():
+            for obj in objects.values():
+                store.adopt(obj)
+
+    def clear(self):
+        """
+        remove all the objects (the object types are kept). The links between the objects are removed first, so their
+        memory is released right away by reference counting instead of waiting for the garbage collector
+        """
+        for objects in self.values():
+            for obj in objects.values():
+                for attr in link_attributes:
+                    try:
+                        delattr(obj, attr)
+                    except AttributeError:
+                        pass
+            objects.clear()
+        self.loaders.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def merge(self, other, disjoint=False):
+        """
+        move the objects of another registry (e.g. built by a worker process) into this one, the other registry is
+        left empty. An object which is in both (a redditor or a subreddit, a placeholder...) is merged into the object
+        of this registry: its missing keys and links are added, the id lists (comments_id, submissions_id...), activity
+        and no_follow are joined without duplicates, and the links of the moved objects to it are replaced.
+        :param disjoint: the id lists of the objects in both registries have no id in common (e.g. registries built
+        from different threads, as the shards of generate_data_objects_parallel), they are joined without looking for
+        duplicates
+        :return: self
+        """
+        replaced = {}
+        relink = {}
+        for object_type, other_objects in other.items():
+            objects = self.setdefault(object_type, {})
+            moved = relink.setdefault(object_type, [])
+            for object_id, obj in other_objects.items():
+                existing = objects.get(object_id)
+                if existing is None:
+                    objects[object_id] = obj
+                    obj._registry = self
+                    obj._record = objects
+                    moved.append(obj)
+                elif existing is not obj:
+                    merge_objects(existing, obj, disjoint)
+                    replaced[id(obj)] = existing
+                    moved.append(existing)
+        if replaced:
+            replaced_types = {obj.object_type for obj in replaced.values()}
+            for object_type, moved in relink.items():
+                # only the links which can point to a replaced object, read from the slots directly: an unset slot
+                # would go through RedditObjectBase.__getattr__
+                slots = [object_slots[attr] for attr in special_objects.get(object_type, link_attributes)
+                         if link_targets[attr] & replaced_types]
+                if not slots:
+                    continue
+                for obj in moved:
+                    for slot in slots:
+                        try:
+                            linked = slot.__get__(obj)
+                        except AttributeError:
+                            continue
+                        if linked is not None and id(linked) in replaced:
+                            slot.__set__(obj, replaced[id(linked)])
+        if self.store is not None:
+            for moved in relink.values():
+                for obj in moved:
+                    self.store.adopt(obj)
+        for other_objects in other.values():
+            other_objects.clear()
+        self.loaders.update(other.loaders)
+        other.loaders.clear()
+        return self
+
+    def get_state(self):
+        """
+        flat state of the registry: {"layouts": [keys], "types": [object type], "rows": [(type, id, layout, values,
+        processed, links, attributes)]}. The keys of the data dicts are stored once per layout (layout -1: values is a
+        CompactData), and the links are the positions of the linked objects in rows (in the order of link_attributes,
+        -1 for None, -2 when not set)
+        """
+        positions = {}
+        for objects in self.values():
+            for obj in objects.values():
+                positions[id(obj)] = len(positions)
+        types = list(self)
+        layouts = {}
+        rows = []
+        for type_index, (object_type, objects) in enumerate(self.items()):
+            attributes_of_type = special_attributes.get(object_type, [])
+            for object_id, obj in objects.items():
+                data = obj._data
+                if isinstance(data, CompactData):
+                    # pickled by CompactData.__reduce__
+                    layout, values = -1, data
+                else:
+                    keys = tuple(data)
+                    if keys not in layouts:
+                        layouts[keys] = len(layouts)
+                    layout, values = layouts[keys], tuple(data.values())
+                links = []
+                for attr in link_attributes:
+                    linked = getattr(obj, attr, False)
+                    if linked is False:
+                        links.append(-2)
+                    elif linked is None:
+                        links.append(-1)
+                    else:
+                        # an object which is not in the registry is not kept
+                        links.append(positions.get(id(linked), -1))
+                attributes = {attr: getattr(obj, attr) for attr in attributes_of_type if hasattr(obj, attr)}
+                attributes.update(getattr(obj, "__dict__", {}))
+                rows.append((type_index, object_id, layout, values, getattr(obj, "processed", False), tuple(links),
+                             attributes))
+        return {"layouts": list(layouts), "types": types, "rows": rows}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        rebuild a registry from get_state
+        """
+        registry = cls()
+        layouts = state["layouts"]
+        types = state["types"]
+        classes = [CreateObject.object_type2class.get(object_type, RedditObjectBase) for object_type in types]
+        records = [registry.setdefault(object_type, {}) for object_type in types]
+        all_objects = []
+        for type_index, object_id, layout, values, processed, links, attributes in state["rows"]:
+            object_class = classes[type_index]
+            obj = object_class.__new__(object_class)
+            obj._data = values if layout < 0 else dict(zip(layouts[layout], values))
+            obj.processed = processed
+            obj._registry = registry
+            obj._record = records[type_index]
+            records[type_index][object_id] = obj
+            all_objects.append(obj)
+        for obj, row in zip(all_objects, state["rows"]):
+            for attr, link in zip(link_attributes, row[5]):
+                if link >= 0:
+                    setattr(obj, attr, all_objects[link])
+                elif link == -1:
+                    setattr(obj, attr, None)
+            for attr, value in row[6].items():
+                setattr(obj, attr, value)
+        return registry
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        rebuild a registry from its pickled state (see __reduce__), without the garbage collector (see _pause_gc)
+        """
+        with _pause_gc():
+            return cls.from_state(pickle.loads(data))
+
+    def __reduce__(self):
+        # the state is pickled on its own, so it is unpickled in one go by from_bytes, without the garbage collector
+        with _pause_gc():
+            return self.__class__.from_bytes, (pickle.dumps(self.get_state(), protocol=pickle.HIGHEST_PROTOCOL),)
+
+    def save_snapshot(self, path):
+        """
+        save all the objects to a binary snapshot file: the flat state (see get_state) written by pickle in one go,
+        compressed with zstandard if path ends with .zst
+        """
+        with _pause_gc():
+            snapshot = {"format": snapshot_format, "version": snapshot_version, "state": self.get_state()}
+            with _open_snapshot(path, "wb") as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """
+        load a registry from a snapshot of save_snapshot. It is a pickle, only load the snapshots you trust
+        """
+        with _pause_gc():
+            with _open_snapshot(path, "rb") as f:
+                snapshot = pickle.load(f)
+            if not isinstance(snapshot, dict) or snapshot.get("format") != snapshot_format:
+                raise ValueError(f"{path} is not a snapshot of reddit objects")
+            if snapshot["version"] > snapshot_version:
+                raise ValueError(f"Snapshot version {snapshot['version']} of {path} is not supported")
+            return cls.from_state(snapshot["state"])
+
+
+snapshot_format = "reddit_object.Registry"
+snapshot_version = 1
+
+
+@contextmanager
+def _pause_gc():
+    """
+    disable the garbage collector while building or saving millions of objects, it would traverse them again and again
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _open_snapshot(path, mode):
+    if not str(path).endswith(".zst"):
+        return open(path, mode)
+    import zstandard
+    if mode == "wb":
+        return zstandard.ZstdCompressor(threads=-1).stream_writer(open(path, "wb"))
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+
+
+def merge_objects(existing, obj, disjoint=False):
+    """
+    merge obj (the same object from another registry) into existing, see Registry.merge
+    :param disjoint: join the id lists without looking for duplicates
+    """
+    data = existing._data
+    for key, value in obj._data.items():
+        current = data.get(key)
+        if current is None:
+            data[key] = value
+        elif current is value:
+            continue
+        elif key in merged_list_keys and isinstance(value, list):
+            if disjoint:
+                current.extend(value)
+            else:
+                known = set(current)
+                current.extend(item_id for item_id in value if item_id not in known)
+        elif key == "activity":
+            if disjoint:
+                current.extend(value)
+            else:
+                known = set(tuple(item) for item in current)
+                current.extend(item for item in value if tuple(item) not in known)
+        elif key == "no_follow" and isinstance(value, dict) and isinstance(current, dict):
+            for sub_key, ids in value.items():
+                if disjoint:
+                    current.setdefault(sub_key, []).extend(ids)
+                    continue
+                known = set(current.setdefault(sub_key, []))
+                current[sub_key].extend(item_id for item_id in ids if item_id not in known)
+    for attr in link_attributes + special_attributes.get(existing.object_type, []):
+        slot = object_slots[attr]
+        value = slot_value(slot, obj)
+        if value is not None and slot_value(slot, existing) is None:
+            slot.__set__(existing, value)
+    existing.processed = getattr(existing, "processed", False) or getattr(obj, "processed", False)
+
+
+record = Registry()
+
+# the loaders of the default registry, see Registry
+record_loaders = record.loaders
 
 prefix_map_id2type = {
     "t1_": "comment",
@@ -16,6 +330,9 @@ prefix_map_id2type = {
 
 prefix_map_type2id = {v: k for k, v in prefix_map_id2type.items()}
 
+# prefixes of the parent_id of a comment: a comment or the submission
+parent_prefixes = (prefix_map_type2id["comment"], prefix_map_type2id["submission"])
+
 special_objects = {
     "submission": ["_submission", "_author", "_subreddit", "_comment_tree"],
     "comment": ["_submission", "_author", "_subreddit", "_comment_tree", "_parent"],
@@ -59,12 +376,498 @@ default_attributes_values = {
 }
 
 
+# use CompactData instead of dict for the _data of the new objects, see use_compact_data
+compact_data = False
+
+# the keys stored in the slots of CompactData for every object type, the others are in the overflow
+compact_fields = {
+    "reddit_object": ["id", "id_36", "fullname"],
+    "submission": ["id", "id_36", "fullname", "author", "author_id", "author_id_36", "author_fullname", "subreddit",
+                   "subreddit_id", "subreddit_id_36", "subreddit_fullname", "created_utc", "score", "title", "selftext",
+                   "body", "num_comments", "no_follow", "comments_id", "comments_total_id"],
+    "comment": ["id", "id_36", "fullname", "author", "author_id", "author_id_36", "author_fullname", "subreddit",
+                "subreddit_id", "subreddit_id_36", "subreddit_fullname", "created_utc", "score", "body", "link_id",
+                "link_id_36", "link_id_fullname", "parent_id", "parent_id_36", "parent_id_fullname", "comments_id",
+                "comments_total_id"],
+    "redditor": ["id", "id_36", "fullname", "name", "submissions_id", "comments_id", "activity", "no_follow"],
+    "subreddit": ["id", "id_36", "fullname", "name", "submissions_id", "comments_id"],
+    "comment_tree": ["id", "id_36", "fullname", "submission_id", "submission_id_36", "submission_fullname",
+                     "parent_id", "parent_id_36", "parent_id_fullname", "comments_id", "comments_total_id"],
+}
+
+# the short str values of these keys are unique to an object, the other short str values are interned
+compact_unique_keys = {"id", "id_36", "fullname", "body", "title", "selftext", "permalink", "url"}
+
+class _Missing:
+    """
+    marker of a missing key of CompactData, pickled as a reference to _missing
+    """
+
+    def __reduce__(self):
+        return "_missing"
+
+    def __repr__(self):
+        return "<missing>"
+
+
+_missing = _Missing()
+
+
+class _Empty:
+    """
+    marker of an empty list or dict value among the shared constants of CompactData: every object gets its own empty
+    container when the key is first read (so it can be changed in place), pickled as a reference to the marker
+    """
+
+    def __init__(self, factory, name):
+        self.factory = factory
+        self.name = name
+
+    def __reduce__(self):
+        return self.name
+
+    def __repr__(self):
+        return f"<empty {self.factory.__name__}>"
+
+
+_empty_list = _Empty(list, "_empty_list")
+_empty_dict = _Empty(dict, "_empty_dict")
+_empty_markers = {list: _empty_list, dict: _empty_dict}
+
+
+class _Derived:
+    """
+    marker of a value of CompactData computed from its int id when it is read (the id_36 and fullname strings, which
+    the objects have for every id), pickled as a reference to the marker
+    """
+
+    def __init__(self, compute, name):
+        self.compute = compute
+        self.name = name
+
+    def __reduce__(self):
+        return self.name
+
+    def __repr__(self):
+        return f"<derived {self.name}>"
+
+
+_derived_id_36 = _Derived(lambda data: id_codec.encode36(data["id"]), "_derived_id_36")
+_derived_fullname = _Derived(lambda data: prefix_map_type2id[data.object_type] + id_codec.encode36(data["id"]),
+                             "_derived_fullname")
+
+# shared read-only dicts of the constant (None, bool, 0, "", and empty list or dict) values of the overflow keys, most
+# objects have the same
+_compact_constants = {(): {}}
+
+# shared key -> position dicts of the other overflow keys (the values are in a list per object)
+_compact_layouts = {(): {}}
+
+# the layouts and constants seen once: they are shared from the second object which has them on, so the key sets which
+# do not recur (e.g. the flair_text_<id> keys of the redditors) are kept in the object instead of a shared dict
+_compact_candidates = set()
+
+# maximum number of shared layouts and constants dicts (and of candidates, cleared when full)
+compact_shared_limit = 4096
+
+
+def _compact_shared(cache, keys, make):
+    """
+    the shared dict of keys in cache, made by make(keys) when keys is seen the second time
+    :return: the shared dict, None when keys is not shared (yet)
+    """
+    shared = cache.get(keys)
+    if shared is not None or len(cache) >= compact_shared_limit:
+        return shared
+    candidate = (id(cache), keys)
+    if candidate in _compact_candidates:
+        _compact_candidates.discard(candidate)
+        shared = cache[keys] = make(keys)
+        return shared
+    if len(_compact_candidates) >= compact_shared_limit:
+        _compact_candidates.clear()
+    _compact_candidates.add(candidate)
+    return None
+
+
+def _compact_layout(keys):
+    return _compact_shared(_compact_layouts, tuple(keys), lambda layout: {key: idx for idx, key in enumerate(layout)})
+
+
+def _compact_constant_values(constants):
+    return _compact_shared(_compact_constants, tuple(constants), dict)
+
+
+def use_compact_data(enable=True):
+    """
+    build the new objects of all the registries with CompactData instead of dict for _data (see CompactData), for the
+    objects of one registry use Registry(compact=True)
+    """
+    global compact_data
+    compact_data = enable
+
+
+class CompactData(MutableMapping):
+    """
+    A compact replacement of the _data dict of an object.
+    The core keys of the object type (compact_fields) are stored in __slots__. The other keys with a constant value
+    (None, True, False, 0, "", or an empty list or dict, made for the object when it is read) are kept in a dict shared
+    by all the objects with the same constant keys and values,
+    and the remaining keys are in an overflow list whose key positions are shared by the objects with the same keys.
+    The keys added after the object is made, and the key sets which are not shared by other objects, are in a dict of
+    the object (_extra). Short str values (names, flairs, types...) are interned, and id_36 and fullname are computed
+    from the int id when they are read instead of kept (when they are the ones of the id).
+    It works as a dict (obj["key"], get, update, in, iteration, len); use to_dict for a real dict, e.g. for json.
+    """
+    __slots__ = ("_layout", "_values", "_constants", "_extra")
+    object_type = "reddit_object"
+    fields = ()
+    field_set = frozenset()
+    _field_values = staticmethod(lambda obj: ())
+
+    def __init__(self, data=None):
+        for field in self.fields:
+            object.__setattr__(self, field, _missing)
+        self._layout = _compact_layouts[()]
+        self._values = None
+        self._constants = _compact_constants[()]
+        self._extra = None
+        if data:
+            self.update(data)
+
+    @staticmethod
+    def _intern(key, value):
+        if type(value) is str and len(value) <= 32 and key not in compact_unique_keys:
+            return sys.intern(value)
+        return value
+
+    @classmethod
+    def from_dict(cls, data):
+        obj = cls.__new__(cls)
+        field_set = cls.field_set
+        set_field = object.__setattr__
+        intern = sys.intern
+        for field in cls.fields:
+            set_field(obj, field, _missing)
+        extra_keys = []
+        extra_values = []
+        constants = []
+        for key, value in data.items():
+            value_type = type(value)
+            if value_type is str and len(value) <= 32 and key not in compact_unique_keys:
+                value = intern(value)
+            if key in field_set:
+                set_field(obj, key, value)
+            elif value is None or value is True or value is False or (value_type in (int, str) and not value):
+                constants.append((key, value))
+            elif value_type in _empty_markers and not value:
+                constants.append((key, _empty_markers[value_type]))
+            else:
+                extra_keys.append(key)
+                extra_values.append(value)
+        obj._set_overflow(extra_keys, extra_values, constants)
+        object_id = obj.id if "id" in field_set else None
+        if type(object_id) is int and object_id >= 0 and "id_36" in field_set:
+            id_36 = id_codec.encode36(object_id)
+            if obj.id_36 == id_36:
+                set_field(obj, "id_36", _derived_id_36)
+            prefix = prefix_map_type2id.get(cls.object_type)
+            if prefix is not None and "fullname" in field_set and obj.fullname == prefix + id_36:
+                set_field(obj, "fullname", _derived_fullname)
+        return obj
+
+    def _set_overflow(self, keys, values, constants):
+        """
+        store the overflow keys and the constants in the shared dicts, or in _extra when they are not shared
+        """
+        self._extra = None
+        shared_constants = _compact_constant_values(constants) if constants else _compact_constants[()]
+        if shared_constants is None:
+            self._constants = _compact_constants[()]
+            self._extra = dict(constants)
+        else:
+            self._constants = shared_constants
+        layout = _compact_layout(keys) if keys else _compact_layouts[()]
+        if layout is None:
+            self._layout = _compact_layouts[()]
+            self._values = None
+            if self._extra is None:
+                self._extra = {}
+            self._extra.update(zip(keys, values))
+        else:
+            self._layout = layout
+            self._values = list(values) if values else None
+
+    def _lookup(self, key):
+        """
+        the stored value of a key (_missing, or an _Empty marker for a shared empty container)
+        """
+        if key in self.field_set:
+            return object.__getattribute__(self, key)
+        if key in self._layout:
+            return self._values[self._layout[key]]
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        return self._constants.get(key, _missing)
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            value = object.__getattribute__(self, key)
+        elif key in self._layout:
+            value = self._values[self._layout[key]]
+        elif self._extra is not None and key in self._extra:
+            value = self._extra[key]
+        else:
+            value = self._constants.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        value_type = type(value)
+        if value_type is _Empty:
+            # the empty container of this object from now on
+            value = value.factory()
+            self[key] = value
+        elif value_type is _Derived:
+            return value.compute(self)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _missing
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            object.__setattr__(self, key, value)
+        elif key in self._layout:
+            self._values[self._layout[key]] = value
+        else:
+            # a new key is kept in the object, it hides the shared constant if there is one
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def update(self, other=(), **kwargs):
+        # the update of MutableMapping checks the type of other and looks every key up again in it
+        setitem = self.__setitem__
+        for key, value in (other.items() if hasattr(other, "items") else other):
+            setitem(key, value)
+        for key, value in kwargs.items():
+            setitem(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.field_set:
+            object.__setattr__(self, key, _missing)
+        else:
+            self[key] = _missing
+
+    def __iter__(self):
+        for field in self.fields:
+            if object.__getattribute__(self, field) is not _missing:
+                yield field
+        for key, idx in self._layout.items():
+            if self._values[idx] is not _missing:
+                yield key
+        extra = self._extra or {}
+        for key, value in extra.items():
+            if value is not _missing and key not in self._layout:
+                yield key
+        for key in self._constants:
+            if key not in self._layout and key not in extra:
+                yield key
+
+    def __len__(self):
+        # the same count as __iter__, without going through the keys one by one
+        count = len(self.fields) - self._field_values(self).count(_missing)
+        if self._values:
+            count += len(self._values) - self._values.count(_missing)
+        extra = self._extra
+        if extra:
+            count += len(extra) - list(extra.values()).count(_missing) + len(self._constants.keys() - extra.keys())
+        else:
+            count += len(self._constants)
+        return count
+
+    def to_dict(self):
+        data = {}
+        for key in self:
+            value = self._lookup(key)
+            if type(value) is _Empty:
+                value = value.factory()
+            elif type(value) is _Derived:
+                value = value.compute(self)
+            data[key] = value
+        return data
+
+    def __reduce__(self):
+        # the layout and constants dicts are shared between the objects, so pickled once
+        field_values = tuple(object.__getattribute__(self, field) for field in self.fields)
+        return compact_from_state, (self.object_type, field_values, self._layout, self._values, self._constants,
+                                    self._extra)
+
+    def __deepcopy__(self, memo):
+        return self.__class__.from_dict(copy.deepcopy(self.to_dict(), memo))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.to_dict()!r})"
+
+
+def _field_getter(fields):
+    """
+    function of a CompactData returning the tuple of the values of its fields
+    """
+    getter = operator.attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda obj: (getter(obj),)
+    return getter
+
+
+compact_data_types = {
+    object_type: type(f"Compact{''.join(part.title() for part in object_type.split('_'))}Data", (CompactData,),
+                      {"__slots__": tuple(fields), "object_type": object_type, "fields": tuple(fields),
+                       "field_set": frozenset(fields), "_field_values": staticmethod(_field_getter(fields)),
+                       "__module__": __name__})
+    for object_type, fields in compact_fields.items()}
+
+
+def compact_from_dict(object_type, data):
+    """
+    CompactData of an object type from a dict
+    """
+    return compact_data_types[object_type].from_dict(data)
+
+
+def compact_from_state(object_type, field_values, layout, values, constants, extra=None):
+    """
+    CompactData of an object type from the pickled state of CompactData.__reduce__
+    """
+    compact_type = compact_data_types[object_type]
+    obj = compact_type.__new__(compact_type)
+    for field, value in zip(compact_type.fields, field_values):
+        object.__setattr__(obj, field, value)
+    obj._set_overflow(list(layout), [values[idx] for idx in layout.values()] if layout else [],
+                      list(constants.items()))
+    if extra:
+        if obj._extra is None:
+            obj._extra = {}
+        obj._extra.update(extra)
+    return obj
+
+
+class ActivityTimeline(list):
+    """
+    The activity of a redditor, a list of (created_utc, id, object type) sorted by time (stable, the items with the same
+    time are in the order they were added).
+    An append in time order keeps the list sorted, the others only mark it as unsorted and the list is sorted once when
+    it is read, so building the timeline is O(n log n) instead of a sort on every append.
+    """
+    __slots__ = ("is_sorted",)
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.is_sorted = False
+        self.ensure_sorted()
+
+    def append(self, item):
+        if self.is_sorted and list.__len__(self) and list.__getitem__(self, -1)[0] > item[0]:
+            self.is_sorted = False
+        list.append(self, item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self.is_sorted = False
+
+    def ensure_sorted(self):
+        if not self.is_sorted:
+            list.sort(self, key=lambda x: x[0])
+            self.is_sorted = True
+        return self
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.is_sorted = not args and not kwargs
+
+    def __iter__(self):
+        return list.__iter__(self.ensure_sorted())
+
+    def __reversed__(self):
+        return list.__reversed__(self.ensure_sorted())
+
+    def __getitem__(self, item):
+        return list.__getitem__(self.ensure_sorted(), item)
+
+    def __setitem__(self, key, value):
+        list.__setitem__(self, key, value)
+        self.is_sorted = False
+
+    def __eq__(self, other):
+        return list.__eq__(self.ensure_sorted(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return list.__repr__(self.ensure_sorted())
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def copy(self):
+        return self.__class__(list(self))
+
+    def index(self, *args):
+        return list.index(self.ensure_sorted(), *args)
+
+    def bisect(self, created_utc, right=False):
+        """
+        position of created_utc in the sorted timeline (before the items with the same time, after them if right)
+        """
+        self.ensure_sorted()
+        low, high = 0, list.__len__(self)
+        while low < high:
+            middle = (low + high) // 2
+            middle_time = list.__getitem__(self, middle)[0]
+            if middle_time < created_utc or (right and middle_time == created_utc):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def between(self, start=None, end=None, object_type=None):
+        """
+        the activity with start <= created_utc <= end, by binary search
+        :param start: start time, None for no bound
+        :param end: end time, None for no bound
+        :param object_type: only this type (submission or comment), None for all
+        :return: list of (created_utc, id, object type)
+        """
+        begin = 0 if start is None else self.bisect(start)
+        stop = list.__len__(self) if end is None else self.bisect(end, right=True)
+        items = list.__getitem__(self.ensure_sorted(), slice(begin, stop))
+        if object_type is not None:
+            items = [item for item in items if item[2] == object_type]
+        return items
+
+
 class RedditObjectBase:
     object_type = "reddit_object"
 
     record[object_type] = {}
 
-    def __init__(self, object_dict, use_record=True, enforce_id=False):
+    # the relationships and arguments of all the object types, the other attributes go to __dict__
+    __slots__ = ("_data", "processed", "_registry", "_record", "_submission", "_author", "_subreddit", "_comment_tree",
+                 "_parent", "_head", "_author_args", "_subreddit_args", "__dict__", "__weakref__")
+
+    def __init__(self, object_dict, use_record=True, enforce_id=False, registry=None):
         self._data = object_dict
 
         if "id" not in self._data:
@@ -73,9 +876,10 @@ class RedditObjectBase:
             print(f"Warning, this {self.object_type} does not have id")
 
         self.processed = False
+        self._registry = record if registry is None else registry
 
         if use_record and "id" in self._data:
-            self._record = record[self.object_type]
+            self._record = self._registry[self.object_type]
             try:
                 self.process_id()
             except NotImplementedError:
@@ -104,9 +908,10 @@ class RedditObjectBase:
         return data
 
     @classmethod
-    def load(cls, data, depth=0):
-        if "id" in data["_data"] and data["_data"]["id"] in record[data["tag"]]:
-            obj = record[data["tag"]][data["id"]]
+    def load(cls, data, depth=0, registry=None):
+        registry = record if registry is None else registry
+        if "id" in data["_data"] and data["_data"]["id"] in registry[data["tag"]]:
+            obj = registry[data["tag"]][data["id"]]
             if len(data["_data"]) > 1:
                 obj._data.update(data["_data"])
             if len(data) > 2:
@@ -115,11 +920,12 @@ class RedditObjectBase:
                 if depth is None:
                     for special_object in special_objects[obj.object_type]:
                         setattr(obj, special_object,
-                                getattr(obj, special_object).load(data[special_object], depth=None))
+                                getattr(obj, special_object).load(data[special_object], depth=None, registry=registry))
                 elif depth > 0:
                     for special_object in special_objects[obj.object_type]:
                         setattr(obj, special_object,
-                                getattr(obj, special_object).load(data[special_object], depth=depth - 1))
+                                getattr(obj, special_object).load(data[special_object], depth=depth - 1,
+                                                                  registry=registry))
             obj.processed = True
             return obj
         obj = cls.__new__(cls) if data["tag"] == cls.object_type else RedditObjectBase.__new__(
@@ -130,19 +936,43 @@ class RedditObjectBase:
             setattr(obj, attr, data[attr])
         if depth is None:
             for special_object in special_objects[obj.object_type]:
-                setattr(obj, special_object, getattr(obj, special_object).load(data[special_object], depth=None))
+                setattr(obj, special_object,
+                        getattr(obj, special_object).load(data[special_object], depth=None, registry=registry))
         elif depth > 0:
             for special_object in special_objects[obj.object_type]:
-                setattr(obj, special_object, getattr(obj, special_object).load(data[special_object], depth=depth - 1))
+                setattr(obj, special_object,
+                        getattr(obj, special_object).load(data[special_object], depth=depth - 1, registry=registry))
         obj.processed = True
-        obj._record = record[obj.object_type]
+        obj._registry = registry
+        obj._record = registry[obj.object_type]
         obj._record[obj._data["id"]] = obj
         return obj
 
     def process_id(self):
         raise NotImplementedError
 
+    def process_object_id(self):
+        """
+        id (int), id_36 and fullname of the object from its id (int, base 36 id or fullname), a fullname already there
+        is kept when the id is a fullname
+        :return: False if there is no id to process
+        """
+        object_id = self._data.get("id")
+        if not object_id or not isinstance(object_id, (str, int)):
+            return False
+        prefix = prefix_map_type2id[self.object_type]
+        object_id, id_36, fullname = id_codec.split_id(object_id, prefix)
+        if not self._data.get("fullname") or not isinstance(self._data["id"], str) or \
+                not self._data["id"].startswith(prefix):
+            self._data["fullname"] = fullname
+        self._data["id_36"] = id_36
+        self._data["id"] = object_id
+        return True
+
     def __getattr__(self, item):
+        if item == "_data":
+            # not initialized yet (e.g. while unpickling)
+            raise AttributeError(item)
         if item in self._data:
             return self._data[item]
         else:
@@ -177,13 +1007,29 @@ class RedditObjectBase:
         return False
 
 
+# the slot descriptors of the link attributes and arguments, read without the __getattr__ fallback of an unset slot
+object_slots = {attr: RedditObjectBase.__dict__[attr] for attr in link_attributes + ["_author_args", "_subreddit_args"]}
+
+
+def slot_value(slot, obj):
+    """
+    value of a slot (see object_slots) of obj, None when it is not set
+    """
+    try:
+        return slot.__get__(obj)
+    except AttributeError:
+        return None
+
+
 class Submission(RedditObjectBase):
     object_type = "submission"
 
     record[object_type] = {}
 
-    def __init__(self, submission_dict):
-        super().__init__(submission_dict)
+    __slots__ = ()
+
+    def __init__(self, submission_dict, registry=None):
+        super().__init__(submission_dict, registry=registry)
         self._submission = self
 
         if not self.processed:
@@ -200,12 +1046,11 @@ class Submission(RedditObjectBase):
                 self._author_args = None
                 self._data["author_id"], self._data["author_id_36"], self._data["author_fullname"] = None, None, None
         try:
-            self._author = create_redditor(self._author_args)
+            self._author = create_redditor(self._author_args, self._registry)
 
             if not self.processed:
                 self._author._data["submissions_id"].append(self._data["id"])
                 self._author._data["activity"].append((self._data["created_utc"], self._data["id"], self.object_type))
-                self._author._data["activity"].sort(key=lambda x: x[0])
                 self._author._data["no_follow"]["submissions"].append(self._data["id"]) \
                     if "no_follow" in self._data and self._data["no_follow"] else None
 
@@ -230,7 +1075,7 @@ class Submission(RedditObjectBase):
                 self._data["subreddit_id"], self._data["subreddit_id_36"], self._data[
                     "subreddit_fullname"] = None, None, None
         try:
-            self._subreddit = create_subreddit(self._subreddit_args)
+            self._subreddit = create_subreddit(self._subreddit_args, self._registry)
             if not self.processed:
                 self._subreddit._data["submissions_id"].append(self._data["id"])
         except ValueError:
@@ -273,64 +1118,21 @@ class Submission(RedditObjectBase):
                                                       "id_36": self._data["id_36"],
                                                       "fullname": self._data["fullname"],
                                                       "comments_id": self._data["comments_id"],
-                                                      "comments_total_id": self._data["comments_total_id"]})
+                                                      "comments_total_id": self._data["comments_total_id"]},
+                                                     self._registry)
         except ValueError:
             self._comment_tree = None
 
     def process_id(self):
-        if self._data.get("id") and isinstance(self._data["id"], str):
-            if self._data["id"].startswith(prefix_map_type2id[self.object_type]):
-                if not self._data.get("fullname"):
-                    self._data["fullname"] = self._data["id"]
-                self._data["id_36"] = self._data["id"][3:]
-                self._data["id"] = int(self._data["id"][3:], 36)
-            else:
-                self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id']}"
-                self._data["id_36"] = self._data["id"]
-                self._data["id"] = int(self._data["id"], 36)
-        elif self._data.get("id") and isinstance(self._data["id"], int):
-            self._data["id_36"] = int2base(self._data["id"], 36)
-            self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id_36']}"
+        self.process_object_id()
 
     @staticmethod
     def process_author_id(author_id):
-        if isinstance(author_id, str):
-            if author_id.startswith(prefix_map_type2id["redditor"]):
-                author_id_36 = author_id[3:]
-                author_id_int = int(author_id[3:], 36)
-                author_fullname = author_id
-            else:
-                author_id_36 = author_id
-                author_id_int = int(author_id, 36)
-                author_fullname = f"{prefix_map_type2id['redditor']}{author_id}"
-        elif isinstance(author_id, int):
-            author_id_36 = int2base(author_id, 36)
-            author_id_int = author_id
-            author_fullname = f"{prefix_map_type2id['redditor']}{author_id_36}"
-        else:
-            raise ValueError("author_id must be str or int")
-
-        return author_id_int, author_id_36, author_fullname
+        return id_codec.split_hot_id(author_id, prefix_map_type2id["redditor"])
 
     @staticmethod
     def process_subreddit_id(subreddit_id):
-        if isinstance(subreddit_id, str):
-            if subreddit_id.startswith(prefix_map_type2id["subreddit"]):
-                subreddit_id_36 = subreddit_id[3:]
-                subreddit_id_int = int(subreddit_id[3:], 36)
-                subreddit_fullname = subreddit_id
-            else:
-                subreddit_id_36 = subreddit_id
-                subreddit_id_int = int(subreddit_id, 36)
-                subreddit_fullname = f"{prefix_map_type2id['subreddit']}{subreddit_id}"
-        elif isinstance(subreddit_id, int):
-            subreddit_id_36 = int2base(subreddit_id, 36)
-            subreddit_id_int = subreddit_id
-            subreddit_fullname = f"{prefix_map_type2id['subreddit']}{subreddit_id_36}"
-        else:
-            raise ValueError("subreddit_id must be str or int")
-
-        return subreddit_id_int, subreddit_id_36, subreddit_fullname
+        return id_codec.split_hot_id(subreddit_id, prefix_map_type2id["subreddit"])
 
     def process_author_args(self):
         author_args = {}
@@ -395,8 +1197,10 @@ class Comment(RedditObjectBase):
 
     record[object_type] = {}
 
-    def __init__(self, comment_dict):
-        super().__init__(comment_dict)
+    __slots__ = ()
+
+    def __init__(self, comment_dict, registry=None):
+        super().__init__(comment_dict, registry=registry)
         if not self.processed:
             try:
                 if not self._data.get("link_id"):
@@ -407,11 +1211,11 @@ class Comment(RedditObjectBase):
                     self._data["link_id"]
                 )
 
-                if record["submission"].get(self._data["link_id"]):
-                    self._submission = record["submission"][self._data["link_id"]]
+                if self._registry["submission"].get(self._data["link_id"]):
+                    self._submission = self._registry["submission"][self._data["link_id"]]
                 else:
                     try:
-                        self._submission = create_submission({"id": self._data["link_id"]})
+                        self._submission = create_submission({"id": self._data["link_id"]}, self._registry)
                     except ValueError:
                         self._submission = None
 
@@ -419,7 +1223,7 @@ class Comment(RedditObjectBase):
                 self._submission = None
         else:
             try:
-                self._submission = create_submission({"id": self._data["link_id"]})
+                self._submission = create_submission({"id": self._data["link_id"]}, self._registry)
             except ValueError:
                 self._submission = None
             except KeyError:
@@ -441,11 +1245,10 @@ class Comment(RedditObjectBase):
                 self._data["author_id"], self._data["author_id_36"], self._data["author_fullname"] = None, None, None
 
         try:
-            self._author = create_redditor(self._author_args)
+            self._author = create_redditor(self._author_args, self._registry)
             if not self.processed:
                 self._author._data["comments_id"].append(self._data["id"])
                 self._author._data["activity"].append((self._data["created_utc"], self._data["id"], self.object_type))
-                self._author._data["activity"].sort(key=lambda x: x[0])
                 if self._data.get("no_follow"):
                     self._author._data["no_follow"]['comments'].append(self._data["id"])
         except ValueError:
@@ -475,7 +1278,7 @@ class Comment(RedditObjectBase):
                     "subreddit_fullname"] = None, None, None
 
         try:
-            self._subreddit = create_subreddit(self._subreddit_args)
+            self._subreddit = create_subreddit(self._subreddit_args, self._registry)
             if not self.processed:
                 self._subreddit._data["comments_id"].append(self._data["id"])
         except ValueError:
@@ -522,7 +1325,7 @@ class Comment(RedditObjectBase):
             self._parent = self._submission
         else:
             try:
-                self._parent = create_comment({"id": self._data["parent_id"]})
+                self._parent = create_comment({"id": self._data["parent_id"]}, self._registry)
                 if not self.processed:
                     self._parent._data["comments_id"].append(self._data["id"])
                     self._parent._data["comments_total_id"].append(self._data["id"])
@@ -547,7 +1350,7 @@ class Comment(RedditObjectBase):
                 "parent_id_fullname": self._data["parent_id_fullname"],
                 "comments_id": self._data["comments_id"],
                 "comments_total_id": self._data["comments_total_id"],
-            })
+            }, self._registry)
         except ValueError:
             self._comment_tree = None
 
@@ -556,82 +1359,19 @@ class Comment(RedditObjectBase):
 
     @staticmethod
     def process_submission_id(submission_id):
-        if isinstance(submission_id, str):
-            if submission_id.startswith("t3_"):
-                submission_id_36 = submission_id[3:]
-                submission_id_int = int(submission_id[3:], 36)
-                submission_fullname = submission_id
-            else:
-                submission_id_36 = submission_id
-                submission_id_int = int(submission_id, 36)
-                submission_fullname = f"{prefix_map_type2id['submission']}{submission_id}"
-        elif isinstance(submission_id, int):
-            submission_id_36 = int2base(submission_id, 36)
-            submission_id_int = submission_id
-            submission_fullname = f"{prefix_map_type2id['submission']}{submission_id_36}"
-        else:
-            raise ValueError("submission_id must be str or int")
-
-        return submission_id_int, submission_id_36, submission_fullname
+        return id_codec.split_hot_id(submission_id, prefix_map_type2id["submission"])
 
     def process_id(self):
-        if self._data.get("id") and isinstance(self._data["id"], str):
-            if self._data["id"].startswith(prefix_map_type2id[self.object_type]):
-                if not self._data.get("fullname"):
-                    self._data["fullname"] = self._data["id"]
-                self._data["id_36"] = self._data["id"][3:]
-                self._data["id"] = int(self._data["id"][3:], 36)
-            else:
-                self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id']}"
-                self._data["id_36"] = self._data["id"]
-                self._data["id"] = int(self._data["id"], 36)
-        elif self._data.get("id") and isinstance(self._data["id"], int):
-            self._data["id_36"] = int2base(self._data["id"], 36)
-            self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id_36']}"
-
-        else:
+        if not self.process_object_id():
             raise ValueError("id must be str or int")
 
     @staticmethod
     def process_parent_id(parent_id):
-        if isinstance(parent_id, str):
-            if parent_id.startswith(prefix_map_type2id["comment"]) or parent_id.startswith(
-                    prefix_map_type2id["submission"]):
-                parent_id_36 = parent_id[3:]
-                parent_id_int = int(parent_id[3:], 36)
-                parent_fullname = parent_id
-            else:
-                parent_id_36 = parent_id
-                parent_id_int = int(parent_id, 36)
-                parent_fullname = f"{prefix_map_type2id['comment']}{parent_id}"
-        elif isinstance(parent_id, int):
-            parent_id_36 = int2base(parent_id, 36)
-            parent_id_int = parent_id
-            parent_fullname = f"{prefix_map_type2id['comment']}{parent_id_36}"
-        else:
-            raise ValueError("parent_id must be str or int")
-
-        return parent_id_int, parent_id_36, parent_fullname
+        return id_codec.split_hot_id(parent_id, prefix_map_type2id["comment"], parent_prefixes)
 
     @staticmethod
     def process_author_id(author_id):
-        if isinstance(author_id, str):
-            if author_id.startswith(prefix_map_type2id["redditor"]):
-                author_id_36 = author_id[3:]
-                author_id_int = int(author_id[3:], 36)
-                author_fullname = author_id
-            else:
-                author_id_36 = author_id
-                author_id_int = int(author_id, 36)
-                author_fullname = f"{prefix_map_type2id['redditor']}{author_id}"
-        elif isinstance(author_id, int):
-            author_id_36 = int2base(author_id, 36)
-            author_id_int = author_id
-            author_fullname = f"{prefix_map_type2id['redditor']}{author_id_36}"
-        else:
-            raise ValueError("author_id must be str or int")
-
-        return author_id_int, author_id_36, author_fullname
+        return id_codec.split_hot_id(author_id, prefix_map_type2id["redditor"])
 
     def process_author_args(self):
         author_args = {}
@@ -668,23 +1408,7 @@ class Comment(RedditObjectBase):
 
     @staticmethod
     def process_subreddit_id(subreddit_id):
-        if isinstance(subreddit_id, str):
-            if subreddit_id.startswith(prefix_map_type2id["subreddit"]):
-                subreddit_id_36 = subreddit_id[3:]
-                subreddit_id_int = int(subreddit_id[3:], 36)
-                subreddit_fullname = subreddit_id
-            else:
-                subreddit_id_36 = subreddit_id
-                subreddit_id_int = int(subreddit_id, 36)
-                subreddit_fullname = f"{prefix_map_type2id['subreddit']}{subreddit_id}"
-        elif isinstance(subreddit_id, int):
-            subreddit_id_36 = int2base(subreddit_id, 36)
-            subreddit_id_int = subreddit_id
-            subreddit_fullname = f"{prefix_map_type2id['subreddit']}{subreddit_id_36}"
-        else:
-            raise ValueError("subreddit_id must be str or int")
-
-        return subreddit_id_int, subreddit_id_36, subreddit_fullname
+        return id_codec.split_hot_id(subreddit_id, prefix_map_type2id["subreddit"])
 
     def process_subreddit_args(self):
         subreddit_args = {}
@@ -729,18 +1453,10 @@ class Comment(RedditObjectBase):
 
     def generate_parent_chain(self):
         """
-        Generate parent chain for comment
-        :return:
+        Generate parent chain for comment (and its parent comments), without recursion
+        :return: list of (id, object type) from the submission to the parent
         """
-        if self._parent and self._parent._data["id"] == self._submission._data["id"]:
-            self._data["parent_chain"] = [(self._submission._data["id"], self._submission.object_type)]
-        elif self._parent:
-            self._parent.generate_parent_chain()
-            self._data["parent_chain"] = self._parent._data["parent_chain"] + [
-                (self._parent._data["id"], self._parent.object_type)]
-        else:
-            self._data["parent_chain"] = []
-
+        compute_parent_chains([self], registry=self._registry)
         return self._data["parent_chain"]
 
 
@@ -749,8 +1465,10 @@ class Redditor(RedditObjectBase):
 
     record[object_type] = {}
 
-    def __init__(self, redditor_dict):
-        super().__init__(redditor_dict)
+    __slots__ = ()
+
+    def __init__(self, redditor_dict, registry=None):
+        super().__init__(redditor_dict, registry=registry)
 
         if not self.processed:
 
@@ -764,24 +1482,18 @@ class Redditor(RedditObjectBase):
                 self._data["no_follow"] = {"submissions": [], "comments": []}
 
             if not self._data.get("activity"):
-                self._data["activity"] = []
+                self._data["activity"] = ActivityTimeline()
+            elif not isinstance(self._data["activity"], ActivityTimeline):
+                self._data["activity"] = ActivityTimeline(self._data["activity"])
 
-    def process_id(self):
-        if self._data.get("id") and isinstance(self._data["id"], str):
-            if self._data["id"].startswith(prefix_map_type2id[self.object_type]):
-                if not self._data.get("fullname"):
-                    self._data["fullname"] = self._data["id"]
-                self._data["id_36"] = self._data["id"][3:]
-                self._data["id"] = int(self._data["id"][3:], 36)
-            else:
-                self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id']}"
-                self._data["id_36"] = self._data["id"]
-                self._data["id"] = int(self._data["id"], 36)
-        elif self._data.get("id") and isinstance(self._data["id"], int):
-            self._data["id_36"] = int2base(self._data["id"], 36)
-            self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id_36']}"
+    def activity_between(self, start=None, end=None, object_type=None):
+        """
+        the activity (created_utc, id, object type) with start <= created_utc <= end, see ActivityTimeline.between
+        """
+        return self._data["activity"].between(start, end, object_type)
 
-        else:
+    def process_id(self):
+        if not self.process_object_id():
             raise ValueError("id must be str or int")
 
 
@@ -790,8 +1502,10 @@ class Subreddit(RedditObjectBase):
 
     record[object_type] = {}
 
-    def __init__(self, subreddit_dict):
-        super().__init__(subreddit_dict)
+    __slots__ = ()
+
+    def __init__(self, subreddit_dict, registry=None):
+        super().__init__(subreddit_dict, registry=registry)
 
         if not self.processed:
 
@@ -802,21 +1516,7 @@ class Subreddit(RedditObjectBase):
                 self._data["comments_id"] = []
 
     def process_id(self):
-        if self._data.get("id") and isinstance(self._data["id"], str):
-            if self._data["id"].startswith(prefix_map_type2id[self.object_type]):
-                if not self._data.get("fullname"):
-                    self._data["fullname"] = self._data["id"]
-                self._data["id_36"] = self._data["id"][3:]
-                self._data["id"] = int(self._data["id"][3:], 36)
-            else:
-                self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id']}"
-                self._data["id_36"] = self._data["id"]
-                self._data["id"] = int(self._data["id"], 36)
-        elif self._data.get("id") and isinstance(self._data["id"], int):
-            self._data["id_36"] = int2base(self._data["id"], 36)
-            self._data["fullname"] = f"{prefix_map_type2id[self.object_type]}{self._data['id_36']}"
-
-        else:
+        if not self.process_object_id():
             raise ValueError("id must be str or int")
 
 
@@ -825,41 +1525,45 @@ class CommentTree(RedditObjectBase):
 
     record[object_type] = {}
 
-    def __init__(self, comment_tree_dict):
-        super().__init__(comment_tree_dict)
+    __slots__ = ()
+
+    def __init__(self, comment_tree_dict, registry=None):
+        super().__init__(comment_tree_dict, registry=registry)
+        registry = self._registry
         if not self.processed:
             if not self._data.get("comments_id"):
-                if self._data["id"] in record.get("submission") or self._data["id"] == self._data["submission_id"]:
+                if self._data["id"] in registry.get("submission") or self._data["id"] == self._data["submission_id"]:
                     try:
-                        self._data["comments_id"] = create_submission({"id": self._data["id"]})._data["comments_id"]
+                        self._data["comments_id"] = create_submission({"id": self._data["id"]}, registry)._data[
+                            "comments_id"]
                     except ValueError:
                         self._data["comments_id"] = []
-                elif self._data["id"] in record.get("comment"):
-                    self._data["comments_id"] = record.get("comment")[self._data["id"]]["comments_id"]
+                elif self._data["id"] in registry.get("comment"):
+                    self._data["comments_id"] = registry.get("comment")[self._data["id"]]["comments_id"]
                 else:
                     self._data["comments_id"] = []
             if not self._data.get("comments_total_id"):
-                if self._data["id"] in record.get("submission") or self._data["id"] == self._data["submission_id"]:
+                if self._data["id"] in registry.get("submission") or self._data["id"] == self._data["submission_id"]:
                     try:
-                        self._data["comments_total_id"] = create_submission({"id": self._data["id"]})._data[
+                        self._data["comments_total_id"] = create_submission({"id": self._data["id"]}, registry)._data[
                             "comments_total_id"]
                     except ValueError:
                         self._data["comments_total_id"] = []
-                elif self._data["id"] in record.get("comment"):
-                    self._data["comments_total_id"] = record.get("comment")[self._data["id"]]["comments_total_id"]
+                elif self._data["id"] in registry.get("comment"):
+                    self._data["comments_total_id"] = registry.get("comment")[self._data["id"]]["comments_total_id"]
                 else:
                     self._data["comments_total_id"] = []
 
             if not self._data.get("submission_id"):
-                if self._data["id"] in record.get("submission_id"):
-                    self._data["submission_id"] = record.get("submission_id")[self._data["id"]]
+                if self._data["id"] in registry.get("submission_id"):
+                    self._data["submission_id"] = registry.get("submission_id")[self._data["id"]]
                     try:
-                        self._head = create_submission({"id": self._data["submission_id"]})
+                        self._head = create_submission({"id": self._data["submission_id"]}, registry)
                     except ValueError:
                         self._head = None
                 else:
                     try:
-                        self._head = create_comment({"id": self._data["id"]})
+                        self._head = create_comment({"id": self._data["id"]}, registry)
                         self._data["submission_id"] = self._head._data["submission_id"]
                     except ValueError:
                         self._head = None
@@ -868,17 +1572,17 @@ class CommentTree(RedditObjectBase):
             else:
                 if self._data["submission_id"] == self._data["id"]:
                     try:
-                        self._head = create_submission({"id": self._data["id"]})
+                        self._head = create_submission({"id": self._data["id"]}, registry)
                     except ValueError:
                         self._head = None
                 else:
                     try:
-                        self._head = create_comment({"id": self._data["id"]})
+                        self._head = create_comment({"id": self._data["id"]}, registry)
                     except ValueError:
                         self._head = None
 
             try:
-                self._submission = create_submission({"id": self._data["submission_id"]})
+                self._submission = create_submission({"id": self._data["submission_id"]}, registry)
             except ValueError:
                 self._submission = None
 
@@ -898,74 +1602,82 @@ class CommentTree(RedditObjectBase):
         self._data["comments_id"].append(comment_id)
         self._data["comments_total_id"].append(comment_id)
 
-    def update_attr(self):
+    def update_attr(self, memo=None):
+        """
+        repair the links and the comment ids after all the objects are built
+        :param memo: dict shared between the trees for the descendants of the comments, see collect_descendants
+        """
+        registry = self._registry
         if not self._head:
-            if self._data["id"] in record.get("comment"):
+            if self._data["id"] in registry.get("comment"):
                 try:
-                    self._head = create_comment({"id": self._data["id"]})
+                    self._head = create_comment({"id": self._data["id"]}, registry)
                 except ValueError:
                     self._head = None
-            elif self._data["id"] in record.get("submission"):
+            elif self._data["id"] in registry.get("submission"):
                 try:
-                    self._head = create_submission({"id": self._data["id"]})
+                    self._head = create_submission({"id": self._data["id"]}, registry)
                 except ValueError:
                     self._head = None
             else:
                 self._head = None
         if not self._submission:
             try:
-                self._submission = create_submission({"id": self._data["submission_id"]})
+                self._submission = create_submission({"id": self._data["submission_id"]}, registry)
             except ValueError:
                 self._submission = None
         if not self._data.get("comments_id"):
-            if self._data["id"] in record.get("submission") or self._data["id"] == self._data["submission_id"]:
+            if self._data["id"] in registry.get("submission") or self._data["id"] == self._data["submission_id"]:
                 try:
-                    self._data["comments_id"] = create_submission({"id": self._data["id"]})._data["comments_id"]
+                    self._data["comments_id"] = create_submission({"id": self._data["id"]}, registry)._data[
+                        "comments_id"]
                 except ValueError:
                     self._data["comments_id"] = []
-            elif self._data["id"] in record.get("comment"):
-                self._data["comments_id"] = record.get("comment")[self._data["id"]]["comments_id"]
+            elif self._data["id"] in registry.get("comment"):
+                self._data["comments_id"] = registry.get("comment")[self._data["id"]]["comments_id"]
             else:
                 self._data["comments_id"] = []
         if not self._data.get("comments_total_id"):
-            if self._data["id"] in record.get("submission") or self._data["id"] == self._data["submission_id"]:
+            if self._data["id"] in registry.get("submission") or self._data["id"] == self._data["submission_id"]:
                 try:
-                    self._data["comments_total_id"] = create_submission({"id": self._data["id"]})._data[
+                    self._data["comments_total_id"] = create_submission({"id": self._data["id"]}, registry)._data[
                         "comments_total_id"]
                 except ValueError:
                     self._data["comments_total_id"] = []
-            elif self._data["id"] in record.get("comment"):
-                self._data["comments_total_id"] = record.get("comment")[self._data["id"]]["comments_total_id"]
+            elif self._data["id"] in registry.get("comment"):
+                self._data["comments_total_id"] = registry.get("comment")[self._data["id"]]["comments_total_id"]
             else:
                 self._data["comments_total_id"] = []
-        self.update_comments_total_id()
+        self.update_comments_total_id(memo)
 
-    def update_comments_total_id(self):
+    def update_comments_total_id(self, memo=None):
         if self._head:
             self._data["comments_total_id"] = self._head._data["comments_total_id"]
         else:
             self._data["comments_total_id"] = []
 
-        comment_total_id = self.dig_depth(self._data["comments_id"], None)
-
-        for comment_id in comment_total_id:
-            if comment_id not in self._data["comments_total_id"]:
-                self._data["comments_total_id"].append(comment_id)
+        comments_total_id = self._data["comments_total_id"]
+        seen = set(comments_total_id)
+        for comment_id in collect_descendants(self._data["comments_id"], memo, self._registry):
+            if comment_id not in seen:
+                seen.add(comment_id)
+                comments_total_id.append(comment_id)
 
     @staticmethod
-    def dig_depth(comment_id_list, depth=None):
+    def dig_depth(comment_id_list, depth=None, registry=None):
         comment_total_id = []
         for comment_id in comment_id_list:
             try:
-                comment = create_comment({"id": comment_id})
+                comment = create_comment({"id": comment_id}, registry)
                 comment_total_id.extend(comment._data["comments_id"])
                 if depth:
                     if depth <= 1:
                         pass
                     else:
-                        comment_total_id.extend(CommentTree.dig_depth(comment._data["comments_id"], depth - 1))
+                        comment_total_id.extend(
+                            CommentTree.dig_depth(comment._data["comments_id"], depth - 1, registry))
                 else:
-                    comment_total_id.extend(CommentTree.dig_depth(comment._data["comments_id"], depth))
+                    comment_total_id.extend(CommentTree.dig_depth(comment._data["comments_id"], depth, registry))
             except ValueError:
                 pass
         return comment_total_id
@@ -976,64 +1688,261 @@ class CreateObject:
                          "comment_tree": CommentTree}
 
     @staticmethod
-    def create_object(object_dict, object_type="submission"):
+    def create_object(object_dict, object_type="submission", registry=None):
+        registry = record if registry is None else registry
         object_id = CreateObject.process_id(object_dict["id"], object_type)
         object_dict["id"] = object_id
 
-        if not CreateObject.if_record(object_id, object_type):
-            return CreateObject.object_type2class[object_type](object_dict)
+        if not CreateObject.if_record(object_id, object_type, registry):
+            if len(object_dict) == 1 and object_type in registry.loaders:
+                loaded_dict = registry.loaders[object_type](object_id)
+                if loaded_dict is not None:
+                    loaded_dict["id"] = object_id
+                    object_dict = loaded_dict
+            obj = CreateObject.object_type2class[object_type](object_dict, registry=registry)
+            if (compact_data or registry.compact) and not isinstance(obj._data, CompactData):
+                # packed once the object is built, its processing reads and writes a dict
+                obj._data = compact_data_types[object_type].from_dict(obj._data)
+            if registry.store is not None:
+                registry.store.adopt(obj)
+            return obj
         else:
-            required_object = CreateObject.get_record(object_id, object_type)
+            required_object = CreateObject.get_record(object_id, object_type, registry)
             required_object.get_dict().update(object_dict)
             return required_object
 
     @staticmethod
     def process_id(object_id, object_type="submission"):
         if isinstance(object_id, str):
-            if object_id.startswith(prefix_map_type2id[object_type]):
-                return int(object_id[len(prefix_map_type2id[object_type]):], 36)
-            else:
-                return int(object_id, 36)
+            return id_codec.split_id(object_id, prefix_map_type2id[object_type])[0]
         elif isinstance(object_id, int):
             return object_id
         else:
             raise ValueError(f"Unknown object id type {type(object_id)}")
 
     @staticmethod
-    def if_record(object_id, object_type="submission"):
-        if object_type in record:
-            if object_id in record[object_type]:
+    def if_record(object_id, object_type="submission", registry=None):
+        registry = record if registry is None else registry
+        if object_type in registry:
+            if object_id in registry[object_type]:
                 return True
         return False
 
     @staticmethod
-    def get_record(object_id, object_type="submission"):
-        if object_type in record:
-            if object_id in record[object_type]:
-                return record[object_type][object_id]
+    def get_record(object_id, object_type="submission", registry=None):
+        registry = record if registry is None else registry
+        if object_type in registry:
+            if object_id in registry[object_type]:
+                return registry[object_type][object_id]
         raise ValueError(f"Object {object_id} of type {object_type} not found in record")
 
 
 # a series of create object functions based on CreateObject class which will not create duplicate objects
 # directly create object by ObjectClass(object_dict) will create duplicate objects, which is not allowed
-def create_submission(submission_dict):
-    return CreateObject.create_object(submission_dict, "submission")
-
-
-def create_comment(comment_dict):
-    return CreateObject.create_object(comment_dict, "comment")
-
-
-def create_redditor(redditor_dict):
-    return CreateObject.create_object(redditor_dict, "redditor")
+def create_submission(submission_dict, registry=None):
+    return CreateObject.create_object(submission_dict, "submission", registry)
+
+
+def create_comment(comment_dict, registry=None):
+    return CreateObject.create_object(comment_dict, "comment", registry)
+
+
+def create_redditor(redditor_dict, registry=None):
+    return CreateObject.create_object(redditor_dict, "redditor", registry)
+
+
+def create_subreddit(subreddit_dict, registry=None):
+    return CreateObject.create_object(subreddit_dict, "subreddit", registry)
+
+
+def create_comment_tree(comment_tree_dict, registry=None):
+    return CreateObject.create_object(comment_tree_dict, "comment_tree", registry)
+
+
+def collect_descendants(comment_ids, memo=None, registry=None):
+    """
+    ids of all the descendants of the comments (without the comments), in the order of CommentTree.dig_depth: the
+    replies of the first comment, the descendants of these replies, then the replies of the second comment...
+    It is one iterative post-order pass (no recursion limit on deep threads), the descendants of every comment visited
+    are kept in memo so they are computed once when memo is shared, e.g. by update_comment_trees.
+    :param comment_ids: list of comment ids
+    :param memo: dict of comment id -> list of the ids of its descendants (None if the comment cannot be built)
+    :param registry: registry of the comments (default: record)
+    :return: list of comment ids
+    """
+    if memo is None:
+        memo = {}
+    registry = record if registry is None else registry
+    comment_record = registry["comment"]
+    visiting = set()
+    for comment_id in comment_ids:
+        stack = [comment_id]
+        while stack:
+            current_id = stack[-1]
+            if current_id in memo:
+                stack.pop()
+                continue
+            comment = comment_record.get(current_id)
+            if comment is None:
+                try:
+                    comment = create_comment({"id": current_id}, registry)
+                except ValueError:
+                    memo[current_id] = None
+                    stack.pop()
+                    continue
+            replies = comment._data["comments_id"]
+            if current_id not in visiting:
+                # first visit: the descendants of the replies are needed first
+                visiting.add(current_id)
+                stack.extend(reply_id for reply_id in reversed(replies)
+                             if reply_id not in memo and reply_id not in visiting)
+                continue
+            stack.pop()
+            visiting.discard(current_id)
+            descendants = list(replies)
+            for reply_id in replies:
+                # a reply still being visited is in a cycle of parents, it is left out
+                if memo.get(reply_id):
+                    descendants.extend(memo[reply_id])
+            memo[current_id] = descendants
+
+    result = []
+    for comment_id in comment_ids:
+        if memo.get(comment_id):
+            result.extend(memo[comment_id])
+    return result
+
+
+def update_comment_trees(comment_trees=None, registry=None):
+    """
+    repair all the comment trees (CommentTree.update_attr) in one pass: the descendants of every comment are computed
+    once for the whole forest instead of once per tree containing it
+    :param comment_trees: iterable of comment trees (default: all the comment trees of the registry)
+    :param registry: registry of the trees (default: record)
+    """
+    if comment_trees is None:
+        comment_trees = list((record if registry is None else registry)["comment_tree"].values())
+    memo = {}
+    for comment_tree in comment_trees:
+        comment_tree.update_attr(memo)
+
+
+class ParentChains:
+    """
+    The parent chains of comments as arrays, one row per comment (the comments and all their parent comments), the rows
+    of the parents are before the rows of their replies:
+    ids: comment id
+    parents: row of the parent comment, -1 if the parent is not a comment (or there is none)
+    heads: id of the parent submission for a top level comment, -1 otherwise
+    depths: length of the parent chain (1 for a top level comment)
+    The arrays are array("q"), np.frombuffer(parent_chains.parents, dtype=np.int64) gives a numpy array without copy.
+    """
+
+    def __init__(self, comments=()):
+        self.ids = array("q")
+        self.parents = array("q")
+        self.heads = array("q")
+        self.depths = array("q")
+        self.rows = {}
+        for comment in comments:
+            self.add(comment)
+
+    def add(self, comment):
+        """
+        add the rows of a comment and of its parent comments which are not there yet, in one iterative walk up
+        :return: the row of the comment
+        """
+        path = []
+        on_path = set()
+        node = comment
+        while node._data["id"] not in self.rows:
+            path.append(node)
+            on_path.add(node._data["id"])
+            parent = getattr(node, "_parent", None)
+            if parent is None or parent.object_type != "comment" or parent._data["id"] in on_path:
+                break
+            node = parent
+        for node in reversed(path):
+            parent = getattr(node, "_parent", None)
+            if parent is None:
+                parent_row, head, depth = -1, -1, 0
+            elif parent.object_type != "comment":
+                parent_row, head, depth = -1, parent._data["id"], 1
+            elif parent._data["id"] in self.rows:
+                parent_row, head = self.rows[parent._data["id"]], -1
+                depth = self.depths[parent_row] + 1
+            else:
+                # a cycle of parents, cut at this comment
+                parent_row, head, depth = -1, -1, 0
+            self.rows[node._data["id"]] = len(self.ids)
+            self.ids.append(node._data["id"])
+            self.parents.append(parent_row)
+            self.heads.append(head)
+            self.depths.append(depth)
+        return self.rows[comment._data["id"]]
 
+    def __len__(self):
+        return len(self.ids)
 
-def create_subreddit(subreddit_dict):
-    return CreateObject.create_object(subreddit_dict, "subreddit")
+    def __contains__(self, comment_id):
+        return comment_id in self.rows
 
+    def depth(self, comment_id):
+        return self.depths[self.rows[comment_id]]
 
-def create_comment_tree(comment_tree_dict):
-    return CreateObject.create_object(comment_tree_dict, "comment_tree")
+    def ancestors(self, comment_id):
+        """
+        ids of the parent comments of a comment, from the top level comment to the parent
+        """
+        ancestor_ids = []
+        row = self.parents[self.rows[comment_id]]
+        while row >= 0:
+            ancestor_ids.append(self.ids[row])
+            row = self.parents[row]
+        return ancestor_ids[::-1]
+
+    def chain(self, comment_id):
+        """
+        the parent chain of a comment, as Comment.generate_parent_chain: list of (id, object type) from the submission
+        to the parent
+        """
+        row = self.rows[comment_id]
+        while self.parents[row] >= 0:
+            row = self.parents[row]
+        head = [(self.heads[row], "submission")] if self.heads[row] >= 0 else []
+        return head + [(ancestor_id, "comment") for ancestor_id in self.ancestors(comment_id)]
+
+
+def compute_parent_chains(comments=None, as_arrays=False, registry=None):
+    """
+    compute the parent chains of comments in one iterative pass, the chain of every comment is computed once from the
+    chain of its parent
+    :param comments: iterable of comments (default: all the comments of the registry)
+    :param as_arrays: only return the ParentChains arrays instead of setting parent_chain of every comment (the lists
+    take O(depth) memory per comment)
+    :param registry: registry of the comments (default: record)
+    :return: ParentChains of the comments and their parent comments
+    """
+    registry = record if registry is None else registry
+    if comments is None:
+        comments = registry["comment"].values()
+    parent_chains = ParentChains(comments)
+    if as_arrays:
+        return parent_chains
+    comment_record = registry["comment"]
+    chains = []
+    for row, comment_id in enumerate(parent_chains.ids):
+        parent_row = parent_chains.parents[row]
+        if parent_row >= 0:
+            chain = chains[parent_row] + [(parent_chains.ids[parent_row], "comment")]
+        elif parent_chains.heads[row] >= 0:
+            chain = [(parent_chains.heads[row], "submission")]
+        else:
+            chain = []
+        chains.append(chain)
+        if comment_id in comment_record:
+            comment_record[comment_id]._data["parent_chain"] = chain
+    return parent_chains
 
 
 def int2base(x, base=10):
@@ -1053,6 +1962,8 @@ def int2base(x, base=10):
         return oct(x)
     elif base == 16:
         return hex(x)
+    elif base == 36:
+        return id_codec.encode36(x)
     else:
         digs = "0123456789abcdefghijklmnopqrstuvwxyz"
         if x < 0:
@@ -1064,8 +1975,8 @@ def int2base(x, base=10):
         x *= sign
         digits = []
         while x:
-            digits.append(digs[int(x % base)])
-            x = int(x / base)
+            x, remainder = divmod(x, base)
+            digits.append(digs[remainder])
         if sign < 0:
             digits.append("-")
         digits.reverse()
@@ -0,0 +1,220 @@
+"""
+export of the objects of a registry to an SQLite database with normalized tables (submissions, comments, redditors,
+subreddits and the edges of the comment trees) for SQL queries, and the reader which builds the objects of some threads
+from it again
+"""
+import os
+import sqlite3
+from itertools import islice
+
+from . import objects
+from .instrumentation import is_stub
+from .json_backend import get_backend
+
+# 64 bit signed integers of SQLite, the ids derived from long subreddit names do not fit
+sqlite_int_max = 2 ** 63 - 1
+
+tables = {
+    "submissions": ["id INTEGER NOT NULL", "id_36 TEXT", "author_id INTEGER", "author TEXT", "subreddit_id INTEGER",
+                    "subreddit TEXT", "created_utc INTEGER", "score INTEGER", "num_comments INTEGER", "title TEXT",
+                    "data TEXT"],
+    "comments": ["id INTEGER NOT NULL", "id_36 TEXT", "link_id INTEGER", "parent_id INTEGER", "author_id INTEGER",
+                 "author TEXT", "subreddit TEXT", "created_utc INTEGER", "score INTEGER", "body TEXT", "data TEXT"],
+    "redditors": ["id INTEGER NOT NULL", "id_36 TEXT", "name TEXT", "num_submissions INTEGER",
+                  "num_comments INTEGER"],
+    "subreddits": ["id INTEGER", "id_36 TEXT", "name TEXT", "num_submissions INTEGER", "num_comments INTEGER"],
+    "edges": ["child_id INTEGER NOT NULL", "parent_id INTEGER", "parent_type TEXT", "link_id INTEGER"],
+}
+
+# created after the rows are inserted: table -> columns of the indexes
+table_indexes = {
+    "submissions": ["id", "author_id", "created_utc"],
+    "comments": ["id", "link_id", "parent_id", "author_id", "created_utc"],
+    "redditors": ["id", "name"],
+    "subreddits": ["id_36", "name"],
+    "edges": ["child_id", "parent_id", "link_id"],
+}
+unique_indexes = {("submissions", "id"), ("comments", "id"), ("redditors", "id"), ("edges", "child_id")}
+
+# keys of the objects computed by the build, left out of the data column (the reader builds them again)
+derived_keys = {"fullname", "id_36", "author_id", "author_id_36", "subreddit_id_36", "subreddit_fullname", "link_id_36",
+                "link_id_fullname", "parent_id_36", "parent_id_fullname", "comments_id", "comments_total_id",
+                "parent_chain"}
+
+
+def to_int(value, default=None):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return value if -sqlite_int_max <= value <= sqlite_int_max else default
+
+
+def raw_record(obj) -> dict:
+    """
+    the record of a submission or comment as create_submission or create_comment take it: the fields of the object
+    without the ones computed by the build, and the fullname of the parent of a comment (a submission or a comment)
+    """
+    data = {key: value for key, value in obj._data.items() if key not in derived_keys}
+    if obj.object_type == "comment":
+        data.pop("subreddit_id", None)
+        if obj._data.get("parent_id_fullname"):
+            data["parent_id"] = obj._data["parent_id_fullname"]
+        if obj._data.get("link_id_fullname"):
+            data["link_id"] = obj._data["link_id_fullname"]
+    return data
+
+
+def submission_rows(registry, dumps):
+    for submission_id, obj in registry["submission"].items():
+        if is_stub(obj):
+            continue
+        data = obj._data
+        yield (submission_id, data.get("id_36"), to_int(data.get("author_id")), data.get("author"),
+               to_int(data.get("subreddit_id")), data.get("subreddit"), to_int(data.get("created_utc")),
+               to_int(data.get("score")), to_int(data.get("num_comments")), data.get("title"), dumps(raw_record(obj)))
+
+
+def comment_rows(registry, dumps):
+    for comment_id, obj in registry["comment"].items():
+        if is_stub(obj):
+            continue
+        data = obj._data
+        yield (comment_id, data.get("id_36"), to_int(data.get("link_id")), to_int(data.get("parent_id")),
+               to_int(data.get("author_id")), data.get("author"), data.get("subreddit"),
+               to_int(data.get("created_utc")), to_int(data.get("score")), data.get("body"), dumps(raw_record(obj)))
+
+
+def redditor_rows(registry):
+    for redditor_id, obj in registry["redditor"].items():
+        data = obj._data
+        yield (to_int(redditor_id), data.get("id_36"), data.get("name"), len(data.get("submissions_id", ())),
+               len(data.get("comments_id", ())))
+
+
+def subreddit_rows(registry):
+    for subreddit_id, obj in registry["subreddit"].items():
+        data = obj._data
+        yield (to_int(subreddit_id), data.get("id_36"), data.get("name"), len(data.get("submissions_id", ())),
+               len(data.get("comments_id", ())))
+
+
+def edge_rows(registry):
+    """
+    comment -> parent edges of the comment trees, after the repair: the parent of a top level comment, or of a comment
+    whose parent is deleted, is its submission
+    """
+    for comment_id, obj in registry["comment"].items():
+        if is_stub(obj):
+            continue
+        parent = getattr(obj, "_parent", None)
+        linked_submission = getattr(obj, "_submission", None)
+        yield (comment_id, parent._data["id"] if parent is not None else None,
+               parent.object_type if parent is not None else None,
+               linked_submission._data["id"] if linked_submission is not None else None)
+
+
+def insert_rows(connection, table: str, rows, batch_size: int) -> int:
+    """
+    insert rows in a table with executemany, one transaction per batch of batch_size rows
+    :return: number of rows inserted
+    """
+    columns = [column.split()[0] for column in tables[table]]
+    statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return count
+        connection.execute("BEGIN")
+        connection.executemany(statement, batch)
+        connection.execute("COMMIT")
+        count += len(batch)
+
+
+def create_indexes(connection):
+    for table, columns in table_indexes.items():
+        for column in columns:
+            unique = "UNIQUE " if (table, column) in unique_indexes else ""
+            connection.execute(f"CREATE {unique}INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})")
+    connection.execute("ANALYZE")
+
+
+def export_sqlite(path: str, registry: objects.Registry = None, batch_size: int = 10000,
+                  json_backend=None) -> dict:
+    """
+    write the objects of a registry (after the build) to an SQLite database, replacing its tables:
+
+    submissions and comments: the main fields as columns and the record as JSON in data (the stubs are left out),
+    redditors and subreddits: ids, names and number of submissions and comments, edges: comment (child_id) -> parent
+    (parent_id, parent_type submission or comment) of the comment trees, with the submission of the thread (link_id).
+
+    The rows are inserted by batches of batch_size in one transaction each, then the indexes are created (on the ids,
+    link_id, parent_id, author_id and created_utc). The ids which do not fit in 64 bits (the subreddits of the
+    comments, whose id comes from their name) are NULL.
+    :param path: SQLite file
+    :param registry: registry of the objects (default: objects.record)
+    :param json_backend: json backend or its name for the data column (default: REDDIT_JSON_BACKEND or auto)
+    :return: number of rows of every table
+    """
+    registry = objects.record if registry is None else registry
+    dumps = get_backend(json_backend).dumps
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        for table, columns in tables.items():
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+            connection.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+        counts = {
+            "submissions": insert_rows(connection, "submissions", submission_rows(registry, dumps), batch_size),
+            "comments": insert_rows(connection, "comments", comment_rows(registry, dumps), batch_size),
+            "redditors": insert_rows(connection, "redditors", redditor_rows(registry), batch_size),
+            "subreddits": insert_rows(connection, "subreddits", subreddit_rows(registry), batch_size),
+            "edges": insert_rows(connection, "edges", edge_rows(registry), batch_size),
+        }
+        create_indexes(connection)
+    finally:
+        connection.close()
+    return counts
+
+
+def read_threads(path: str, submission_ids=None, where: str = None, params=(), registry: objects.Registry = None,
+                 json_backend=None) -> objects.Registry:
+    """
+    build the objects of some threads of a database of export_sqlite: the submissions selected and all their comments
+    (found with the link_id index), with their comment trees, authors and subreddits, repaired as the build does
+    :param submission_ids: int ids, base 36 ids or fullnames of the submissions of the threads
+    :param where: SQL condition on the submissions table selecting the threads instead (e.g. "subreddit = ? AND
+    created_utc >= ?"), with params, default: all of them when submission_ids is None too
+    :param registry: registry to build the objects in (default: a new one)
+    :return: the registry
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    registry = objects.Registry() if registry is None else registry
+    loads = get_backend(json_backend).loads
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("CREATE TEMP TABLE selected (id INTEGER PRIMARY KEY)")
+        if submission_ids is not None:
+            connection.executemany("INSERT OR IGNORE INTO selected (id) VALUES (?)",
+                                   ((objects.CreateObject.process_id(submission_id, "submission"),)
+                                    for submission_id in submission_ids))
+        else:
+            connection.execute(f"INSERT OR IGNORE INTO selected (id) SELECT id FROM submissions "
+                               f"{'WHERE ' + where if where else ''}", params)
+        new_comments = []
+        for (data,) in connection.execute("SELECT data FROM submissions WHERE id IN (SELECT id FROM selected) "
+                                          "ORDER BY rowid"):
+            objects.create_submission(loads(data), registry)
+        for (data,) in connection.execute("SELECT data FROM comments WHERE link_id IN (SELECT id FROM selected) "
+                                          "ORDER BY rowid"):
+            new_comments.append(objects.create_comment(loads(data), registry))
+    finally:
+        connection.close()
+    for comment in new_comments:
+        comment.update_parent()
+    objects.update_comment_trees(registry=registry)
+    return registry
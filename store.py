@@ -0,0 +1,221 @@
+"""
+disk-backed storage of the data of the objects, for the datasets larger than memory: the fields of the records are
+kept in an SQLite file with an LRU cache of the recently used ones, the objects only keep their links and id lists
+"""
+import os
+import pickle
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import copy
+
+from .objects import object_types
+
+# the keys kept in memory: the id, and the lists the objects append to in place (the comment trees share them with
+# their head), the other keys of the records are in the store
+local_keys = {"id", "comments_id", "comments_total_id", "submissions_id", "activity", "no_follow"}
+
+
+class DiskData(MutableMapping):
+    """
+    The _data of an object of a registry with a store (see SQLiteStore): the keys of local_keys are in memory, the
+    other ones are read from the store (through its cache) when they are used, and written back when they change.
+    It is pickled and copied as a dict.
+    """
+
+    __slots__ = ("_store", "_key", "_local")
+
+    def __init__(self, store, key, local):
+        self._store = store
+        self._key = key
+        self._local = local
+
+    def __getitem__(self, key):
+        local = self._local
+        if key in local:
+            return local[key]
+        return self._store.get(self._key)[key]
+
+    def __setitem__(self, key, value):
+        if key in local_keys:
+            self._local[key] = value
+        else:
+            self._store.get(self._key)[key] = value
+            self._store.mark_dirty(self._key)
+
+    def __delitem__(self, key):
+        if key in self._local:
+            del self._local[key]
+        else:
+            del self._store.get(self._key)[key]
+            self._store.mark_dirty(self._key)
+
+    def __contains__(self, key):
+        return key in self._local or key in self._store.get(self._key)
+
+    def __iter__(self):
+        yield from self._local
+        yield from self._store.get(self._key)
+
+    def __len__(self):
+        return len(self._local) + len(self._store.get(self._key))
+
+    def to_dict(self):
+        data = dict(self._local)
+        data.update(self._store.get(self._key))
+        return data
+
+    def __repr__(self):
+        return f"DiskData({self.to_dict()!r})"
+
+    def __reduce__(self):
+        return dict, (self.to_dict(),)
+
+    def __copy__(self):
+        return self.to_dict()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.to_dict(), memo)
+
+
+class SQLiteStore:
+    """
+    Store of the data of the objects in an SQLite file, one pickled dict per object, with an LRU cache of cache_size
+    dicts in memory. The changed dicts are written when they leave the cache, in batches of batch_size in one
+    transaction. The file is a cache of the build (no journal, no sync): a temporary file by default, removed by close.
+
+    Give it to a registry (Registry(store=...) or registry.use_store) or to DataProcessorReddit(store=...): the objects
+    created then get a DiskData as _data, their links (parent, submission, author...) stay in memory and keep working.
+    """
+
+    def __init__(self, path: str = None, cache_size: int = 100000, batch_size: int = 10000):
+        """
+        :param path: SQLite file (default: a temporary file removed by close)
+        :param cache_size: number of objects whose data is kept in memory
+        :param batch_size: number of changed objects written at once
+        """
+        self.temporary = path is None
+        if self.temporary:
+            file_descriptor, path = tempfile.mkstemp(suffix=".sqlite", prefix="reddit_object_")
+            os.close(file_descriptor)
+        self.path = path
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.type_index = {object_type: idx for idx, object_type in enumerate(object_types)}
+        self.cache = OrderedDict()
+        self.dirty = set()
+        # changed dicts out of the cache, not written yet
+        self.pending = {}
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS objects (type INTEGER, id INTEGER, data BLOB, "
+                                "PRIMARY KEY (type, id)) WITHOUT ROWID")
+
+    def key(self, object_type, object_id):
+        return self.type_index[object_type], object_id
+
+    def adopt(self, obj):
+        """
+        move the data of an object to the store, obj._data becomes a DiskData
+        """
+        data = obj._data
+        if isinstance(data, DiskData):
+            return obj
+        key = self.key(obj.object_type, data["id"])
+        local = {}
+        stored = {}
+        for data_key, value in data.items():
+            if data_key in local_keys:
+                local[data_key] = value
+            else:
+                stored[data_key] = value
+        self.put(key, stored)
+        obj._data = DiskData(self, key, local)
+        return obj
+
+    def get(self, key) -> dict:
+        """
+        the stored dict of an object (type index, id), from the cache or the file
+        """
+        cache = self.cache
+        data = cache.get(key)
+        if data is not None:
+            cache.move_to_end(key)
+            return data
+        data = self.pending.pop(key, None)
+        if data is not None:
+            self.dirty.add(key)
+        else:
+            row = self.connection.execute("SELECT data FROM objects WHERE type = ? AND id = ?", key).fetchone()
+            data = pickle.loads(row[0]) if row is not None else {}
+        cache[key] = data
+        self.evict()
+        return data
+
+    def put(self, key, data: dict):
+        self.cache[key] = data
+        self.cache.move_to_end(key)
+        self.dirty.add(key)
+        self.evict()
+
+    def mark_dirty(self, key):
+        self.dirty.add(key)
+
+    def evict(self):
+        cache = self.cache
+        while len(cache) > self.cache_size:
+            key, data = cache.popitem(last=False)
+            if key in self.dirty:
+                self.dirty.discard(key)
+                self.pending[key] = data
+                if len(self.pending) >= self.batch_size:
+                    self.write_pending()
+
+    def write_pending(self):
+        if not self.pending:
+            return
+        rows = [(key[0], key[1], pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+                for key, data in self.pending.items()]
+        self.connection.execute("BEGIN")
+        self.connection.executemany("INSERT OR REPLACE INTO objects (type, id, data) VALUES (?, ?, ?)", rows)
+        self.connection.execute("COMMIT")
+        self.pending.clear()
+
+    def flush(self):
+        """
+        write all the changed dicts (the ones in the cache too) to the file
+        """
+        for key in self.dirty:
+            self.pending[key] = self.cache[key]
+        self.dirty.clear()
+        self.write_pending()
+
+    def clear(self):
+        """
+        remove the data of all the objects
+        """
+        self.cache.clear()
+        self.dirty.clear()
+        self.pending.clear()
+        self.connection.execute("DELETE FROM objects")
+
+    def close(self):
+        """
+        close the file (removed if it is a temporary one), the DiskData of the objects cannot be read after
+        """
+        if self.connection is None:
+            return
+        if not self.temporary:
+            self.flush()
+        self.connection.close()
+        self.connection = None
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getstate__(self):
+        raise TypeError("a store cannot be pickled, the objects are pickled with their data as dicts")
+
+    def __repr__(self):
+        return f"<SQLiteStore {self.path}, {len(self.cache)} cached>"
@@ -1,37 +1,160 @@
 """
 It is a script to convert zst files to json files.
 """
-import json
+import glob
 import os
+import queue
+import re
+import shutil
+import tempfile
+import zlib
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from multiprocessing import Manager
 
 import zstandard
 import argparse
 import logging
 
+try:
+    from .json_backend import get_backend
+except ImportError:
+    from json_backend import get_backend
+
 log = logging.getLogger("bot")
 log.setLevel(logging.DEBUG)
 log.addHandler(logging.StreamHandler())
 
 
-def read_lines_zst(file_name):
+class LineFilter:
+    """
+    Filter the lines of a dump by subreddit names, author names and a created_utc range (both ends included).
+    prefilter only looks for the values in the raw line, which is much cheaper than json.loads, and drops the lines
+    that cannot match; match is the exact check on the parsed record.
+    Subreddit and author names are case-insensitive as on Reddit.
+    """
+    created_utc_pattern = re.compile(r'"created_utc"\s*:\s*"?(\d+)')
+
+    def __init__(self, subreddits=None, authors=None, time_min=None, time_max=None):
+        self.subreddits = {subreddit.lower() for subreddit in subreddits} if subreddits else None
+        self.authors = {author.lower() for author in authors} if authors else None
+        self.time_min = time_min
+        self.time_max = time_max
+        self.subreddit_tokens = [f'"{subreddit}"' for subreddit in self.subreddits] if self.subreddits else None
+        self.author_tokens = [f'"{author}"' for author in self.authors] if self.authors else None
+
+    def prefilter(self, line):
+        if self.subreddit_tokens or self.author_tokens:
+            lower_line = line.lower()
+            if self.subreddit_tokens and not any(token in lower_line for token in self.subreddit_tokens):
+                return False
+            if self.author_tokens and not any(token in lower_line for token in self.author_tokens):
+                return False
+        if self.time_min is not None or self.time_max is not None:
+            # nested objects (e.g. crosspost_parent_list) have their own created_utc, keep the line if any of them fits
+            times = self.created_utc_pattern.findall(line)
+            if times and not any(self.in_time_range(int(created_utc)) for created_utc in times):
+                return False
+        return True
+
+    def match(self, obj):
+        if self.subreddits and (obj.get("subreddit") or "").lower() not in self.subreddits:
+            return False
+        if self.authors and (obj.get("author") or "").lower() not in self.authors:
+            return False
+        if self.time_min is not None or self.time_max is not None:
+            try:
+                return self.in_time_range(int(obj["created_utc"]))
+            except (KeyError, TypeError, ValueError):
+                return False
+        return True
+
+    def in_time_range(self, created_utc):
+        if self.time_min is not None and created_utc < self.time_min:
+            return False
+        if self.time_max is not None and created_utc > self.time_max:
+            return False
+        return True
+
+
+class CommentBuckets:
+    """
+    Group comments by link_id with bounded memory.
+    The comment lines are spilled to hash-partitioned bucket files on disk, then every bucket is grouped in memory on
+    its own, so only one bucket (about 1/num_buckets of the comments) is in memory at a time. A submission is always
+    in a single bucket, so the buckets can be written one after the other to the json object of
+    submission id -> list of comments that LoadComments reads.
+    """
+
+    def __init__(self, num_buckets=64, tmp_dir=None, json_backend=None):
+        self.json_backend = get_backend(json_backend)
+        self.num_buckets = num_buckets
+        self.bucket_dir = tempfile.mkdtemp(prefix="comment_buckets_", dir=tmp_dir)
+        self.bucket_files = [open(os.path.join(self.bucket_dir, f"{idx}.jsonl"), 'w') for idx in range(num_buckets)]
+
+    def add(self, line, comment):
+        """
+        add the line of a comment, comment is the parsed line
+        """
+        link_id = comment["link_id"]
+        self.bucket_files[zlib.crc32(link_id.encode()) % self.num_buckets].write(line.strip() + "\n")
+
+    def write(self, json_file):
+        """
+        merge the buckets to the json file
+        """
+        for bucket_file in self.bucket_files:
+            bucket_file.close()
+        with open(json_file, 'w') as f:
+            f.write("{")
+            first = True
+            for idx in range(self.num_buckets):
+                grouped = {}
+                with open(os.path.join(self.bucket_dir, f"{idx}.jsonl"), 'r') as bucket_file:
+                    for line in bucket_file:
+                        comment = self.json_backend.loads(line)
+                        if comment["link_id"] not in grouped:
+                            grouped[comment["link_id"]] = []
+                        grouped[comment["link_id"]].append(comment)
+                for link_id, comments in grouped.items():
+                    if not first:
+                        f.write(", ")
+                    first = False
+                    f.write(f"{self.json_backend.dumps(link_id)}: {self.json_backend.dumps(comments)}")
+            f.write("}")
+
+    def close(self):
+        for bucket_file in self.bucket_files:
+            bucket_file.close()
+        shutil.rmtree(self.bucket_dir, ignore_errors=True)
+
+
+def read_lines_zst(file_name, line_filter=None):
+    """
+    read the lines of a zst file, with the position in the file for the progress
+    :param file_name: zst file path
+    :param line_filter: optional LineFilter, the lines which fail its prefilter are skipped
+    """
     with open(file_name, 'rb') as file_handle:
         buffer = ''
-        reader = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(file_handle)
-        while True:
-            chunk = read_and_decode(reader, 2 ** 27, (2 ** 29) * 2)
-
-            if not chunk:
-                break
-            lines = (buffer + chunk).split("\n")
+        reader = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(file_handle,
+                                                                                  read_across_frames=True)
+        try:
+            while True:
+                chunk = read_and_decode(reader, 2 ** 27, (2 ** 29) * 2)
 
-            for line in lines[:-1]:
-                yield line, file_handle.tell()
+                if not chunk:
+                    break
+                lines = (buffer + chunk).split("\n")
 
-            buffer = lines[-1]
+                for line in lines[:-1]:
+                    if line_filter is None or line_filter.prefilter(line):
+                        yield line, file_handle.tell()
 
-        reader.close()
+                buffer = lines[-1]
+        finally:
+            reader.close()
 
 
 def read_and_decode(reader, chunk_size, max_window_size, previous_chunk=None, bytes_read=0):
@@ -48,10 +171,25 @@ def read_and_decode(reader, chunk_size, max_window_size, previous_chunk=None, by
         return read_and_decode(reader, chunk_size, max_window_size, chunk, bytes_read)
 
 
-def zst2json(zst_file, json_file):
+def zst2json(zst_file, json_file, output_format="json", progress_queue=None, line_filter=None, num_buckets=64,
+             tmp_dir=None, json_backend=None):
     """
     Convert zst file to json file.
+    :param zst_file: zst file path
+    :param json_file: output file path
+    :param output_format: "json" to dump one json list at the end, "jsonl" to write each valid record as a line of
+    newline-delimited json while it is parsed (memory stays flat no matter how big the input is), "grouped" for comments
+    to write the json object of submission id -> list of comments for LoadComments, grouped on disk with CommentBuckets
+    :param progress_queue: optional queue, (zst_file, file_bytes_processed) is put on it at every progress report
+    :param line_filter: optional LineFilter to keep only some subreddits, authors or a created_utc range
+    :param num_buckets: number of buckets for the grouped format, more buckets use less memory
+    :param tmp_dir: directory for the buckets of the grouped format (default: system temporary directory)
+    :param json_backend: json backend or its name, see json_backend.get_backend
+    :return: the statistics of the file
     """
+    if output_format not in ("json", "jsonl", "grouped"):
+        raise ValueError(f"Unknown output format {output_format}")
+    json_backend = get_backend(json_backend)
     total_lines = 0
     bad_lines = 0
     file_bytes_processed = 0
@@ -60,37 +198,187 @@ def zst2json(zst_file, json_file):
     begin_time = datetime.now()
     using_time = 0
     remaining_time = 0
-    # use list to store the data
+    # use list to store the data, only for the json format
     data = []
+    output_handle = None
+    buckets = None
     file_bytes_processed = 0
-    for line, file_bytes_processed in read_lines_zst(zst_file):
-        total_lines += 1
-        if total_lines % 100000 == 0:
+    # the prefilter runs in the loop, after the progress report, so total_lines and the progress count every line
+    zst_lines = read_lines_zst(zst_file)
+    # the zst file, the jsonl file and the buckets (files and directory) are closed and removed even on an error
+    try:
+        output_handle = open(json_file, 'w') if output_format == "jsonl" else None
+        buckets = CommentBuckets(num_buckets, tmp_dir, json_backend) if output_format == "grouped" else None
+        for line, file_bytes_processed in zst_lines:
+            total_lines += 1
+            if total_lines % 100000 == 0:
+                using_time = datetime.now() - begin_time
+                remaining_time = using_time * (file_size / file_bytes_processed - 1)
+                using_time = str(using_time)
+                remaining_time = str(remaining_time)
+                # log.info(
+                #     f"{using_time:,} : {remaining_time:,} : {total_lines:,} : {bad_lines:,} : {file_bytes_processed:,}:{(file_bytes_processed / file_size) * 100:.0f}%")
+                log.info(
+                    f"{os.path.basename(zst_file)} : {using_time} : {remaining_time} : {total_lines} : {bad_lines} : {file_bytes_processed} : {(file_bytes_processed / file_size) * 100:.0f}%"
+                )
+                if progress_queue is not None:
+                    progress_queue.put((zst_file, file_bytes_processed))
+            if line_filter is not None and not line_filter.prefilter(line):
+                continue
+            try:
+                json_line = json_backend.loads(line)
+            except json_backend.decode_error:
+                bad_lines += 1
+                continue
+            if line_filter is not None and not line_filter.match(json_line):
+                continue
+            if buckets is not None:
+                if not isinstance(json_line, dict) or not json_line.get("link_id"):
+                    bad_lines += 1
+                    continue
+                buckets.add(line, json_line)
+            elif output_handle is not None:
+                # the line is already valid json, write it as it is instead of dumping it again
+                output_handle.write(line.strip())
+                output_handle.write("\n")
+            else:
+                data.append(json_line)
+
+        if buckets is not None:
+            buckets.write(json_file)
+        elif output_handle is None:
+            # write the data to json file
+            with open(json_file, 'w') as f:
+                f.write(json_backend.dumps(data))
+    finally:
+        zst_lines.close()
+        if buckets is not None:
+            buckets.close()
+        if output_handle is not None:
+            output_handle.close()
+
+    log.info(f"Finished {os.path.basename(zst_file)}")
+    return {"zst_file": zst_file, "json_file": json_file, "total_lines": total_lines, "bad_lines": bad_lines,
+            "file_size": file_size}
+
+
+def find_zst_files(zst_path):
+    """
+    find the zst files of a directory (e.g. monthly RS_YYYY-MM.zst / RC_YYYY-MM.zst dumps) or of a glob pattern
+    """
+    if os.path.isdir(zst_path):
+        zst_path = os.path.join(zst_path, "*.zst")
+    return sorted(glob.glob(zst_path))
+
+
+def output_files(zst_files, output_dir, output_format="json"):
+    """
+    output file of every zst file in output_dir, named after the zst file
+    :raise ValueError: when zst files of different directories have the same name (their outputs would overwrite each
+    other)
+    """
+    extension = ".jsonl" if output_format == "jsonl" else ".json"
+    json_files = {}
+    zst_of_json = {}
+    for zst_file in zst_files:
+        json_file = os.path.join(output_dir, os.path.splitext(os.path.basename(zst_file))[0] + extension)
+        if json_file in zst_of_json:
+            raise ValueError(f"{zst_of_json[json_file]} and {zst_file} would both be written to {json_file}, convert "
+                             f"them to different output directories")
+        zst_of_json[json_file] = zst_file
+        json_files[zst_file] = json_file
+    return json_files
+
+
+def zst2json_batch(zst_path, output_dir, output_format="json", workers=None, progress_interval=10, line_filter=None,
+                   num_buckets=64, tmp_dir=None, json_backend=None):
+    """
+    Convert all the zst files of a directory or a glob pattern in a process pool, one file per process.
+    :param zst_path: directory or glob pattern of the zst files
+    :param output_dir: directory to save the json files, named after the zst files (see output_files)
+    :param output_format: "json", "jsonl" or "grouped", see zst2json
+    :param workers: number of processes (default: number of cpus)
+    :param progress_interval: seconds between two aggregate progress reports
+    :param line_filter: optional LineFilter, see zst2json
+    :param num_buckets: number of buckets of every file for the grouped format, see zst2json
+    :param tmp_dir: directory for the buckets of the grouped format (default: system temporary directory)
+    :param json_backend: json backend or its name, see json_backend.get_backend
+    :return: the statistics of every file
+    """
+    zst_files = find_zst_files(zst_path)
+    if not zst_files:
+        raise ValueError(f"No zst file found in {zst_path}")
+    json_files = output_files(zst_files, output_dir, output_format)
+    os.makedirs(output_dir, exist_ok=True)
+    # the biggest files first, so a big file does not start last and keep the other processes waiting
+    file_sizes = {zst_file: os.path.getsize(zst_file) for zst_file in zst_files}
+    zst_files.sort(key=lambda x: file_sizes[x], reverse=True)
+    total_size = sum(file_sizes.values())
+    bytes_processed = {zst_file: 0 for zst_file in zst_files}
+    results = []
+
+    begin_time = datetime.now()
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+        progress_queue = manager.Queue()
+        pending = set()
+        for zst_file in zst_files:
+            pending.add(executor.submit(zst2json, zst_file, json_files[zst_file], output_format, progress_queue,
+                                         line_filter, num_buckets, tmp_dir, json_backend))
+
+        while pending:
+            done, pending = wait(pending, timeout=progress_interval, return_when=FIRST_COMPLETED)
+            while True:
+                try:
+                    zst_file, file_bytes_processed = progress_queue.get_nowait()
+                except queue.Empty:
+                    break
+                bytes_processed[zst_file] = max(bytes_processed[zst_file], file_bytes_processed)
+            for future in done:
+                result = future.result()
+                bytes_processed[result["zst_file"]] = result["file_size"]
+                results.append(result)
+
             using_time = datetime.now() - begin_time
-            remaining_time = using_time * (file_size / file_bytes_processed - 1)
-            using_time = str(using_time)
-            remaining_time = str(remaining_time)
-            # log.info(
-            #     f"{using_time:,} : {remaining_time:,} : {total_lines:,} : {bad_lines:,} : {file_bytes_processed:,}:{(file_bytes_processed / file_size) * 100:.0f}%")
+            processed = sum(bytes_processed.values())
+            remaining_time = using_time * (total_size / processed - 1) if processed else "unknown"
             log.info(
-                f"{using_time} : {remaining_time} : {total_lines} : {bad_lines} : {file_bytes_processed} : {(file_bytes_processed / file_size) * 100:.0f}%"
+                f"total : {using_time} : {remaining_time} : {len(results)}/{len(zst_files)} files : "
+                f"{sum(result['total_lines'] for result in results)} lines : "
+                f"{processed} : {(processed / total_size) * 100 if total_size else 100:.0f}%"
             )
-        try:
-            json_line = json.loads(line)
-            data.append(json_line)
-        except json.decoder.JSONDecodeError:
-            bad_lines += 1
-
-    # write the data to json file
-    with open(json_file, 'w') as f:
-        json.dump(data, f)
 
-    log.info("Finished")
+    log.info(f"Finished {len(results)} files, {sum(result['bad_lines'] for result in results)} bad lines")
+    return results
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Convert zst file to json file.')
     parser.add_argument('--zst_file', type=str, default='scripts/output/XboxSeriesX_submissions.zst', help='zst file path')
     parser.add_argument('--json_file', type=str, default='json_output/XboxSeriesX_submissions.json', help='json file path')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'jsonl', 'grouped'],
+                        help='json: one json list, jsonl: stream one record per line (constant memory), '
+                             'grouped: comments grouped by submission for LoadComments (bounded memory)')
+    parser.add_argument('--num_buckets', type=int, default=64, help='number of disk buckets for grouped format')
+    parser.add_argument('--tmp_dir', type=str, default=None, help='directory of the disk buckets')
+    parser.add_argument('--zst_dir', type=str, default=None,
+                        help='directory or glob of zst files, converts all of them in parallel instead of --zst_file')
+    parser.add_argument('--output_dir', type=str, default='json_output', help='output directory for --zst_dir')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for --zst_dir')
+    parser.add_argument('--json_backend', type=str, default=None,
+                        help='json, orjson, msgspec or auto (default: REDDIT_JSON_BACKEND or auto)')
+    parser.add_argument('--subreddits', type=str, default=None, help='comma separated subreddit names to keep')
+    parser.add_argument('--authors', type=str, default=None, help='comma separated author names to keep')
+    parser.add_argument('--time_min', type=int, default=None, help='minimum created_utc to keep')
+    parser.add_argument('--time_max', type=int, default=None, help='maximum created_utc to keep')
     args = parser.parse_args()
-    zst2json(args.zst_file, args.json_file)
+    line_filter = None
+    if args.subreddits or args.authors or args.time_min is not None or args.time_max is not None:
+        line_filter = LineFilter(subreddits=args.subreddits.split(",") if args.subreddits else None,
+                                 authors=args.authors.split(",") if args.authors else None,
+                                 time_min=args.time_min, time_max=args.time_max)
+    if args.zst_dir:
+        zst2json_batch(args.zst_dir, args.output_dir, args.output_format, args.workers, line_filter=line_filter,
+                       num_buckets=args.num_buckets, tmp_dir=args.tmp_dir, json_backend=args.json_backend)
+    else:
+        zst2json(args.zst_file, args.json_file, args.output_format, line_filter=line_filter,
+                 num_buckets=args.num_buckets, tmp_dir=args.tmp_dir, json_backend=args.json_backend)
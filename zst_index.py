@@ -0,0 +1,361 @@
+"""
+It is a script to index zst files for random access.
+
+The index is a sqlite sidecar file next to the zst file. It records the frames of the zst file (the compressed and the
+decompressed offset where every frame starts), and for every record its id, the frame it starts in, its decompressed
+offset, the length of the line and created_utc (indexed for the time range queries). A lookup seeks to the frame and
+only decodes that region.
+
+zstd can only start decoding at the beginning of a frame, so the lookups are fast when the file has many small
+frames. The Pushshift dumps are usually written as one big frame, use make_seekable (--seekable_file) to rewrite them
+in frames of a few megabytes first.
+"""
+import json
+import os
+import sqlite3
+
+from datetime import datetime
+
+import zstandard
+import argparse
+
+try:
+    from .zst2json import log
+    from .json_backend import get_backend
+    from .id_codec import decode36
+except ImportError:
+    from zst2json import log
+    from json_backend import get_backend
+    from id_codec import decode36
+
+
+def parse_id(object_id):
+    """
+    id of a record as an int, accepts int, base 36 id and fullname (t1_xxx)
+    """
+    return decode36(object_id)
+
+
+def make_seekable(zst_file, output_file, frame_size=2 ** 22, level=3):
+    """
+    rewrite a zst file as a series of independent frames, every frame holds complete lines of about frame_size bytes
+    :param zst_file: zst file path
+    :param output_file: output zst file path, it can still be read by read_lines_zst
+    :param frame_size: decompressed size of a frame, smaller frames make faster lookups but compress worse
+    :param level: compression level
+    """
+    compressor = zstandard.ZstdCompressor(level=level)
+    frames = 0
+    with open(zst_file, 'rb') as input_handle, open(output_file, 'wb') as output_handle:
+        reader = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(input_handle,
+                                                                                  read_across_frames=True)
+        buffer = b''
+        while True:
+            chunk = reader.read(frame_size)
+            if not chunk:
+                break
+            buffer += chunk
+            while len(buffer) >= frame_size:
+                end = buffer.rfind(b'\n', 0, max(frame_size, buffer.find(b'\n') + 1)) + 1
+                if end == 0:
+                    # no complete line yet
+                    break
+                output_handle.write(compressor.compress(buffer[:end]))
+                frames += 1
+                buffer = buffer[end:]
+        if buffer:
+            output_handle.write(compressor.compress(buffer))
+            frames += 1
+        reader.close()
+    log.info(f"Wrote {frames} frames to {output_file}")
+    return frames
+
+
+def iter_frames(zst_file, read_size=2 ** 20):
+    """
+    decompress a zst file frame by frame
+    :return: generator of (frame index, compressed offset of the frame, decompressed offset of the frame, decompressed
+    chunk), a frame can be split into several chunks
+    """
+    decompressor = zstandard.ZstdDecompressor(max_window_size=2 ** 31)
+    frame = 0
+    compressed_offset = 0
+    decompressed_offset = 0
+    frame_compressed_offset = 0
+    frame_decompressed_offset = 0
+    decompress_obj = decompressor.decompressobj()
+    with open(zst_file, 'rb') as file_handle:
+        data = file_handle.read(read_size)
+        while data:
+            chunk = decompress_obj.decompress(data)
+            if chunk:
+                yield frame, frame_compressed_offset, frame_decompressed_offset, chunk
+                decompressed_offset += len(chunk)
+            if decompress_obj.eof:
+                # the frame ends in data, the rest of data is the next frame
+                compressed_offset += len(data) - len(decompress_obj.unused_data)
+                data = decompress_obj.unused_data
+                frame += 1
+                frame_compressed_offset = compressed_offset
+                frame_decompressed_offset = decompressed_offset
+                decompress_obj = decompressor.decompressobj()
+                if not data:
+                    data = file_handle.read(read_size)
+            else:
+                compressed_offset += len(data)
+                data = file_handle.read(read_size)
+
+
+def build_index(zst_file, index_file=None, batch_size=100000, json_backend=None):
+    """
+    index the records of a zst file to a sqlite sidecar file
+    :param zst_file: zst file path
+    :param index_file: index file path (default: zst_file + ".idx")
+    :param batch_size: number of records inserted at once
+    :param json_backend: json backend or its name, see json_backend.get_backend
+    :return: index file path
+    """
+    json_backend = get_backend(json_backend)
+    index_file = index_file or zst_file + ".idx"
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    connection = sqlite3.connect(index_file)
+    connection.executescript("""
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE frames (frame INTEGER PRIMARY KEY, compressed_offset INTEGER, decompressed_offset INTEGER);
+        CREATE TABLE records (id INTEGER PRIMARY KEY, frame INTEGER, offset INTEGER, length INTEGER,
+                              created_utc INTEGER);
+    """)
+
+    begin_time = datetime.now()
+    total_lines = 0
+    bad_lines = 0
+    records = []
+    frames = []
+
+    def index_line(line, line_frame, line_start):
+        nonlocal total_lines, bad_lines
+        total_lines += 1
+        try:
+            obj = json_backend.loads(line)
+            object_id = parse_id(obj["id"])
+            created_utc = int(obj["created_utc"]) if obj.get("created_utc") is not None else None
+        except (json_backend.decode_error, ValueError, KeyError, TypeError, AttributeError):
+            bad_lines += 1
+        else:
+            records.append((object_id, line_frame, line_start, len(line), created_utc))
+
+    # decompressed offset of the current chunk
+    position = 0
+    # the line being read may go across chunks and frames, it is indexed at the frame where it starts
+    buffer = b''
+    line_frame = 0
+    line_start = 0
+    for frame, compressed_offset, decompressed_offset, chunk in iter_frames(zst_file):
+        if not frames or frames[-1][0] != frame:
+            frames.append((frame, compressed_offset, decompressed_offset))
+        if not buffer:
+            line_frame = frame
+            line_start = position
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end == -1:
+                buffer += chunk[start:]
+                break
+            index_line(buffer + chunk[start:end], line_frame, line_start)
+            buffer = b''
+            start = end + 1
+            line_frame = frame
+            line_start = position + start
+            if len(records) >= batch_size:
+                connection.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)", records)
+                records.clear()
+                log.info(f"{datetime.now() - begin_time} : {total_lines} : {bad_lines} : {compressed_offset}")
+        position += len(chunk)
+    if buffer.strip():
+        # the last line of a file which does not end with a newline
+        index_line(buffer, line_frame, line_start)
+    connection.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)", records)
+    connection.executemany("INSERT INTO frames VALUES (?, ?, ?)", frames)
+    connection.execute("INSERT INTO meta VALUES (?, ?)", ("zst_size", str(os.path.getsize(zst_file))))
+    connection.execute("CREATE INDEX records_created_utc ON records (created_utc)")
+    connection.commit()
+    connection.close()
+    log.info(f"Indexed {total_lines} lines ({bad_lines} bad lines) in {len(frames)} frames to {index_file}")
+    return index_file
+
+
+class SeekableZstReader:
+    """
+    Random access to the records of a zst file with the index of build_index.
+    """
+    # largest read from the decoder, the bytes between two records are skipped in reads of this size
+    read_size = 2 ** 24
+
+    def __init__(self, zst_file, index_file=None, json_backend=None):
+        self.json_backend = get_backend(json_backend)
+        self.zst_file = zst_file
+        self.index_file = index_file or zst_file + ".idx"
+        if not os.path.exists(self.index_file):
+            raise FileNotFoundError(f"Index {self.index_file} not found, build it with build_index first")
+        self.connection = sqlite3.connect(self.index_file)
+        self.frames = dict((frame, (compressed_offset, decompressed_offset)) for frame, compressed_offset,
+                           decompressed_offset in self.connection.execute("SELECT * FROM frames"))
+        self.file_handle = open(zst_file, 'rb')
+        self.decompressor = zstandard.ZstdDecompressor(max_window_size=2 ** 31)
+
+    def open_frame(self, decompressor, file_handle, frame):
+        """
+        decoder of file_handle starting at the frame
+        :return: the decoder and the decompressed offset of the frame
+        """
+        compressed_offset, decompressed_offset = self.frames[frame]
+        file_handle.seek(compressed_offset)
+        return decompressor.stream_reader(file_handle, read_across_frames=True, closefd=False), decompressed_offset
+
+    def skip(self, reader, count, offset):
+        """
+        skip count decompressed bytes of the decoder, to the offset
+        """
+        while count > 0:
+            skipped = len(reader.read(min(count, self.read_size)))
+            if not skipped:
+                raise EOFError(f"Offset {offset} is out of {self.zst_file}")
+            count -= skipped
+
+    def read_exact(self, reader, length):
+        """
+        read length decompressed bytes of the decoder (fewer at the end of the file)
+        """
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            chunk = reader.read(min(remaining, self.read_size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def read_region(self, frame, offset, length):
+        """
+        decode length bytes at the decompressed offset, starting to decode at the frame
+        """
+        reader, decompressed_offset = self.open_frame(self.decompressor, self.file_handle, frame)
+        try:
+            self.skip(reader, offset - decompressed_offset, offset)
+            return self.read_exact(reader, length)
+        finally:
+            reader.close()
+
+    def get(self, object_id):
+        """
+        get the record of an id (int, base 36 or fullname)
+        :return: the record dict or None if the id is not in the file
+        """
+        row = self.connection.execute("SELECT frame, offset, length FROM records WHERE id = ?",
+                                      (parse_id(object_id),)).fetchone()
+        if row is None:
+            return None
+        return self.json_backend.loads(self.read_region(*row))
+
+    def get_many(self, object_ids):
+        """
+        get the records of several ids, the ids which are not in the file are skipped. The records are decoded in
+        offset order by one pass of the decoder (see iter_rows)
+        :return: dict of int id -> record
+        """
+        rows = []
+        for object_id in object_ids:
+            row = self.connection.execute("SELECT id, frame, offset, length FROM records WHERE id = ?",
+                                          (parse_id(object_id),)).fetchone()
+            if row is not None:
+                rows.append(row)
+        return self.read_rows(rows)
+
+    def iter_time_range(self, time_min, time_max):
+        """
+        the records with time_min <= created_utc <= time_max (found with the created_utc index of the records), in file
+        order, yielded one by one as they are decoded (see iter_rows)
+        """
+        rows = self.connection.execute(
+            "SELECT id, frame, offset, length FROM records WHERE created_utc BETWEEN ? AND ? ORDER BY offset",
+            (time_min, time_max))
+        for _, record in self.iter_rows(rows):
+            yield record
+
+    def read_rows(self, rows):
+        """
+        read the rows (id, frame, offset, length)
+        :return: dict of int id -> record, in offset order
+        """
+        return dict(self.iter_rows(sorted(rows, key=lambda x: x[2])))
+
+    def iter_rows(self, rows):
+        """
+        read the rows (id, frame, offset, length) sorted by offset and yield (id, record) as they are parsed. One
+        decoder goes across the rows, the bytes between two rows are skipped in reads of read_size, so only one record
+        is in memory at a time. It starts again at the frame of a row when the frame starts after the current position
+        (zstd cannot seek inside a frame). It has its own handle of the file and decompressor, so get can be called
+        while iterating
+        """
+        decompressor = zstandard.ZstdDecompressor(max_window_size=2 ** 31)
+        reader = None
+        position = 0
+        with open(self.zst_file, 'rb') as file_handle:
+            try:
+                for object_id, frame, offset, length in rows:
+                    if reader is None or offset < position or self.frames[frame][1] > position:
+                        if reader is not None:
+                            reader.close()
+                        reader, position = self.open_frame(decompressor, file_handle, frame)
+                    self.skip(reader, offset - position, offset)
+                    line = self.read_exact(reader, length)
+                    position = offset + len(line)
+                    yield object_id, self.json_backend.loads(line)
+            finally:
+                if reader is not None:
+                    reader.close()
+
+    def close(self):
+        self.file_handle.close()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def __contains__(self, object_id):
+        return self.connection.execute("SELECT 1 FROM records WHERE id = ?",
+                                       (parse_id(object_id),)).fetchone() is not None
+
+    def __getitem__(self, object_id):
+        record = self.get(object_id)
+        if record is None:
+            raise KeyError(object_id)
+        return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index zst file for random access.')
+    parser.add_argument('--zst_file', type=str, required=True, help='zst file path')
+    parser.add_argument('--index_file', type=str, default=None, help='index file path (default: zst_file.idx)')
+    parser.add_argument('--seekable_file', type=str, default=None,
+                        help='rewrite zst_file to this file in small frames first, then index the new file')
+    parser.add_argument('--frame_size', type=int, default=2 ** 22, help='decompressed size of a frame')
+    parser.add_argument('--get', type=str, default=None, help='print the record of this id instead of indexing')
+    args = parser.parse_args()
+    if args.get:
+        with SeekableZstReader(args.zst_file, args.index_file) as zst_reader:
+            print(json.dumps(zst_reader.get(args.get)))
+    else:
+        if args.seekable_file:
+            make_seekable(args.zst_file, args.seekable_file, args.frame_size)
+            args.zst_file = args.seekable_file
+        build_index(args.zst_file, args.index_file)